@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import signal
+import sys
 from .daemon import Daemon
 
 
 def main(common):
     d = Daemon(common)
 
+    # Exit cleanly when the service manager stops the daemon, so it gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # This requires python 3.7+
     # asyncio.run(d.start())
 
     # This works in python 3.6
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait([d.start()]))
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.wait([d.start()]))
+    finally:
+        # Settings changes might still be waiting to be saved
+        d.cleanup()
 
 
 def stop(common):
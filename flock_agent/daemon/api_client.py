@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
 import base64
+import gzip
+import json
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+
+from .circuit_breaker import CircuitBreaker
+
+# zstd compression is optional, if the zstandard module is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class PermissionDenied(Exception):
@@ -20,6 +31,14 @@ class BadStatusCode(Exception):
     pass
 
 
+class PayloadTooLarge(Exception):
+    """
+    The API responded that the request body is too large
+    """
+
+    pass
+
+
 class ResponseIsNotJson(Exception):
     """
     If the API response is not JSON
@@ -52,9 +71,18 @@ class ConnectionError(Exception):
     pass
 
 
+class CircuitOpen(ConnectionError):
+    """
+    The server failed too many times recently, so the request wasn't sent
+    """
+
+    pass
+
+
 class FlockApiClient(object):
     """
-    This is a client that interacts with the Flock gateway
+    This is a client that interacts with the Flock gateway. The daemon keeps a single
+    instance of it, so every request reuses the same pool of keep-alive connections.
     """
 
     def __init__(self, common):
@@ -62,15 +90,47 @@ class FlockApiClient(object):
         logger = logging.getLogger("FlockApiClient.__init__")
         logger.debug("")
 
+        pool_size = self.c.global_settings.get("gateway_pool_size")
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = (
+            self.c.global_settings.get("gateway_connect_timeout"),
+            self.c.global_settings.get("gateway_read_timeout"),
+        )
+
+        # Stop hammering the server while it's down
+        self.breaker = CircuitBreaker(
+            self.c.global_settings.get("gateway_failure_threshold"),
+            self.c.global_settings.get("gateway_backoff_min"),
+            self.c.global_settings.get("gateway_backoff_max"),
+        )
+
+        # The request body content codings that the server accepts. Servers advertise
+        # these with an Accept-Encoding response header (RFC 7694), so until the first
+        # response, request bodies are sent uncompressed
+        self.request_encodings = []
+
+    def close(self):
+        """
+        Close all of the pooled connections
+        """
+        self.session.close()
+
     def register(self, name):
         logger = logging.getLogger("FlockApiClient.register")
         logger.debug("")
 
+        # Registering is something the user is waiting on, so it's sent even if the
+        # circuit breaker is open
         obj = self._make_request(
             "/register",
             "post",
             False,
             {"username": self.c.global_settings.get("gateway_username"), "name": name},
+            use_breaker=False,
         )
 
         if "auth_token" not in obj:
@@ -86,6 +146,23 @@ class FlockApiClient(object):
         logger.debug("")
         self._make_request("/ping", "get", True)
 
+    def check_connection(self):
+        """
+        Check if logs can be submitted to the server. The circuit breaker tracks how
+        real requests went, so while they're succeeding this doesn't send anything.
+        After failures, it pings the server as the breaker's probe, once the breaker's
+        backoff is over.
+        """
+        logger = logging.getLogger("FlockApiClient.check_connection")
+        if self.breaker.state == CircuitBreaker.CLOSED:
+            return True
+        try:
+            self.ping()
+            return True
+        except Exception as e:
+            logger.debug(f"server unavailable: {type(e).__name__}")
+            return False
+
     def submit(self, data):
         """
         Submit data to the Flock server
@@ -102,7 +179,7 @@ class FlockApiClient(object):
         logger.debug("")
         self._make_request("/submit_flock_logs", "post", True, data)
 
-    def _make_request(self, path, method, auth, data=None):
+    def _make_request(self, path, method, auth, data=None, use_breaker=True):
         """
         Makes a request to the api.
 
@@ -110,25 +187,54 @@ class FlockApiClient(object):
         method: the http method to use (string)
         auth: whether to use http authentication. (bool)
         data: Data to send with the reuqest (dict)
+        use_breaker: whether to fail right away if the circuit breaker is open (bool)
         """
         url = self._build_url(path)
 
         logger = logging.getLogger("FlockApiClient._make_request")
         logger.debug(f"{method} {url}")
 
-        try:
-            res = requests.request(
-                method, url, json=data, headers=self._get_headers(auth)
-            )
+        if use_breaker and not self.breaker.allow_request():
+            raise CircuitOpen()
 
-            logger.debug(f"status_code: {res.status_code}, data: {res.content}")
+        headers = self._get_headers(auth)
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers["Content-Type"] = "application/json"
 
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError()
+        encoding = self._get_request_encoding(body)
+        if encoding:
+            logger.debug(f"compressing {len(body)} bytes with {encoding}")
+            headers["Content-Encoding"] = encoding
+
+        try:
+            res = self._send(method, url, headers, self._compress(body, encoding))
+
+            # If the server doesn't support the compressed body after all, stop
+            # compressing and try again
+            if encoding and res.status_code == 415:
+                logger.info(f"server does not accept {encoding} request bodies")
+                self.request_encodings = []
+                del headers["Content-Encoding"]
+                res = self._send(method, url, headers, body)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        # Server errors and rate limiting count as failures, but any other response
+        # means the server is up
+        if res.status_code >= 500 or res.status_code == 429:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
 
         if res.status_code == 401:
             raise PermissionDenied()
 
+        if res.status_code == 413:
+            raise PayloadTooLarge()
+
         if res.status_code == 200 or res.status_code == 400:
             if res.content:
                 try:
@@ -151,6 +257,60 @@ class FlockApiClient(object):
         if res.status_code != 200:
             raise BadStatusCode(res)
 
+    def _send(self, method, url, headers, body):
+        """
+        Send a request with an already serialized body, and return the response
+        """
+        logger = logging.getLogger("FlockApiClient._send")
+        try:
+            res = self.session.request(
+                method, url, data=body, headers=headers, timeout=self.timeout,
+            )
+
+            logger.debug(f"status_code: {res.status_code}, data: {res.content}")
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            raise ConnectionError()
+
+        self._update_request_encodings(res)
+        return res
+
+    def _update_request_encodings(self, res):
+        """
+        Keep track of which request body codings the server says it accepts
+        """
+        if "Accept-Encoding" not in res.headers:
+            return
+        encodings = []
+        for encoding in res.headers["Accept-Encoding"].split(","):
+            encoding = encoding.split(";")[0].strip().lower()
+            if encoding in ["gzip", "zstd"]:
+                encodings.append(encoding)
+        self.request_encodings = encodings
+
+    def _get_request_encoding(self, body):
+        """
+        Pick how to compress a request body, or return None to not compress it
+        """
+        if (
+            body is None
+            or not self.c.global_settings.get("gateway_compression")
+            or len(body) < self.c.global_settings.get("gateway_compression_threshold")
+        ):
+            return None
+        if "zstd" in self.request_encodings and zstandard:
+            return "zstd"
+        if "gzip" in self.request_encodings:
+            return "gzip"
+        return None
+
+    def _compress(self, body, encoding):
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor().compress(body)
+        if encoding == "gzip":
+            return gzip.compress(body, compresslevel=6)
+        return body
+
     def _build_url(self, path):
         """
         Build the URL of a request, with a path starting with "/"
@@ -162,6 +322,8 @@ class FlockApiClient(object):
     def _get_headers(self, auth):
         headers = {}
         headers["User-Agent"] = "Flock Agent {}".format(self.c.version)
+        if not self.c.global_settings.get("gateway_keep_alive"):
+            headers["Connection"] = "close"
         if auth:
             encoded_credentials = base64.b64encode(
                 "{}:{}".format(
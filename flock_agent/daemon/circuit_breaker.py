@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to the server after it fails several times in a row.
+
+    While the breaker is closed, requests go through normally. After
+    failure_threshold failures in a row it opens, and requests fail right away
+    without touching the network. It stays open for a random time between 0 and an
+    exponentially growing backoff (full jitter), so that when the server comes back,
+    agents don't all reconnect at once. Then it's half-open: a single probe request
+    is let through, and if it succeeds the breaker closes, otherwise it opens again
+    with a longer backoff.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold, backoff_min, backoff_max, clock=time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.retry_at = 0
+        self.probing = False
+
+    def allow_request(self):
+        """
+        Check if a request can be sent to the server now. When the breaker is
+        half-open, this only returns True for one request, until its result is
+        recorded.
+        """
+        logger = logging.getLogger("CircuitBreaker.allow_request")
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+
+            if self.state == CircuitBreaker.OPEN and self.clock() >= self.retry_at:
+                logger.info("half-open, probing the server")
+                self.state = CircuitBreaker.HALF_OPEN
+
+            if self.state == CircuitBreaker.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        logger = logging.getLogger("CircuitBreaker.record_success")
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logger.info("closed, the server is back")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.opens = 0
+            self.probing = False
+
+    def record_failure(self):
+        logger = logging.getLogger("CircuitBreaker.record_failure")
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.OPEN:
+                # This request was sent before the breaker opened
+                return
+            if (
+                self.state == CircuitBreaker.HALF_OPEN
+                or self.failures >= self.failure_threshold
+            ):
+                backoff = min(
+                    self.backoff_max, self.backoff_min * 2 ** min(self.opens, 16)
+                )
+                delay = random.uniform(0, backoff)
+                logger.info(f"open, retrying in {delay:.0f}s")
+
+                self.state = CircuitBreaker.OPEN
+                self.opens += 1
+                self.retry_at = self.clock() + delay
+                self.probing = False
+
+    def seconds_until_retry(self):
+        """
+        How long until the breaker lets a request through, or 0 if it would now
+        """
+        with self.lock:
+            if self.state != CircuitBreaker.OPEN:
+                return 0
+            return max(0, self.retry_at - self.clock())
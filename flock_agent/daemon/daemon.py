@@ -3,6 +3,9 @@ import os
 import sys
 import grp
 import asyncio
+import concurrent.futures
+import json
+import uuid
 import requests
 import subprocess
 import logging
@@ -13,6 +16,11 @@ from aiohttp.web_runner import GracefulExit
 
 from .global_settings import GlobalSettings
 from .osquery import Osquery
+from .query_cache import QueryCache
+from .health_batch import stream_health_batch
+from .file_watcher import FileWatcher
+from .event_bus import EventBus, EventTypes
+from .submission_queue import SubmissionQueue
 from .flock_logs import FlockLog, FlockLogTypes
 from .api_client import (
     FlockApiClient,
@@ -25,6 +33,7 @@ from .api_client import (
 )
 from ..common import Platform
 from ..health import health_items
+from ..twigs import twigs
 
 
 class Daemon:
@@ -50,9 +59,26 @@ class Daemon:
 
         logger.info(f"version {self.c.version}")
 
+        # Flock Agent lib directory
+        if Platform.current() == Platform.MACOS:
+            self.lib_dir = "/usr/local/var/lib/flock-agent"
+        else:
+            self.lib_dir = "/var/lib/flock-agent"
+        os.makedirs(self.lib_dir, exist_ok=True)
+
+        # Logs from osquery and Flock Agent wait in this queue until the server accepts
+        # them
+        self.submission_queue = SubmissionQueue(self.lib_dir)
+        self.c.submission_queue = self.submission_queue
+
         self.osquery = Osquery(common)
         self.c.osquery = self.osquery
 
+        # Results of twig and health item queries that the GUI runs are cached. Twig
+        # results are kept for the twig's interval, and health results for 5 minutes
+        self.query_cache = QueryCache()
+        self.health_cache_ttl = 300
+
         hostname = self.osquery.exec("SELECT uuid AS host_uuid FROM system_info;")
         if hostname:
             hostname = hostname[0]["host_uuid"]
@@ -60,18 +86,29 @@ class Daemon:
         self.global_settings = GlobalSettings(common, hostname)
         self.c.global_settings = self.global_settings
 
+        # All requests to the server share this client's connection pool
         self.api_client = FlockApiClient(self.c)
+        self.c.api_client = self.api_client
 
-        # Flock Agent lib directory
-        if Platform.current() == Platform.MACOS:
-            self.lib_dir = "/usr/local/var/lib/flock-agent"
-        else:
-            self.lib_dir = "/var/lib/flock-agent"
-        os.makedirs(self.lib_dir, exist_ok=True)
+        # Submitting logs does blocking file and network I/O, so it runs in its own thread,
+        # one submission at a time, to keep the http server responsive
+        self.submit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # Identifies this run of the daemon in ETags, since twig_version starts over
+        # every time it starts
+        self.boot_id = uuid.uuid4().hex
+
+        # Tells the GUIs subscribed to /events about changes
+        self.event_bus = EventBus()
+        self.events_heartbeat_interval = 15
+
+        # Watches the log files for changes, once the submit loop starts
+        self.file_watcher = None
 
-        # Flock Agent keeps its own submission queue separate from osqueryd, for when users
+        # Flock Agent keeps its own log separate from osqueryd, for when users
         # enable/disable the server, or enable/disable twigs
         self.flock_log = FlockLog(self.c, self.lib_dir)
+        self.c.flock_log = self.flock_log
 
         # Prepare the unix socket path
         self.unix_socket_path = os.path.join(self.lib_dir, "socket")
@@ -104,42 +141,81 @@ class Daemon:
         )
 
     async def submit_loop(self):
+        # Submit logs a couple of seconds after they're written. If the log files can't
+        # be watched, poll them every minute instead, and even if they can, check
+        # every 5 minutes just in case
+        submit_event = asyncio.Event()
+        self.file_watcher = FileWatcher(
+            [
+                self.osquery.results_filename,
+                self.osquery.snapshots_filename,
+                self.flock_log.filename,
+            ],
+            submit_event.set,
+        )
+        if self.file_watcher.start():
+            poll_interval = 300
+        else:
+            poll_interval = 60
+
         while True:
+            # Changes while submitting trigger another pass
+            submit_event.clear()
+
             if self.global_settings.get("use_server") and self.global_settings.get(
                 "gateway_token"
             ):
                 await self.submit_logs_osquery()
                 await self.submit_logs_flock()
 
-            # Wait a minute
-            await asyncio.sleep(60)
+            try:
+                await asyncio.wait_for(submit_event.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
 
     async def submit_logs_osquery(self):
         # Submit osquery logs
         try:
-            self.osquery.submit_logs()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.submit_executor, self.osquery.submit_logs)
         except Exception as e:
             exception_type = type(e).__name__
             logger = logging.getLogger("Daemon.submit_loop")
             logger.debug(f"Exception submitting logs: {exception_type}")
+            self.event_bus.publish(
+                EventTypes.SUBMISSION_ERROR,
+                {"source": "osquery", "error": exception_type},
+            )
 
     async def submit_logs_flock(self):
         logger = logging.getLogger("Daemon.submit_logs_flock")
         # Submit Flock Agent logs
         try:
-            self.flock_log.submit_logs()
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(self.submit_executor, self.flock_log.submit_logs)
         except Exception as e:
             exception_type = type(e).__name__
             logger.warning(f"Exception submitting flock logs: {exception_type}")
+            self.event_bus.publish(
+                EventTypes.SUBMISSION_ERROR,
+                {"source": "flock", "error": exception_type},
+            )
 
     async def http_server(self):
         logger = logging.getLogger("Daemon.http_server")
         logger.info("Starting http server")
+        self.event_bus.start()
 
         def response_object(data=None, error=False):
             obj = {"data": data, "error": error}
             return web.json_response(obj)
 
+        def publish_twigs_changed():
+            self.event_bus.publish(
+                EventTypes.TWIGS_CHANGED,
+                {"twig_version": self.global_settings.twig_version},
+            )
+
         # Routes
         async def ping(request):
             return response_object()
@@ -170,14 +246,15 @@ class Daemon:
                 logger.debug(f"setting {key}={val}")
                 self.global_settings.set(key, val)
                 self.global_settings.save()
+                self.event_bus.publish(EventTypes.SETTING_CHANGED, {"key": key})
 
                 if key == "use_server":
                     if val:
                         self.flock_log.log(FlockLogTypes.SERVER_ENABLED)
                     else:
                         self.flock_log.log(FlockLogTypes.SERVER_DISABLED)
-                        # Submit flock logs right away
-                        await self.submit_logs_flock()
+                        # Submit flock logs right away, without making the client wait
+                        asyncio.ensure_future(self.submit_logs_flock())
 
             return response_object()
 
@@ -185,11 +262,16 @@ class Daemon:
             twig_id = request.match_info.get("twig_id", None)
             try:
                 twig = self.global_settings.get_twig(twig_id)
-                data = self.osquery.exec(twig["query"])
-                return response_object(data)
             except:
                 return response_object(error="invalid twig_id")
 
+            data = await self.query_cache.get(
+                ("twig", twig_id),
+                twigs[twig_id]["interval"],
+                lambda: self.osquery.exec_async(twig["query"]),
+            )
+            return response_object(data)
+
         async def enable_undecided_twigs(request):
             logger = logging.getLogger("Daemon.http_server.enable_undecided_twigs")
             # If the user choose to automatically opt-in to new twigs, this enables them all
@@ -205,6 +287,7 @@ class Daemon:
                 self.global_settings.save()
                 self.osquery.refresh_osqueryd()
                 self.flock_log.log(FlockLogTypes.TWIGS_ENABLED, enabled_twig_ids)
+                publish_twigs_changed()
 
             return response_object()
 
@@ -220,6 +303,22 @@ class Daemon:
         async def get_twig_enabled_statuses(request):
             return response_object(self.global_settings.get_twig_enabled_statuses())
 
+        async def get_twigs_state(request):
+            # Everything the GUI needs to know about twigs in one request. The ETag
+            # changes whenever any twig's state or use_server changes, so the GUI can
+            # use If-None-Match to skip downloading it again
+            state = self.global_settings.get_twigs_state()
+            state["use_server"] = self.global_settings.get("use_server")
+            etag = '"{}-{}-{}"'.format(
+                self.boot_id, state["twig_version"], int(state["use_server"])
+            )
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304, headers={"ETag": etag})
+
+            response = response_object(state)
+            response.headers["ETag"] = etag
+            return response
+
         async def update_twig_status(request):
             logger = logging.getLogger("Daemon.update_twig_status")
             twig_status = await request.json()
@@ -254,6 +353,7 @@ class Daemon:
             if enabled_twig_ids or disabled_twig_ids:
                 self.global_settings.save()
                 self.osquery.refresh_osqueryd()
+                publish_twigs_changed()
 
             if enabled_twig_ids:
                 logger.info(f"enabled twigs: {enabled_twig_ids}")
@@ -264,21 +364,101 @@ class Daemon:
 
             return response_object()
 
+        async def exec_health_item(health_item):
+            async def fetch():
+                # Every GUI gets fresh health results, not just the one that asked
+                data = await self.osquery.exec_async(health_item["query"])
+                if data is not None:
+                    self.event_bus.publish(
+                        EventTypes.HEALTH_CHANGED,
+                        {"name": health_item["name"], "data": data},
+                    )
+                return data
+
+            return await self.query_cache.get(
+                ("health", health_item["name"]), self.health_cache_ttl, fetch
+            )
+
         async def exec_health(request):
             health_item_name = request.match_info.get("health_item_name", None)
-            query = None
             for health_item in health_items[Platform.current()]:
                 if health_item["name"] == health_item_name:
-                    query = health_item["query"]
-                    break
-            if query:
-                try:
-                    data = self.osquery.exec(query)
+                    data = await exec_health_item(health_item)
+                    if data is None:
+                        return response_object(
+                            error="error executing health item query"
+                        )
                     return response_object(data)
-                except:
-                    return response_object(error="error executing health item query")
-            else:
-                return response_object(error="invalid health_item_name")
+
+            return response_object(error="invalid health_item_name")
+
+        async def exec_health_batch(request):
+            # Run all of the health item queries at once, and stream each result back
+            # as a line of JSON as soon as it's ready
+            response = web.StreamResponse()
+            response.content_type = "application/x-ndjson"
+            await response.prepare(request)
+            await stream_health_batch(
+                health_items[Platform.current()], exec_health_item, response.write
+            )
+            await response.write_eof()
+            return response
+
+        async def invalidate_cache(request):
+            self.query_cache.invalidate()
+            return response_object()
+
+        async def submission_queue_depth(request):
+            # How many logs are waiting to be submitted in each lane
+            loop = asyncio.get_event_loop()
+            depths = await loop.run_in_executor(None, self.submission_queue.depths)
+            lanes = [
+                self.osquery.get_lane_source(priority)
+                for priority, _ in self.osquery.lanes
+            ] + ["flock"]
+            return response_object({lane: depths.get(lane, 0) for lane in lanes})
+
+        async def submission_queue_dropped(request):
+            # How many logs were ever dropped from each lane, to stay in the disk budgets
+            loop = asyncio.get_event_loop()
+            dropped = await loop.run_in_executor(
+                None, self.submission_queue.get_dropped
+            )
+            return response_object(dropped)
+
+        async def events(request):
+            # Stream events to the GUI as server-sent events, until it disconnects.
+            # Comments get sent while it's quiet, so dead connections get noticed
+            response = web.StreamResponse()
+            response.content_type = "text/event-stream"
+            response.headers["Cache-Control"] = "no-cache"
+            await response.prepare(request)
+
+            queue = self.event_bus.subscribe()
+            try:
+                # Let the GUI know it's subscribed, so it can refresh anything it missed
+                queue.put_nowait(
+                    {"type": EventTypes.CONNECTED, "data": {"boot_id": self.boot_id}}
+                )
+                while True:
+                    try:
+                        event = await asyncio.wait_for(
+                            queue.get(), self.events_heartbeat_interval
+                        )
+                    except asyncio.TimeoutError:
+                        await response.write(b": heartbeat\n\n")
+                        continue
+                    if event is None:
+                        break
+                    message = "event: {}\ndata: {}\n\n".format(
+                        event["type"], json.dumps(event["data"])
+                    )
+                    await response.write(message.encode())
+            finally:
+                self.event_bus.unsubscribe(queue)
+
+            await response.write_eof()
+            return response
 
         async def register_server(request):
             data = await request.json()
@@ -304,9 +484,14 @@ class Daemon:
             self.global_settings.save()
 
             # Try to register
-            try:
+            def register():
                 self.api_client.register(name)
                 self.api_client.ping()
+
+            try:
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, register)
+                self.event_bus.publish(EventTypes.SERVER_REGISTERED)
                 return response_object()
             except PermissionDenied:
                 return response_object(error="Permission denied")
@@ -335,8 +520,14 @@ class Daemon:
         app.router.add_get("/undecided_twig_ids", get_undecided_twig_ids)
         app.router.add_get("/enabled_twig_ids", get_enabled_twig_ids)
         app.router.add_get("/twig_enabled_statuses", get_twig_enabled_statuses)
+        app.router.add_get("/twigs_state", get_twigs_state)
         app.router.add_post("/update_twig_status", update_twig_status)
         app.router.add_get("/exec_health/{health_item_name}", exec_health)
+        app.router.add_get("/exec_health_batch", exec_health_batch)
+        app.router.add_post("/invalidate_cache", invalidate_cache)
+        app.router.add_get("/submission_queue_depth", submission_queue_depth)
+        app.router.add_get("/submission_queue_dropped", submission_queue_dropped)
+        app.router.add_get("/events", events)
         app.router.add_post("/register_server", register_server)
 
         loop = asyncio.get_event_loop()
@@ -440,5 +631,14 @@ class Daemon:
                 await asyncio.sleep(30)
 
     def cleanup(self):
+        self.global_settings.flush()
+        if self.file_watcher:
+            self.file_watcher.stop()
+        self.submit_executor.shutdown()
+        self.api_client.close()
+        self.osquery.extension_client.close()
+        self.osquery.uploader.close()
+        self.flock_log.close()
+        self.submission_queue.close()
         if os.path.exists(self.unix_socket_path):
             os.remove(self.unix_socket_path)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+
+
+class EventBus(object):
+    """
+    Publishes events about changes in the daemon, like settings or twigs changing, to
+    every GUI that's subscribed to /events. Each subscriber gets its own queue, and
+    events can be published from any thread.
+
+    If a subscriber falls too far behind, it gets disconnected instead of letting its
+    queue grow forever. When it reconnects it should refresh everything.
+    """
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self.loop = None
+        self.subscribers = set()
+
+    def start(self):
+        """
+        Start delivering events, in the current event loop
+        """
+        self.loop = asyncio.get_event_loop()
+
+    def subscribe(self):
+        """
+        Return a new queue that gets every event published from now on. Getting None
+        from the queue means the subscriber was disconnected.
+        """
+        queue = asyncio.Queue(self.max_queued + 1)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event_type, data=None):
+        """
+        Send an event to all of the subscribers. This is safe to call from any thread.
+        """
+        if not self.loop:
+            return
+        event = {"type": event_type, "data": data}
+        self.loop.call_soon_threadsafe(self._publish, event)
+
+    def _publish(self, event):
+        logger = logging.getLogger("EventBus._publish")
+        for queue in list(self.subscribers):
+            if queue.qsize() < self.max_queued:
+                queue.put_nowait(event)
+            else:
+                # There's always room for this, because of the extra slot
+                logger.warning("subscriber is too far behind, disconnecting it")
+                self.unsubscribe(queue)
+                queue.put_nowait(None)
+
+
+class EventTypes:
+    CONNECTED = "connected"
+    SETTING_CHANGED = "setting_changed"
+    TWIGS_CHANGED = "twigs_changed"
+    HEALTH_CHANGED = "health_changed"
+    SERVER_REGISTERED = "server_registered"
+    SUBMISSION_ERROR = "submission_error"
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+from ..common import Platform
+
+# inotify constants, from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+inotify_event_header = struct.Struct("iIII")
+
+
+class FileWatcher(object):
+    """
+    Calls a callback soon after any of the watched files change, using inotify in
+    Linux and kqueue in macOS, so the event loop doesn't have to poll them. Changes
+    that come in bursts are coalesced into a single call, debounce seconds after the
+    first one.
+
+    The files' directories are watched too, so it keeps working when files get
+    rotated, truncated, or created.
+    """
+
+    def __init__(self, filenames, callback, debounce=2):
+        self.filenames = [os.path.abspath(filename) for filename in filenames]
+        self.callback = callback
+        self.debounce = debounce
+
+        self.loop = None
+        self.fd = None
+        self.kq = None
+        self.kq_fds = {}
+        self.debounce_handle = None
+
+    def start(self):
+        """
+        Start watching the files, in the current event loop. Returns False if the
+        files can't be watched on this platform, in which case the caller should fall
+        back to polling.
+        """
+        logger = logging.getLogger("FileWatcher.start")
+        self.loop = asyncio.get_event_loop()
+        try:
+            if Platform.current() == Platform.LINUX:
+                self._start_inotify()
+            elif Platform.current() == Platform.MACOS:
+                self._start_kqueue()
+            else:
+                return False
+        except OSError as e:
+            logger.warning(f"can't watch files, falling back to polling: {e}")
+            self.stop()
+            return False
+
+        logger.info(f"watching {', '.join(self.filenames)}")
+        return True
+
+    def stop(self):
+        if self.debounce_handle:
+            self.debounce_handle.cancel()
+            self.debounce_handle = None
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.kq:
+            self.loop.remove_reader(self.kq.fileno())
+            self.kq.close()
+            self.kq = None
+            for fd in self.kq_fds:
+                os.close(fd)
+            self.kq_fds = {}
+
+    def _changed(self):
+        # Only schedule one call at a time, so bursts of changes get coalesced
+        if not self.debounce_handle:
+            self.debounce_handle = self.loop.call_later(self.debounce, self._fire)
+
+    def _fire(self):
+        self.debounce_handle = None
+        self.callback()
+
+    def _start_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+
+        # Map each watch descriptor to the names of the watched files in that directory
+        self.inotify_watches = {}
+        for dirname in set(os.path.dirname(filename) for filename in self.filenames):
+            wd = libc.inotify_add_watch(
+                self.fd, dirname.encode(), IN_MODIFY | IN_CREATE | IN_MOVED_TO
+            )
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"can't watch {dirname}")
+            self.inotify_watches[wd] = set(
+                os.path.basename(filename).encode()
+                for filename in self.filenames
+                if os.path.dirname(filename) == dirname
+            )
+
+        self.loop.add_reader(self.fd, self._read_inotify)
+
+    def _read_inotify(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = inotify_event_header.unpack_from(data, offset)
+            offset += inotify_event_header.size
+            name = data[offset : offset + size].rstrip(b"\0")
+            offset += size
+
+            # Other files in the same directories, like the submission queue's
+            # database, are ignored
+            if mask & IN_Q_OVERFLOW or name in self.inotify_watches.get(wd, ()):
+                self._changed()
+
+    def _start_kqueue(self):
+        self.kq = select.kqueue()
+        self._watch_kqueue()
+        self.loop.add_reader(self.kq.fileno(), self._read_kqueue)
+
+    def _watch_kqueue(self):
+        """
+        Watch the directories, so creating or renaming files gets noticed, and the
+        files that exist right now, so writes to them get noticed
+        """
+        for fd in self.kq_fds:
+            os.close(fd)
+        self.kq_fds = {}
+
+        paths = set(os.path.dirname(filename) for filename in self.filenames)
+        paths.update(
+            filename for filename in self.filenames if os.path.exists(filename)
+        )
+
+        kevents = []
+        for path in paths:
+            try:
+                fd = os.open(path, getattr(os, "O_EVTONLY", os.O_RDONLY))
+            except FileNotFoundError:
+                continue
+            self.kq_fds[fd] = path
+            kevents.append(
+                select.kevent(
+                    fd,
+                    filter=select.KQ_FILTER_VNODE,
+                    flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                    fflags=select.KQ_NOTE_WRITE
+                    | select.KQ_NOTE_EXTEND
+                    | select.KQ_NOTE_DELETE
+                    | select.KQ_NOTE_RENAME,
+                )
+            )
+        self.kq.control(kevents, 0)
+
+    def _read_kqueue(self):
+        rewatch = False
+        for kevent in self.kq.control(None, 64, 0):
+            path = self.kq_fds.get(kevent.ident)
+            if path in self.filenames:
+                self._changed()
+                if kevent.fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME):
+                    rewatch = True
+            else:
+                # A file in one of the directories was created, deleted, or renamed
+                rewatch = True
+
+        if rewatch:
+            self._watch_kqueue()
+            self._changed()
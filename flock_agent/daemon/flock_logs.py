@@ -1,119 +1,200 @@
 import json
 import logging
 import os
+import threading
 import time
 
-from .api_client import FlockApiClient
+from .log_reader import LogReader
+from .uploader import Uploader
 
 
 class FlockLog:
+    """
+    Flock Agent's own log of events, like enabling or disabling twigs, which gets
+    submitted to the server alongside osquery results.
+
+    Events are written to flock.log through a long-lived file handle, and fsynced in
+    batches. To submit them, flock.log is atomically renamed to flock.log.pending, which
+    gets read into the submission queue and then deleted, so an event is always in
+    exactly one of the two files or the queue, even if the daemon crashes.
+    """
+
     def __init__(self, common, lib_dir):
         logger = logging.getLogger("FlockLog.__init__")
         self.c = common
         self.filename = os.path.join(lib_dir, "flock.log")
+        self.pending_filename = os.path.join(lib_dir, "flock.log.pending")
+        self.lib_dir = lib_dir
         logger.info(f"Sending flocklog to {self.filename}")
 
-        # If the log file doesn't exist, create an empty one
-        if not os.path.exists(self.filename):
-            open(self.filename, "a").close()
-            os.chmod(self.filename, 0o600)
-
-    def log(self, flock_log_type, twig_ids=None):
-        with open(self.filename, "a") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "type": flock_log_type,
-                        "twig_ids": twig_ids,
-                        "timestamp": int(time.time() * 1000),  # In milliseconds
-                    }
-                )
-                + "\n"
-            )
-        os.chmod(self.filename, 0o600)
+        # fsync after this many events, or this many seconds after the first unsynced
+        # event, whichever comes first
+        self.sync_size = 50
+        self.sync_interval = 1
+
+        # Logs get written from the http server while they're submitted from the
+        # submission thread
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.sync_timer = None
+
+        # Open the log file, creating an empty one if it doesn't exist
+        self.f = self._open()
+
+        # Keeps track of how much of the pending file has already been queued for
+        # submission
+        self.pending_reader = LogReader(
+            self.pending_filename, self.c.submission_queue, "flock.log.pending"
+        )
+        self.uploader = Uploader(self.c)
+
+    def log(self, flock_log_type, twig_ids=None, details=None):
+        obj = {
+            "type": flock_log_type,
+            "twig_ids": twig_ids,
+            "timestamp": int(time.time() * 1000),  # In milliseconds
+        }
+        if details:
+            obj.update(details)
+        line = json.dumps(obj) + "\n"
+
+        with self.lock:
+            # Write it right away, so it isn't lost if the daemon crashes
+            self.f.write(line)
+            self.f.flush()
+
+            # But only fsync once in a while
+            self.unsynced += 1
+            if self.unsynced >= self.sync_size:
+                self._sync()
+            elif not self.sync_timer:
+                self.sync_timer = threading.Timer(self.sync_interval, self.sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+
+    def sync(self):
+        """
+        Make sure all logged events are on disk
+        """
+        with self.lock:
+            self._sync()
+
+    def rotate(self):
+        """
+        Atomically move all logged events into the pending file, so they can be
+        submitted while new events go to a fresh log file. If the pending file still
+        exists because it hasn't been submitted yet, this does nothing.
+        """
+        logger = logging.getLogger("FlockLog.rotate")
+        with self.lock:
+            self._sync()
+            if os.path.exists(self.pending_filename):
+                return
+            if os.fstat(self.f.fileno()).st_size == 0:
+                return
+
+            logger.debug(f"renaming {self.filename} to {self.pending_filename}")
+            self.f.close()
+            os.rename(self.filename, self.pending_filename)
+            self.f = self._open()
+            self._sync_dir()
+
+    def close(self):
+        self.uploader.close()
+        with self.lock:
+            self._sync()
+            self.f.close()
 
     def submit_logs(self):
+        """
+        Move logged events into the submission queue, and then forward everything
+        that's queued to the Flock server.
+        """
         logger = logging.getLogger("FlockLog.submit_logs")
-        # Keep track of the biggest timestamp we see
-        biggest_timestamp = self.c.global_settings.get("last_flock_log_timestamp")
 
-        # What's the results file's modified timestamp, before we start the import
-        try:
-            mtime = os.path.getmtime(self.filename)
+        self.queue_logs()
+        if not self.c.submission_queue.depth("flock"):
+            return
+
+        # Use the daemon's API client, which is shared with the other log source, so
+        # they both know if the server is reachable
+        api_client = self.c.api_client
+        if not api_client.check_connection():
+            logger.warning("Unable to communicate with the server")
+            return
+
+        # Only delete them from the queue once the server has accepted them
+        for batch in self.uploader.upload("flock", api_client.submit_flock_logs):
+            logger.info(
+                f"submitted logs: {', '.join([obj['type'] for obj in batch.items])}",
+            )
 
-            # Load the log file
-            with open(self.filename, "r") as f:
-                lines = f.readlines()
-                if not lines:
-                    return
+    def queue_logs(self):
+        """
+        Rotate the log file, and read the pending file into the submission queue
+        """
+        logger = logging.getLogger("FlockLog.queue_logs")
 
-                logger.debug(f"{len(lines)} lines")
+        self.rotate()
+        if not os.path.exists(self.pending_filename):
+            return
 
-                # Start an API client
-                api_client = FlockApiClient(self.c)
+        for lines in self.pending_reader.read_batches(200):
+            # Make a list of logs
+            logs = []
+            for line in lines:
                 try:
-                    api_client.ping()
-                except:
-                    logger.warning("Unable to communicate with the server",)
-                    return
-
-                # Make a list of logs
-                logs = []
-                for line in lines:
-                    line = line.strip()
-
-                    try:
-                        obj = json.loads(line)
-                    except json.decoder.JSONDecodeError:
-                        logger.warning(f"warning: line is not valid JSON: {line}")
-                        continue
-
-                    if "timestamp" not in obj:
-                        logger.warning(f"warning: timestamp not in line: {line}")
-                        continue
-
-                    if "type" not in obj:
-                        obj["type"] = "unknown"
-
-                    # If we haven't submitted this yet
-                    if obj["timestamp"] > self.c.global_settings.get(
-                        "last_flock_log_timestamp"
-                    ):
-                        logs.append(obj)
-                    else:
-                        # Already submitted
-                        logger.info(
-                            f"skipping \"{obj['type']}\" result, already submitted",
-                        )
-
-                # Submit them
-                api_client.submit_flock_logs(logs)
-                logger.info(
-                    f"submitted logs: {', '.join([obj['type'] for obj in logs])}",
-                )
-
-                # Update the biggest timestamp, if needed
-                if len(logs) > 0:
-                    if logs[-1]["timestamp"] > biggest_timestamp:
-                        biggest_timestamp = logs[-1]["timestamp"]
-
-            # Update timestamp in settings
-            if (
-                self.c.global_settings.get("last_flock_log_timestamp")
-                < biggest_timestamp
-            ):
-                self.c.global_settings.set(
-                    "last_flock_log_timestamp", biggest_timestamp
-                )
-                self.c.global_settings.save()
-
-            # If the log file hasn't been modified since we started the import, truncate it
-            if mtime == os.path.getmtime(self.filename):
-                with open(self.filename, "w") as f:
-                    f.truncate()
-
-        except FileNotFoundError:
-            logger.warning(f"warning: file not found: {self.filename}")
+                    obj = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    logger.warning(f"warning: line is not valid JSON: {line}")
+                    continue
+
+                if "timestamp" not in obj:
+                    logger.warning(f"warning: timestamp not in line: {line}")
+                    continue
+
+                if "type" not in obj:
+                    obj["type"] = "unknown"
+                logs.append(obj)
+
+            # Queue them and move the checkpoint past them in one transaction, so they
+            # can't get queued twice
+            dropped = self.c.submission_queue.enqueue(
+                "flock",
+                logs,
+                checkpoint=self.pending_reader.checkpoint(),
+                budget=(self.c.global_settings.get("flock_log_max_bytes"), ["flock"]),
+            )
+            self.pending_reader.commit(saved=True)
+            if dropped:
+                self.log(FlockLogTypes.LOGS_DROPPED, details={"dropped": dropped})
+
+        # They've been queued, so delete the pending file
+        logger.debug(f"deleting {self.pending_filename}")
+        os.remove(self.pending_filename)
+        self._sync_dir()
+
+    def _open(self):
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        os.fchmod(fd, 0o600)
+        return os.fdopen(fd, "a")
+
+    def _sync(self):
+        if self.sync_timer:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.unsynced = 0
+
+    def _sync_dir(self):
+        # Make sure renames and deletes in the lib dir are on disk
+        fd = os.open(self.lib_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
 class FlockLogTypes:
@@ -121,3 +202,4 @@ class FlockLogTypes:
     SERVER_DISABLED = "server_disabled"
     TWIGS_ENABLED = "twigs_enabled"
     TWIGS_DISABLED = "twigs_disabled"
+    LOGS_DROPPED = "logs_dropped"
@@ -2,7 +2,7 @@
 import json
 import logging
 import os
-
+import threading
 
 from ..twigs import twigs
 from ..common import Platform
@@ -13,6 +13,15 @@ class GlobalSettings(object):
         self.c = common
         self.testing = testing
 
+        # Settings get changed both from the http server and from the submission thread
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        # Saving is coalesced: changes within save_delay seconds get written together
+        self.save_delay = 1
+        self.save_timer = None
+        self.dirty = False
+
         if Platform.current() == Platform.MACOS:
             etc_dir = "/usr/local/etc/flock-agent"
         else:
@@ -32,8 +41,23 @@ class GlobalSettings(object):
             "gateway_token": None,
             "gateway_username": None,
             "automatically_enable_twigs": False,
-            "last_osquery_result_timestamp": 0,  # Timestamp of the last osquery result sent to the server
-            "last_flock_log_timestamp": 0,  # Timestamp of the last flock logs sent to the server
+            "gateway_pool_size": 4,  # Number of pooled connections to the server
+            "gateway_keep_alive": True,  # Reuse connections to the server between requests
+            "gateway_connect_timeout": 10,  # Seconds to wait to connect to the server
+            "gateway_read_timeout": 60,  # Seconds to wait for the server to respond
+            "gateway_failure_threshold": 3,  # Back off after this many failed requests in a row
+            "gateway_backoff_min": 30,  # Seconds to back off after the first failures
+            "gateway_backoff_max": 1800,  # Most seconds to back off, as backoff doubles
+            "gateway_compression": True,  # Compress request bodies, if the server accepts it
+            "gateway_compression_threshold": 1024,  # Only compress bodies at least this big
+            "submission_batch_min_bytes": 16384,  # 16 KiB, smallest batch to submit
+            "submission_batch_max_bytes": 4194304,  # 4 MiB, biggest batch to submit
+            "submission_batch_target_seconds": 2,  # Grow batches while faster than this
+            "submission_max_in_flight": 4,  # Most batches in flight, up to pool size
+            "result_dedupe": True,  # Replace unchanged twig results with heartbeats
+            "result_resync_interval": 86400,  # Seconds between submitting each twig's full results
+            "osquery_results_max_bytes": 104857600,  # 100 MiB for queued osquery logs
+            "flock_log_max_bytes": 10485760,  # 10 MiB for queued Flock Agent logs
             # Twigs
             "twigs": {},
         }
@@ -42,6 +66,14 @@ class GlobalSettings(object):
         # the twig. Those dicts include the fields 'query' and 'enabled', where 'enabled'
         # is either 'undecided', 'enabled', or 'disabled'.
 
+        # Index of which twigs are in each state, which gets updated as twigs are
+        # enabled and disabled instead of scanning all of the twigs. twig_positions
+        # keeps track of the order of the twigs, and twig_version goes up every time
+        # any twig's state changes
+        self.twig_ids_by_state = {}
+        self.twig_positions = {}
+        self.twig_version = 0
+
         self.load(hostname)
 
     def get(self, key):
@@ -50,16 +82,18 @@ class GlobalSettings(object):
     def set(self, key, val):
         logger = logging.getLogger("GlobalSettings.set")
         logger.debug(f"{key} = {val}")
-        self.settings[key] = val
+        with self.lock:
+            self.settings[key] = val
+            self.dirty = True
 
     def get_twig(self, twig_id):
         return self.settings["twigs"][twig_id]
 
     def enable_twig(self, twig_id):
-        self.settings["twigs"][twig_id]["enabled"] = "enabled"
+        self._set_twig_state(twig_id, "enabled")
 
     def disable_twig(self, twig_id):
-        self.settings["twigs"][twig_id]["enabled"] = "disabled"
+        self._set_twig_state(twig_id, "disabled")
 
     def is_twig_enabled(self, twig_id):
         return self.settings["twigs"][twig_id]["enabled"] == "enabled"
@@ -68,31 +102,81 @@ class GlobalSettings(object):
         return self.settings["twigs"][twig_id]["enabled"] == "undecided"
 
     def get_decided_twig_ids(self):
-        twig_ids = []
-        for twig_id in self.settings["twigs"]:
-            if self.settings["twigs"][twig_id]["enabled"] != "undecided":
-                twig_ids.append(twig_id)
-        return twig_ids
+        return self._get_twig_ids_in_states(["enabled", "disabled"])
 
     def get_undecided_twig_ids(self):
-        twig_ids = []
-        for twig_id in self.settings["twigs"]:
-            if self.settings["twigs"][twig_id]["enabled"] == "undecided":
-                twig_ids.append(twig_id)
-        return twig_ids
+        return self._get_twig_ids_in_states(["undecided"])
 
     def get_enabled_twig_ids(self):
-        twig_ids = []
-        for twig_id in self.settings["twigs"]:
-            if self.settings["twigs"][twig_id]["enabled"] == "enabled":
-                twig_ids.append(twig_id)
-        return twig_ids
+        return self._get_twig_ids_in_states(["enabled"])
 
     def get_twig_enabled_statuses(self):
-        enabled_statuses = {}
-        for twig_id in self.settings["twigs"]:
-            enabled_statuses[twig_id] = self.settings["twigs"][twig_id]["enabled"]
-        return enabled_statuses
+        with self.lock:
+            return {
+                twig_id: self.settings["twigs"][twig_id]["enabled"]
+                for twig_id in self.settings["twigs"]
+            }
+
+    def get_twigs_state(self):
+        """
+        Return the state of all the twigs, along with twig_version, all at once so the
+        GUI doesn't need to ask for each part separately. The twigs include their
+        metadata, like name and description.
+        """
+        with self.lock:
+            return {
+                "twig_version": self.twig_version,
+                "twigs": {
+                    twig_id: dict(twigs[twig_id], enabled=twig["enabled"])
+                    for twig_id, twig in self.settings["twigs"].items()
+                },
+                "undecided_twig_ids": self._sort_twig_ids(["undecided"]),
+                "decided_twig_ids": self._sort_twig_ids(["enabled", "disabled"]),
+                "enabled_twig_ids": self._sort_twig_ids(["enabled"]),
+            }
+
+    def _get_twig_ids_in_states(self, states):
+        """
+        Return the ids of the twigs in any of these states, in the same order they are
+        in settings.twigs
+        """
+        with self.lock:
+            return self._sort_twig_ids(states)
+
+    def _sort_twig_ids(self, states):
+        # The caller must hold the lock
+        twig_ids = []
+        for state in states:
+            twig_ids.extend(self.twig_ids_by_state[state])
+        return sorted(twig_ids, key=self.twig_positions.get)
+
+    def _set_twig_state(self, twig_id, state):
+        with self.lock:
+            old_state = self.settings["twigs"][twig_id]["enabled"]
+            if old_state == state:
+                return
+            self.settings["twigs"][twig_id]["enabled"] = state
+            self.twig_ids_by_state[old_state].discard(twig_id)
+            self.twig_ids_by_state[state].add(twig_id)
+            self.twig_version += 1
+            self.dirty = True
+
+    def _index_twigs(self):
+        """
+        Build the index of which twigs are in each state from scratch
+        """
+        with self.lock:
+            self.twig_ids_by_state = {
+                "undecided": set(),
+                "enabled": set(),
+                "disabled": set(),
+            }
+            self.twig_positions = {}
+            for position, twig_id in enumerate(self.settings["twigs"]):
+                state = self.settings["twigs"][twig_id]["enabled"]
+                self.twig_ids_by_state[state].add(twig_id)
+                self.twig_positions[twig_id] = position
+            self.twig_version += 1
 
     def load(self, hostname):
         logger = logging.getLogger("GlobalSettings.load")
@@ -110,6 +194,13 @@ class GlobalSettings(object):
                     if key not in self.settings:
                         self.settings[key] = self.default_settings[key]
 
+                # The submission queue keeps track of what's been submitted now
+                for key in [
+                    "last_osquery_result_timestamp",
+                    "last_flock_log_timestamp",
+                ]:
+                    self.settings.pop(key, None)
+
             except:
                 # If there's an error loading settings, fallback to default settings
                 logger.warning("error loading settings, falling back to default")
@@ -164,15 +255,73 @@ class GlobalSettings(object):
             if twig_id not in twigs:
                 del self.settings["twigs"][twig_id]
 
-        self.save()
+        self._index_twigs()
+        self.dirty = True
+        self.flush()
 
     def save(self):
-        logger = logging.getLogger("GlobalSettings.save")
-        logger.debug("saving")
+        """
+        Save the settings soon. Changes until then get written together.
+        """
         # When unit testing we likely won't have access to these directories and there's no point
         # saving config data.
-        if not self.testing:
-            os.makedirs(self.c.appdata_path, exist_ok=True)
-            with open(self.settings_filename, "w") as settings_file:
-                json.dump(self.settings, settings_file, indent=4)
-            os.chmod(self.settings_filename, 0o600)
+        if self.testing:
+            return
+        with self.lock:
+            if not self.save_timer:
+                self.save_timer = threading.Timer(self.save_delay, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        """
+        Write any unsaved changes right away
+        """
+        logger = logging.getLogger("GlobalSettings.flush")
+        if self.testing:
+            return
+
+        # Hold the write lock while taking the snapshot too, so two flushes at once
+        # can't write an older snapshot after a newer one
+        with self.write_lock:
+            with self.lock:
+                if self.save_timer:
+                    self.save_timer.cancel()
+                    self.save_timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+
+                # Serialize while holding the lock, so nothing changes halfway through
+                data = json.dumps(self.settings, indent=4)
+
+            try:
+                os.makedirs(self.c.appdata_path, exist_ok=True)
+                logger.debug(f"saving {self.settings_filename}")
+                self._write(self.settings_filename, data)
+            except:
+                # Try again next time
+                logger.warning("error saving settings")
+                with self.lock:
+                    self.dirty = True
+                raise
+
+    def _write(self, filename, data):
+        """
+        Atomically replace a file, so a crash can never leave it half written
+        """
+        tmp_filename = f"{filename}.tmp"
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_filename, 0o600)
+        os.replace(tmp_filename, filename)
+
+        # Make sure the rename is on disk too
+        dir_fd = os.open(os.path.dirname(filename), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+
+
+async def stream_health_batch(health_items, exec_health_item, write):
+    """
+    Run all of the health item queries at once, and as soon as each one is ready,
+    pass its result to write() as a line of JSON, like:
+
+    {"name": "...", "data": [...], "error": false}
+
+    If a query fails, its line has an error instead of data, and the rest keep
+    going. If write() fails, like when the client disconnects, or if this gets
+    cancelled, the rest of the queries get cancelled too.
+    """
+    logger = logging.getLogger("stream_health_batch")
+
+    async def exec_named_health_item(health_item):
+        try:
+            data = await exec_health_item(health_item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"{health_item['name']}: {type(e).__name__}")
+            data = None
+        return health_item["name"], data
+
+    tasks = [
+        asyncio.ensure_future(exec_named_health_item(health_item))
+        for health_item in health_items
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            name, data = await task
+            if data is None:
+                obj = {
+                    "name": name,
+                    "data": None,
+                    "error": "error executing health item query",
+                }
+            else:
+                obj = {"name": name, "data": data, "error": False}
+            await write((json.dumps(obj) + "\n").encode())
+    finally:
+        for task in tasks:
+            task.cancel()
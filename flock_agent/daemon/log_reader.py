@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+
+
+class LogReader(object):
+    """
+    Streams new lines out of a log file that another process appends to, like
+    osqueryd's results log. The byte offset (and inode) of the last line that was
+    handled is persisted as a named checkpoint in the submission queue, so each pass
+    only parses the lines that were appended since the previous one, and memory use is
+    bounded by a single batch no matter how big the file gets.
+    """
+
+    def __init__(self, filename, checkpoints, name):
+        self.filename = filename
+        self.checkpoints = checkpoints
+        self.name = name
+
+        self.inode = None
+        self.offset = 0
+        self.pending_offset = 0
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        checkpoint = self.checkpoints.get_checkpoint(self.name)
+        if checkpoint:
+            self.inode, self.offset = checkpoint
+
+    def save_checkpoint(self):
+        self.checkpoints.set_checkpoint(self.name, self.inode, self.offset)
+
+    def checkpoint(self):
+        """
+        The (name, inode, offset) checkpoint for everything yielded so far, so it can
+        be saved in the same transaction that enqueues the lines
+        """
+        return (self.name, self.inode, self.pending_offset)
+
+    def has_new_lines(self):
+        """
+        Check if anything was appended (or the file was replaced) since the checkpoint,
+        without reading it
+        """
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        return st.st_ino != self.inode or st.st_size != self.offset
+
+    def read_batches(self, batch_size):
+        """
+        Generator that yields lists of up to batch_size complete lines that haven't
+        been handled yet. After handling a batch, call commit() to move the checkpoint
+        past it; if it's not committed, the same lines get read again next time.
+        """
+        with open(self.filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # The file was rotated or truncated, so start from the beginning
+                self.inode = st.st_ino
+                self.offset = 0
+
+            f.seek(self.offset)
+            self.pending_offset = self.offset
+
+            batch = []
+            for line in f:
+                # If the last line isn't finished being written, pick it up next time
+                if not line.endswith(b"\n"):
+                    break
+
+                self.pending_offset += len(line)
+                line = line.strip()
+                if line:
+                    batch.append(line.decode("utf-8", errors="replace"))
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+    def commit(self, saved=False):
+        """
+        Mark everything yielded so far as handled. Pass saved=True if checkpoint() was
+        already saved along with the lines.
+        """
+        self.offset = self.pending_offset
+        if not saved:
+            self.save_checkpoint()
+
+    def truncate_if_consumed(self):
+        """
+        If every line in the file has been handled, truncate it so it doesn't grow
+        forever, and start over from the beginning
+        """
+        try:
+            # Truncating an empty file would still look like a change to the file
+            # watcher, and wake up the submit loop again for nothing
+            if os.stat(self.filename).st_size == 0:
+                return
+            with open(self.filename, "r+b") as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino == self.inode and 0 < st.st_size == self.offset:
+                    f.truncate(0)
+                    self.offset = 0
+                    self.save_checkpoint()
+        except FileNotFoundError:
+            pass
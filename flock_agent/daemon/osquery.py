@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import logging
 import os
 import shutil
 import subprocess
 
-from .api_client import FlockApiClient
+from .log_reader import LogReader
+from .flock_logs import FlockLogTypes
+from .result_dedupe import ResultDeduplicator
+from .uploader import Uploader
+from .osquery_extension import (
+    ExtensionClient,
+    ExtensionSocketError,
+    QueryFailed,
+    QueryHandle,
+)
 from ..twigs import twigs
 from ..common import Platform
 
@@ -27,7 +37,11 @@ class Osquery(object):
             self.log_dir = os.path.join(self.lib_dir, "osquery_logs")
             self.config_filename = os.path.join(self.lib_dir, "osquery.conf")
             self.results_filename = os.path.join(self.log_dir, "osqueryd.results.log")
+            self.snapshots_filename = os.path.join(
+                self.log_dir, "osqueryd.snapshots.log"
+            )
             self.plist_filename = "/Library/LaunchAgents/com.facebook.osqueryd.plist"
+            self.extensions_socket = os.path.join(self.lib_dir, "osquery.em")
             os.makedirs(self.lib_dir, exist_ok=True)
 
             # osqueryi should be a symlink to osqueryd -- if it doesn't exist, create it
@@ -41,12 +55,48 @@ class Osquery(object):
             os.chmod("/usr/local/bin/osqueryctl", 0o755)
         else:
             self.osqueryi_bin = "/usr/bin/osqueryi"
+            self.lib_dir = "/var/lib/flock-agent"
             self.log_dir = "/var/log/osquery"
             self.config_filename = "/etc/osquery/osquery.conf"
             self.results_filename = os.path.join(self.log_dir, "osqueryd.results.log")
+            self.snapshots_filename = os.path.join(
+                self.log_dir, "osqueryd.snapshots.log"
+            )
+            self.extensions_socket = "/var/osquery/osquery.em"
+            os.makedirs(self.lib_dir, exist_ok=True)
 
         os.makedirs(self.log_dir, exist_ok=True)
 
+        # Limits for queries run with exec_async
+        self.max_concurrent_queries = 2
+        self.query_timeout = 30  # seconds
+        self.query_semaphore = None
+
+        # When osqueryd is running, queries run over its extension socket instead of in
+        # a new osqueryi process
+        self.extension_client = ExtensionClient(
+            self.extensions_socket, self.query_timeout, self.max_concurrent_queries
+        )
+
+        # Keep track of how much of the results files have already been queued for
+        # submission. osqueryd logs differential results to the results file, and
+        # the results of snapshot twigs to the snapshots file
+        self.results_reader = LogReader(
+            self.results_filename, self.c.submission_queue, "osqueryd.results"
+        )
+        self.snapshots_reader = LogReader(
+            self.snapshots_filename, self.c.submission_queue, "osqueryd.snapshots"
+        )
+        self.uploader = Uploader(self.c)
+
+        # Replaces results that haven't changed with heartbeats
+        self.deduplicator = ResultDeduplicator(self.c)
+
+        # Results are queued in a lane for their twig's priority. Higher priority lanes
+        # get submitted first, but each round every lane gets to submit this many
+        # batches, so bulk results still make progress
+        self.lanes = [("high", 4), ("normal", 2), ("bulk", 1)]
+
         # Define the skeleton osquery config file, without any twigs
         self.config_skeleton = {
             "options": {
@@ -57,6 +107,8 @@ class Osquery(object):
                 "schedule_splay_percent": "10",
                 "utc": "true",
                 "host_identifier": "uuid",
+                "config_refresh": 60,  # re-read this file, for schedule changes
+                "log_result_events": True,  # log differential results one row at a time
             },
             "schedule": {},
             "decorators": {
@@ -68,8 +120,11 @@ class Osquery(object):
 
     def refresh_osqueryd(self):
         """
-        Rebuild the osquery config file based on the latest settings, and restart
-        the osqueryd daemon
+        Rebuild the osquery config file based on the latest settings, and make sure
+        osqueryd is using it. If the config is unchanged nothing happens. If only the
+        schedule changed, osqueryd reloads the config file in place (every
+        config_refresh seconds), which keeps its differential results state. It only
+        gets restarted if anything else changed.
         """
         if self.c.global_settings.get("use_server"):
             logger = logging.getLogger("Osquery.refresh_osqueryd")
@@ -77,59 +132,34 @@ class Osquery(object):
                 f"enabling twigs: {', '.join(self.c.global_settings.get_enabled_twig_ids())}"
             )
 
-            # Rebuild osquery config
-            config = self.config_skeleton.copy()
-            config["schedule"] = {}  # clear the existing schedule
-            for twig_id in self.c.global_settings.get_enabled_twig_ids():
-                config["schedule"][twig_id] = {
-                    "query": twigs[twig_id]["query"],
-                    "interval": twigs[twig_id]["interval"],
-                    "description": twigs[twig_id]["description"],
-                }
-
-            # Stop osqueryd
-            if Platform.current() == Platform.MACOS:
-                if os.path.exists(self.plist_filename):
-                    subprocess.run(["/bin/launchctl", "unload", self.plist_filename])
-            elif Platform.current() == Platform.LINUX:
-                subprocess.run(
-                    ["/usr/bin/pkexec", "/bin/systemctl", "stop", "osqueryd"]
-                )
+            # Rebuild osquery config, and compare it to the one osqueryd is using
+            config = self.build_config()
+            config_json = json.dumps(config, indent=4)
+            old_config_json = self._read_config()
 
-            # Write the config file
-            try:
-                with open(self.config_filename, "w") as config_file:
-                    json.dump(config, config_file, indent=4)
-            except PermissionError:
-                # TODO: hack until flock-agentd runs as root
-                subprocess.run(
-                    ["/usr/bin/pkexec", "/usr/bin/touch", self.config_filename]
-                )
-                subprocess.run(
-                    [
-                        "/usr/bin/pkexec",
-                        "/usr/bin/chown",
-                        "$USER:$USER",
-                        self.config_filename,
-                    ]
-                )
+            if not self._is_osqueryd_running():
+                logger.info("osqueryd is not running, starting it")
+                self._write_config(config_json)
+                self._start_osqueryd()
 
-            # Start osqueryd
-            if Platform.current() == Platform.MACOS:
-                shutil.copyfile(
-                    self.c.get_resource_path(
-                        "autostart/macos/com.facebook.osqueryd.plist"
-                    ),
-                    self.plist_filename,
-                )
-                subprocess.run(["/bin/launchctl", "load", self.plist_filename])
-            elif Platform.current() == Platform.LINUX:
-                subprocess.run(
-                    ["/usr/bin/pkexec", "/bin/systemctl", "start", "osqueryd"]
-                )
-                subprocess.run(
-                    ["/usr/bin/pkexec", "/bin/systemctl", "enable", "osqueryd"]
-                )
+            elif not self._is_plist_current():
+                logger.info("osqueryd launchd plist changed, restarting osqueryd")
+                self._stop_osqueryd()
+                self._write_config(config_json)
+                self._start_osqueryd()
+
+            elif config_json == old_config_json:
+                logger.info("osquery config is unchanged")
+
+            elif self._needs_restart(old_config_json, config):
+                logger.info("osquery config changed, restarting osqueryd")
+                self._stop_osqueryd()
+                self._write_config(config_json)
+                self._start_osqueryd()
+
+            else:
+                logger.info("osquery schedule changed, osqueryd will reload it")
+                self._write_config(config_json)
 
         else:
             logger = logging.getLogger("Osquery.refresh_osqueryd")
@@ -148,12 +178,124 @@ class Osquery(object):
                     ["/usr/bin/pkexec", "/bin/systemctl", "disable", "osqueryd"]
                 )
 
+    def build_config(self):
+        """
+        Build the osquery config, with a schedule of all of the enabled twigs
+        """
+        config = self.config_skeleton.copy()
+        config["schedule"] = {}  # clear the existing schedule
+        for twig_id in self.c.global_settings.get_enabled_twig_ids():
+            config["schedule"][twig_id] = {
+                "query": twigs[twig_id]["query"],
+                "interval": twigs[twig_id]["interval"],
+                "description": twigs[twig_id]["description"],
+            }
+            if twigs[twig_id]["result_mode"] == "snapshot":
+                config["schedule"][twig_id]["snapshot"] = True
+            else:
+                config["schedule"][twig_id]["removed"] = True
+        return config
+
+    def _read_config(self):
+        try:
+            with open(self.config_filename, "r") as config_file:
+                return config_file.read()
+        except (FileNotFoundError, PermissionError):
+            return None
+
+    def _needs_restart(self, old_config_json, config):
+        """
+        osqueryd picks up schedule changes when it refreshes its config, but changes
+        to anything else (like options, which mostly only apply at startup) need a
+        restart
+        """
+        try:
+            old_config = json.loads(old_config_json)
+        except (TypeError, ValueError):
+            return True
+        old_config.pop("schedule", None)
+        return old_config != {key: config[key] for key in config if key != "schedule"}
+
+    def _write_config(self, config_json):
+        try:
+            with open(self.config_filename, "w") as config_file:
+                config_file.write(config_json)
+        except PermissionError:
+            # TODO: hack until flock-agentd runs as root
+            subprocess.run(["/usr/bin/pkexec", "/usr/bin/touch", self.config_filename])
+            subprocess.run(
+                [
+                    "/usr/bin/pkexec",
+                    "/usr/bin/chown",
+                    "$USER:$USER",
+                    self.config_filename,
+                ]
+            )
+
+    def _is_osqueryd_running(self):
+        if Platform.current() == Platform.MACOS:
+            if not os.path.exists(self.plist_filename):
+                return False
+            p = subprocess.run(
+                ["/bin/launchctl", "list", "com.facebook.osqueryd"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            return p.returncode == 0
+        elif Platform.current() == Platform.LINUX:
+            p = subprocess.run(["/bin/systemctl", "is-active", "--quiet", "osqueryd"])
+            return p.returncode == 0
+        return False
+
+    def _is_plist_current(self):
+        """
+        In macOS, check if osqueryd was started with the latest version of its plist
+        """
+        if Platform.current() != Platform.MACOS:
+            return True
+        try:
+            with open(self.plist_filename, "rb") as f:
+                installed_plist = f.read()
+            with open(self._get_plist_resource_path(), "rb") as f:
+                return installed_plist == f.read()
+        except FileNotFoundError:
+            return False
+
+    def _get_plist_resource_path(self):
+        return self.c.get_resource_path("autostart/macos/com.facebook.osqueryd.plist")
+
+    def _stop_osqueryd(self):
+        if Platform.current() == Platform.MACOS:
+            if os.path.exists(self.plist_filename):
+                subprocess.run(["/bin/launchctl", "unload", self.plist_filename])
+        elif Platform.current() == Platform.LINUX:
+            subprocess.run(["/usr/bin/pkexec", "/bin/systemctl", "stop", "osqueryd"])
+
+    def _start_osqueryd(self):
+        if Platform.current() == Platform.MACOS:
+            shutil.copyfile(self._get_plist_resource_path(), self.plist_filename)
+            subprocess.run(["/bin/launchctl", "load", self.plist_filename])
+        elif Platform.current() == Platform.LINUX:
+            subprocess.run(["/usr/bin/pkexec", "/bin/systemctl", "start", "osqueryd"])
+            subprocess.run(["/usr/bin/pkexec", "/bin/systemctl", "enable", "osqueryd"])
+
     def exec(self, query):
         """
         Run an osquery query, return the response as an object
         """
         logger = logging.getLogger("Osquery.exec")
         logger.info(query)
+
+        try:
+            data = self.extension_client.query(query)
+            logger.info(f"{repr(data)}")
+            return data
+        except QueryFailed as e:
+            logger.info(f"error executing query: {e}")
+            return None
+        except ExtensionSocketError as e:
+            logger.debug(f"extension socket unavailable, using osqueryi: {e}")
+
         try:
             p = subprocess.run(
                 [self.osqueryi_bin, "--json", query], stdout=subprocess.PIPE, check=True
@@ -165,87 +307,234 @@ class Osquery(object):
             logger.info("error executing query")
             return None
 
+    async def exec_async(self, query):
+        """
+        Run an osquery query without blocking the event loop, return the response as an
+        object. Only a few queries run at a time, and each one gets stopped if it takes
+        too long, or if the caller is cancelled (like when a client disconnects).
+        """
+        logger = logging.getLogger("Osquery.exec_async")
+        logger.info(query)
+
+        # Create the semaphore here, so it belongs to the running event loop
+        if not self.query_semaphore:
+            self.query_semaphore = asyncio.Semaphore(self.max_concurrent_queries)
+
+        async with self.query_semaphore:
+            handle = QueryHandle()
+            try:
+                loop = asyncio.get_event_loop()
+                data = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        None, self.extension_client.query, query, handle
+                    ),
+                    self.query_timeout,
+                )
+                logger.info(f"{repr(data)}")
+                return data
+            except asyncio.TimeoutError:
+                # Drop its connection, so the executor thread doesn't keep waiting
+                logger.warning(f"query timed out after {self.query_timeout}s")
+                handle.abort()
+                return None
+            except asyncio.CancelledError:
+                logger.info("query cancelled")
+                handle.abort()
+                raise
+            except QueryFailed as e:
+                logger.info(f"error executing query: {e}")
+                return None
+            except ExtensionSocketError as e:
+                logger.debug(f"extension socket unavailable, using osqueryi: {e}")
+
+            try:
+                p = await asyncio.create_subprocess_exec(
+                    self.osqueryi_bin, "--json", query, stdout=asyncio.subprocess.PIPE,
+                )
+            except OSError:
+                logger.info("error executing query")
+                return None
+
+            try:
+                stdout, _ = await asyncio.wait_for(p.communicate(), self.query_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"query timed out after {self.query_timeout}s")
+                await self._kill(p)
+                return None
+            except asyncio.CancelledError:
+                logger.info("query cancelled")
+                await self._kill(p)
+                raise
+
+        logger.info(f"{repr(stdout)}")
+        if p.returncode != 0:
+            logger.info("error executing query")
+            return None
+        try:
+            return json.loads(stdout)
+        except ValueError:
+            logger.info("error parsing query response")
+            return None
+
+    async def _kill(self, p):
+        try:
+            p.kill()
+        except ProcessLookupError:
+            # It already finished
+            pass
+        await p.wait()
+
     def submit_logs(self):
         """
-        If there are new osquery result logs, forward them to the Flock server and
-        truncate the result file.
+        Move new osquery result logs into the submission queue, and then forward
+        everything that's queued to the Flock server, one batch at a time.
         """
         logger = logging.getLogger("Osquery.submit_logs")
-        # Keep track of the biggest timestamp we see
-        biggest_timestamp = self.c.global_settings.get("last_osquery_result_timestamp")
 
-        try:
-            # What's the results file's modified timestamp, before we start the import
-            mtime = os.path.getmtime(self.results_filename)
+        self.queue_logs()
+        if not any(
+            self.c.submission_queue.depth(self.get_lane_source(priority))
+            for priority, _ in self.lanes
+        ):
+            return
 
-            # Load the log file
-            with open(self.results_filename, "r") as results_file:
-                lines = results_file.readlines()
-                if len(lines) > 0:
-                    logger.debug(f"{len(lines)} lines")
+        # Use the daemon's API client, which is shared with the other log source, so
+        # they both know if the server is reachable
+        api_client = self.c.api_client
+        if not api_client.check_connection():
+            logger.warning("Unable to communicate with the server")
+            return
 
-                    # Start an API client
-                    api_client = FlockApiClient(self.c)
-                    try:
-                        api_client.ping()
-                    except:
-                        logger.warning("Unable to communicate with the server")
-                        return
+        # Submit the logs in batches, which only get deleted from the queue once the
+        # server has accepted them
+        while True:
+            submitted = False
+            for priority, max_batches in self.lanes:
+                for batch in self.uploader.upload(
+                    self.get_lane_source(priority), api_client.submit, max_batches
+                ):
+                    submitted = True
+                    names = ", ".join([obj["name"] for obj in batch.items])
+                    logger.info(f"submitted {priority} logs: {names}")
+
+            if not submitted:
+                break
+
+            # Queue any new results before the next round, so urgent ones don't wait
+            # behind a big backlog
+            self.queue_logs()
 
-                    # Make a list of logs
-                    logs = []
+    def split_diff_results(self, obj):
+        """
+        Differential results are logged one row at a time, as "added" or "removed"
+        events, but if osqueryd logged a whole batch of them at once (like before
+        log_result_events was set), split them up the same way
+        """
+        if "diffResults" not in obj:
+            return [obj]
+
+        logs = []
+        for action in ["added", "removed"]:
+            for row in obj["diffResults"].get(action, []):
+                event = {key: obj[key] for key in obj if key != "diffResults"}
+                event["action"] = action
+                event["columns"] = row
+                logs.append(event)
+        return logs
+
+    def get_priority(self, twig_id):
+        if twig_id in twigs:
+            return twigs[twig_id]["priority"]
+        return "normal"
+
+    def get_budget(self):
+        """
+        The disk budget for queued results, which drops the lowest priority lanes'
+        oldest results first
+        """
+        return (
+            self.c.global_settings.get("osquery_results_max_bytes"),
+            [self.get_lane_source(priority) for priority, _ in reversed(self.lanes)],
+        )
+
+    def get_lane_source(self, priority):
+        """
+        The submission queue source for a lane
+        """
+        return f"osquery_{priority}"
+
+    def get_log_readers(self):
+        """
+        The readers for each of the files that osqueryd logs results to
+        """
+        return [self.results_reader, self.snapshots_reader]
+
+    def queue_logs(self):
+        """
+        Read new lines from the results files into the submission queue. This works
+        even when the server can't be reached, so the results files don't grow while
+        logs pile up.
+        """
+        for reader in self.get_log_readers():
+            self._queue_log_file(reader)
+
+    def _queue_log_file(self, reader):
+        logger = logging.getLogger("Osquery._queue_log_file")
+
+        if not os.path.exists(reader.filename):
+            logger.warning(f"warning: file not found: {reader.filename}")
+            return
+
+        if reader.has_new_lines():
+            try:
+                for lines in reader.read_batches(200):
+                    logger.debug(f"{len(lines)} lines")
+
+                    # Sort the logs into lanes
+                    lanes = {priority: [] for priority, _ in self.lanes}
                     for line in lines:
-                        line = line.strip()
                         try:
                             obj = json.loads(line)
                             if "name" not in obj:
                                 obj["name"] = "unknown"
-
-                            if "unixTime" in obj:
-                                # If we haven't submitted this yet
-                                if obj["unixTime"] > self.c.global_settings.get(
-                                    "last_osquery_result_timestamp"
-                                ):
-                                    logs.append(obj)
-                                else:
-                                    # Already submitted
-                                    logger.info(
-                                        f"skipping \"{obj['name']}\" result, already submitted"
-                                    )
-                            else:
-                                logger.warning(f"warning: unixTime not in line: {line}")
-
+                            lanes[self.get_priority(obj["name"])].extend(
+                                self.split_diff_results(obj)
+                            )
                         except json.decoder.JSONDecodeError:
                             logger.warning(f"warning: line is not valid JSON: {line}")
 
-                    # Submit up to 200 log items at a time
-                    chunks = [logs[x : x + 200] for x in range(0, len(logs), 200)]
-                    for chunk in chunks:
-                        api_client.submit(chunk)
-                        logger.info(
-                            f"submitted logs: {', '.join([obj['name'] for obj in chunk])}"
+                    # Replace results that haven't changed with heartbeats
+                    items_by_source = {
+                        self.get_lane_source(priority): self.deduplicator.dedupe(logs)
+                        for priority, logs in lanes.items()
+                    }
+
+                    # Queue them and move the checkpoint past them in one transaction,
+                    # so they can't get queued twice
+                    try:
+                        dropped = self.c.submission_queue.enqueue_many(
+                            items_by_source,
+                            checkpoint=reader.checkpoint(),
+                            budget=self.get_budget(),
+                            result_sets=self.deduplicator.get_changes(),
                         )
+                    except:
+                        # The index wasn't saved, so start over from what was
+                        self.deduplicator.load()
+                        raise
+                    reader.commit(saved=True)
 
-                    # Update the biggest timestamp, if needed
-                    if logs[-1]["unixTime"] > biggest_timestamp:
-                        biggest_timestamp = logs[-1]["unixTime"]
-
-            # Update timestamp in settings
-            if (
-                self.c.global_settings.get("last_osquery_result_timestamp")
-                < biggest_timestamp
-            ):
-                self.c.global_settings.set(
-                    "last_osquery_result_timestamp", biggest_timestamp
-                )
-                self.c.global_settings.save()
+                    if dropped:
+                        # Results that were dropped never made it to the server, so
+                        # submit everything in full again
+                        self.deduplicator.reset()
+                        self.c.flock_log.log(
+                            FlockLogTypes.LOGS_DROPPED, details={"dropped": dropped}
+                        )
 
-            # If the results file hasn't been modified since we started the import, truncate it
-            # (If it has been modified, this means more logs have been added, and we should wait
-            # until the next this function gets called to truncate)
-            if mtime == os.path.getmtime(self.results_filename):
-                with open(self.results_filename, "w") as results_file:
-                    results_file.truncate()
+            except FileNotFoundError:
+                logger.warning(f"warning: file not found: {reader.filename}")
 
-        except FileNotFoundError:
-            logger.warning(f"warning: file not found: {self.results_filename}")
+        # If everything in the file has been queued, truncate it (if more logs have
+        # been added since, wait until the next time this function gets called)
+        reader.truncate_if_consumed()
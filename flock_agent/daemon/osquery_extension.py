@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import logging
+import socket
+import struct
+import threading
+
+# This implements just enough of Thrift's binary protocol to run queries through
+# osqueryd's extension manager socket, without depending on the thrift module. See
+# https://github.com/osquery/osquery/blob/master/osquery/extensions/thrift/osquery.thrift
+
+# Thrift message types
+T_CALL = 1
+T_REPLY = 2
+T_EXCEPTION = 3
+
+# Thrift field types
+T_STOP = 0
+T_BOOL = 2
+T_BYTE = 3
+T_DOUBLE = 4
+T_I16 = 6
+T_I32 = 8
+T_I64 = 10
+T_STRING = 11
+T_STRUCT = 12
+T_MAP = 13
+T_SET = 14
+T_LIST = 15
+
+VERSION_1 = 0x80010000
+
+fixed_formats = {
+    T_BOOL: ">?",
+    T_BYTE: ">b",
+    T_DOUBLE: ">d",
+    T_I16: ">h",
+    T_I32: ">i",
+    T_I64: ">q",
+}
+
+
+class ExtensionSocketError(Exception):
+    """
+    Error communicating with osqueryd's extension socket
+    """
+
+    pass
+
+
+class QueryFailed(Exception):
+    """
+    osqueryd couldn't run the query
+    """
+
+    pass
+
+
+class QueryTimeout(QueryFailed):
+    """
+    osqueryd took too long to run the query
+    """
+
+    pass
+
+
+class QueryAborted(QueryFailed):
+    """
+    The query was aborted from another thread
+    """
+
+    pass
+
+
+def encode_value(ttype, value):
+    """
+    Encode a value of the given Thrift type. Structs are lists of (field_id, type, value)
+    tuples, lists and sets are (element_type, items) tuples, and maps are
+    (key_type, value_type, dict) tuples.
+    """
+    if ttype in fixed_formats:
+        return struct.pack(fixed_formats[ttype], value)
+    if ttype == T_STRING:
+        if isinstance(value, str):
+            value = value.encode()
+        return struct.pack(">i", len(value)) + value
+    if ttype == T_STRUCT:
+        data = b""
+        for field_id, field_type, field_value in value:
+            data += struct.pack(">bh", field_type, field_id)
+            data += encode_value(field_type, field_value)
+        return data + struct.pack(">b", T_STOP)
+    if ttype == T_LIST or ttype == T_SET:
+        element_type, items = value
+        data = struct.pack(">bi", element_type, len(items))
+        for item in items:
+            data += encode_value(element_type, item)
+        return data
+    if ttype == T_MAP:
+        key_type, value_type, items = value
+        data = struct.pack(">bbi", key_type, value_type, len(items))
+        for key in items:
+            data += encode_value(key_type, key)
+            data += encode_value(value_type, items[key])
+        return data
+    raise ValueError(f"unsupported thrift type: {ttype}")
+
+
+def encode_message(name, message_type, seqid, fields):
+    """
+    Encode a whole message, where fields is the arguments (or result) struct
+    """
+    return (
+        struct.pack(">I", VERSION_1 | message_type)
+        + encode_value(T_STRING, name)
+        + struct.pack(">i", seqid)
+        + encode_value(T_STRUCT, fields)
+    )
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if data is None or len(data) != size:
+        raise ExtensionSocketError("connection closed")
+    return data
+
+
+def read_value(f, ttype):
+    """
+    Read a value of the given Thrift type. Structs are returned as dicts that map
+    field ids to values, and strings are decoded as UTF-8.
+    """
+    if ttype in fixed_formats:
+        fmt = fixed_formats[ttype]
+        return struct.unpack(fmt, read_exactly(f, struct.calcsize(fmt)))[0]
+    if ttype == T_STRING:
+        (size,) = struct.unpack(">i", read_exactly(f, 4))
+        return read_exactly(f, size).decode(errors="replace")
+    if ttype == T_STRUCT:
+        fields = {}
+        while True:
+            (field_type,) = struct.unpack(">b", read_exactly(f, 1))
+            if field_type == T_STOP:
+                return fields
+            (field_id,) = struct.unpack(">h", read_exactly(f, 2))
+            fields[field_id] = read_value(f, field_type)
+    if ttype == T_LIST or ttype == T_SET:
+        element_type, size = struct.unpack(">bi", read_exactly(f, 5))
+        return [read_value(f, element_type) for _ in range(size)]
+    if ttype == T_MAP:
+        key_type, value_type, size = struct.unpack(">bbi", read_exactly(f, 6))
+        items = {}
+        for _ in range(size):
+            key = read_value(f, key_type)
+            items[key] = read_value(f, value_type)
+        return items
+    raise ExtensionSocketError(f"unsupported thrift type: {ttype}")
+
+
+def read_message(f):
+    """
+    Read a whole message, and return (name, message_type, seqid, fields)
+    """
+    (version,) = struct.unpack(">I", read_exactly(f, 4))
+    if version & 0xFFFF0000 != VERSION_1:
+        raise ExtensionSocketError("bad thrift protocol version")
+    name = read_value(f, T_STRING)
+    (seqid,) = struct.unpack(">i", read_exactly(f, 4))
+    return name, version & 0xFF, seqid, read_value(f, T_STRUCT)
+
+
+class ExtensionConnection(object):
+    """
+    A single connection to osqueryd's extension manager socket
+    """
+
+    def __init__(self, socket_path, timeout):
+        logger = logging.getLogger("ExtensionConnection.__init__")
+        logger.debug(socket_path)
+
+        self.seqid = 0
+        self.closed = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile("rb")
+
+    def query(self, sql):
+        self.seqid += 1
+        self.sock.sendall(
+            encode_message("query", T_CALL, self.seqid, [(1, T_STRING, sql)])
+        )
+
+        name, message_type, seqid, result = read_message(self.rfile)
+        if seqid != self.seqid:
+            raise ExtensionSocketError("unexpected response")
+        if message_type == T_EXCEPTION:
+            # This is a TApplicationException, where field 1 is the message
+            raise QueryFailed(result.get(1, "unknown error"))
+
+        # Field 0 is the ExtensionResponse
+        response = result.get(0)
+        if response is None:
+            raise QueryFailed("empty response")
+
+        # Field 1 is the ExtensionStatus, and field 2 is the list of rows
+        status = response.get(1, {})
+        if status.get(1, 0) != 0:
+            raise QueryFailed(status.get(2, "unknown error"))
+        return response.get(2, [])
+
+    def abort(self):
+        """
+        Make a query that's blocked reading from the socket in another thread fail
+        right away
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class QueryHandle(object):
+    """
+    Lets another thread abort a query that's running in ExtensionClient.query, like
+    when whoever was waiting for it times out or gets cancelled
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aborted = False
+        self.connection = None
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            if self.connection:
+                self.connection.abort()
+
+    def attach(self, connection):
+        with self.lock:
+            if self.aborted:
+                raise QueryAborted("query aborted")
+            self.connection = connection
+
+    def detach(self):
+        with self.lock:
+            self.connection = None
+
+
+class ExtensionClient(object):
+    """
+    Keeps connections open to osqueryd's extension manager socket, and runs queries
+    over them. This is much faster than starting a new osqueryi process for each
+    query. Each query that runs at the same time gets its own connection, and up to
+    max_idle of them are kept open between queries.
+    """
+
+    def __init__(self, socket_path, timeout=30, max_idle=2):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        # Connections that aren't running a query
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def query(self, sql, handle=None):
+        """
+        Run a query, and return the rows as a list of dicts. Raises QueryFailed if
+        osqueryd couldn't run it (QueryTimeout if it took too long, or QueryAborted if
+        it was aborted with handle), or ExtensionSocketError if osqueryd isn't
+        reachable.
+        """
+        connection = self._get_idle()
+        if connection:
+            try:
+                return self._query(connection, sql, handle)
+            except (OSError, ExtensionSocketError):
+                # The connection might be stale, like if osqueryd restarted, so try
+                # once more with a new connection
+                self._check_aborted(handle)
+
+        try:
+            connection = ExtensionConnection(self.socket_path, self.timeout)
+            return self._query(connection, sql, handle)
+        except (OSError, ExtensionSocketError) as e:
+            self._check_aborted(handle)
+            raise ExtensionSocketError(str(e))
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            connection.close()
+
+    def _query(self, connection, sql, handle):
+        try:
+            if handle:
+                handle.attach(connection)
+            return connection.query(sql)
+        except QueryFailed:
+            # osqueryd answered, so the connection can still be used
+            raise
+        except socket.timeout:
+            connection.close()
+            raise QueryTimeout(f"query timed out after {self.timeout}s")
+        except:
+            connection.close()
+            raise
+        finally:
+            if handle:
+                handle.detach()
+            self._put_idle(connection, handle)
+
+    def _check_aborted(self, handle):
+        if handle and handle.aborted:
+            raise QueryAborted("query aborted")
+
+    def _get_idle(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return None
+
+    def _put_idle(self, connection, handle=None):
+        if connection.closed or (handle and handle.aborted):
+            # The socket might have been shut down just as the query finished
+            connection.close()
+            return
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
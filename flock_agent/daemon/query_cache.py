@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+import time
+
+
+class QueryCache(object):
+    """
+    Caches osquery results for the http server, so opening a twig's details or
+    refreshing the health tab doesn't run a new osqueryi process every time. Each
+    entry has its own TTL, the least recently used entries get evicted when the cache
+    is full, and concurrent requests for the same key share a single query.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+
+        # Maps keys to (expiration time, data), in least recently used order
+        self.entries = collections.OrderedDict()
+
+        # Maps keys to the queries currently running
+        self.in_flight = {}
+
+    async def get(self, key, ttl, fetch):
+        """
+        Return the cached data for key if it hasn't expired. Otherwise await fetch(),
+        a coroutine function that runs the query, and cache its result for ttl seconds.
+        """
+        logger = logging.getLogger("QueryCache.get")
+
+        if key in self.entries:
+            expires, data = self.entries[key]
+            if expires > time.monotonic():
+                logger.debug(f"cache hit: {key}")
+                self.entries.move_to_end(key)
+                return data
+            del self.entries[key]
+
+        if key in self.in_flight:
+            logger.debug(f"waiting for query already in flight: {key}")
+            query = self.in_flight[key]
+        else:
+            logger.debug(f"cache miss: {key}")
+            query = InFlightQuery(asyncio.ensure_future(self._fetch(key, ttl, fetch)))
+            query.task.add_done_callback(lambda task: self.in_flight.pop(key, None))
+            self.in_flight[key] = query
+
+        query.waiters += 1
+        try:
+            return await asyncio.shield(query.task)
+        except asyncio.CancelledError:
+            # If nobody else is waiting for this query, there's no point finishing it
+            if not query.task.done() and query.waiters == 1:
+                query.task.cancel()
+            raise
+        finally:
+            query.waiters -= 1
+
+    async def _fetch(self, key, ttl, fetch):
+        data = await fetch()
+
+        # Don't cache failed queries
+        if data is not None:
+            self.entries[key] = (time.monotonic() + ttl, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return data
+
+    def invalidate(self, key=None):
+        """
+        Forget the cached data for key, or for everything if key is None
+        """
+        logger = logging.getLogger("QueryCache.invalidate")
+        if key is None:
+            logger.debug("invalidating all")
+            self.entries.clear()
+        else:
+            logger.debug(f"invalidating {key}")
+            self.entries.pop(key, None)
+
+
+class InFlightQuery(object):
+    """
+    A query that's running, and how many callers are waiting for its result
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import copy
+import hashlib
+import json
+import logging
+import time
+
+
+class ResultDeduplicator(object):
+    """
+    Most twigs return the same rows almost every time they run. This keeps an index of
+    the content hashes of each twig's last submitted result set, so unchanged results
+    can be replaced with a small heartbeat record instead of being submitted again.
+
+    Snapshot results that are identical to the last ones become a heartbeat.
+    Differential results that add rows the server already has (like when osqueryd's
+    database gets reset and it logs every row as added again) are dropped, with one
+    heartbeat per twig instead. Every resync_interval seconds, each twig's next
+    results are submitted in full anyway.
+
+    The index is stored in the submission queue, and changes to it get saved in the
+    same transaction that queues the results.
+    """
+
+    def __init__(self, common):
+        self.c = common
+
+        # Maps twig names to {"hashes": set of row hashes, "last_full": timestamp}
+        self.result_sets = None
+        self.changed = set()
+
+    def load(self):
+        self.result_sets = {}
+        for name, hashes, last_full in self.c.submission_queue.get_result_sets():
+            self.result_sets[name] = {"hashes": set(hashes), "last_full": last_full}
+        self.changed = set()
+
+    def reset(self):
+        """
+        Forget every result set, so all twigs' next results get submitted in full
+        """
+        self.c.submission_queue.clear_result_sets()
+        self.result_sets = {}
+        self.changed = set()
+
+    def get_changes(self):
+        """
+        Return the result sets that changed since the last call, as a list of
+        (name, hashes, last_full) tuples to save with SubmissionQueue.enqueue_many
+        """
+        changes = [
+            (
+                name,
+                sorted(self.result_sets[name]["hashes"]),
+                self.result_sets[name]["last_full"],
+            )
+            for name in self.changed
+        ]
+        self.changed = set()
+        return changes
+
+    def dedupe(self, logs):
+        """
+        Take a list of osquery result logs, and return the list of logs that should
+        actually be submitted
+        """
+        logger = logging.getLogger("ResultDeduplicator.dedupe")
+        if not self.c.global_settings.get("result_dedupe"):
+            return logs
+        if self.result_sets is None:
+            self.load()
+
+        now = int(time.time())
+        resync_interval = self.c.global_settings.get("result_resync_interval")
+
+        deduped = []
+        suppressed = {}
+        for obj in logs:
+            name = obj["name"]
+            action = obj.get("action")
+            if action not in ["snapshot", "added", "removed"]:
+                deduped.append(obj)
+                continue
+
+            if name not in self.result_sets:
+                self.result_sets[name] = {"hashes": set(), "last_full": now}
+                self.changed.add(name)
+            result_set = self.result_sets[name]
+
+            # Time to submit everything again
+            resync = now - result_set["last_full"] >= resync_interval
+            if resync:
+                logger.info(f"resyncing {name}")
+                result_set["last_full"] = now
+                self.changed.add(name)
+
+            if action == "snapshot":
+                hashes = set(self._hash_row(row) for row in obj.get("snapshot", []))
+                if hashes == result_set["hashes"] and not resync:
+                    deduped.append(self._heartbeat(obj, hashes))
+                else:
+                    result_set["hashes"] = hashes
+                    self.changed.add(name)
+                    deduped.append(obj)
+
+            elif action == "added":
+                row_hash = self._hash_row(obj.get("columns", {}))
+                if row_hash in result_set["hashes"] and not resync:
+                    suppressed[name] = obj
+                else:
+                    result_set["hashes"].add(row_hash)
+                    self.changed.add(name)
+                    deduped.append(obj)
+
+            else:
+                row_hash = self._hash_row(obj.get("columns", {}))
+                result_set["hashes"].discard(row_hash)
+                self.changed.add(name)
+                deduped.append(obj)
+
+        # One heartbeat for each twig whose added rows were all already submitted
+        for name in suppressed:
+            deduped.append(
+                self._heartbeat(suppressed[name], self.result_sets[name]["hashes"])
+            )
+
+        if len(deduped) < len(logs):
+            logger.debug(f"deduplicated {len(logs)} logs into {len(deduped)}")
+        return deduped
+
+    def _hash_row(self, row):
+        return hashlib.sha1(json.dumps(row, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _heartbeat(self, obj, hashes):
+        """
+        A compact record saying the twig's results haven't changed
+        """
+        heartbeat = copy.copy(obj)
+        heartbeat.pop("snapshot", None)
+        heartbeat.pop("columns", None)
+        heartbeat["action"] = "heartbeat"
+        heartbeat["rows"] = len(hashes)
+        heartbeat["hash"] = hashlib.sha1("\n".join(sorted(hashes)).encode()).hexdigest()
+        return heartbeat
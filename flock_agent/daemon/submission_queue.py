@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+class SubmissionQueue(object):
+    """
+    A durable on-disk queue of logs waiting to be submitted to the server, stored in a
+    SQLite database in WAL mode. Each log source ("osquery" or "flock") reads new lines
+    out of its log file and enqueues them, in the same transaction that saves the
+    file's read checkpoint. Then batches get peeked from the front of the queue, and
+    are only deleted once the server acknowledges them.
+
+    Every log in the queue has a sequence number, so a batch is the range of sequence
+    numbers from its first to its last log.
+    """
+
+    def __init__(self, lib_dir):
+        logger = logging.getLogger("SubmissionQueue.__init__")
+        self.filename = os.path.join(lib_dir, "submission_queue.db")
+        logger.info(f"submission queue: {self.filename}")
+
+        # Create the database file only readable by root. SQLite gives its WAL files
+        # the same permissions
+        os.close(os.open(self.filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(self.filename, 0o600)
+
+        # The connection is shared between the http server and the submission thread
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.filename, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS logs ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "source TEXT NOT NULL, "
+            "data TEXT NOT NULL, "
+            "size INTEGER NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS logs_source_seq ON logs (source, seq)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "name TEXT PRIMARY KEY, "
+            "inode INTEGER, "
+            "offset INTEGER NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS result_sets ("
+            "name TEXT PRIMARY KEY, "
+            "hashes TEXT NOT NULL, "
+            "last_full INTEGER NOT NULL)"
+        )
+
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dropped ("
+            "source TEXT PRIMARY KEY, "
+            "count INTEGER NOT NULL)"
+        )
+
+        # Keep track of how many bytes are queued from each source, so enforcing the
+        # disk budgets is cheap
+        self.sizes = dict(
+            self.conn.execute(
+                "SELECT source, SUM(size) FROM logs GROUP BY source"
+            ).fetchall()
+        )
+
+    def enqueue(self, source, items, checkpoint=None, budget=None):
+        """
+        Add a list of logs to the end of the queue. If checkpoint is a
+        (name, inode, offset) tuple, it gets saved in the same transaction, so the
+        logs can't be enqueued twice.
+
+        budget is an optional (max_bytes, sources) tuple. If the logs queued from
+        those sources take up more than max_bytes afterwards, the oldest ones get
+        dropped, from the first source in the list first. This returns a dict that
+        maps sources to how many logs got dropped from them.
+        """
+        return self.enqueue_many({source: items}, checkpoint, budget)
+
+    def enqueue_many(
+        self, items_by_source, checkpoint=None, budget=None, result_sets=None
+    ):
+        """
+        Like enqueue, but for a dict that maps sources to lists of logs, all in one
+        transaction. result_sets is a list of (name, hashes, last_full) tuples from
+        ResultDeduplicator.get_changes() to save in the same transaction.
+        """
+        logger = logging.getLogger("SubmissionQueue.enqueue_many")
+        rows = []
+        sizes = {}
+        for source in items_by_source:
+            sizes[source] = 0
+            for item in items_by_source[source]:
+                data = json.dumps(item)
+                rows.append((source, data, len(data)))
+                sizes[source] += len(data)
+
+        with self.lock:
+            with self._transaction():
+                self.conn.executemany(
+                    "INSERT INTO logs (source, data, size) VALUES (?, ?, ?)", rows
+                )
+                if checkpoint:
+                    self._set_checkpoint(*checkpoint)
+                if result_sets:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO result_sets (name, hashes, last_full) "
+                        "VALUES (?, ?, ?)",
+                        [
+                            (name, json.dumps(hashes), last_full)
+                            for name, hashes, last_full in result_sets
+                        ],
+                    )
+            for source in sizes:
+                self.sizes[source] = self.sizes.get(source, 0) + sizes[source]
+
+            dropped = {}
+            if budget:
+                max_bytes, sources = budget
+                dropped = self._evict(max_bytes, sources)
+                if dropped:
+                    logger.warning(f"disk budget is full, dropped logs: {dropped}")
+            return dropped
+
+    def peek(self, source, max_items=None, max_bytes=None, after_seq=None):
+        """
+        Return a batch of the oldest logs from source, up to max_items logs or
+        max_bytes of serialized logs (but always at least one log), or None if there
+        aren't any. They stay in the queue until they're acknowledged. To peek the
+        batch after one that's still unacknowledged, pass its last_seq as after_seq.
+        """
+        query = "SELECT seq, data, size FROM logs WHERE source = ? AND seq > ?"
+        query += " ORDER BY seq"
+        args = (source, after_seq or 0)
+        if max_items:
+            query += " LIMIT ?"
+            args += (max_items,)
+
+        rows = []
+        size = 0
+        with self.lock:
+            cursor = self.conn.execute(query, args)
+            for row in cursor:
+                if rows and max_bytes and size + row[2] > max_bytes:
+                    break
+                rows.append(row)
+                size += row[2]
+            cursor.close()
+        if not rows:
+            return None
+        return Batch(
+            source, rows[0][0], rows[-1][0], [json.loads(r[1]) for r in rows], size
+        )
+
+    def ack(self, batch):
+        """
+        The server accepted this batch, so delete it from the queue
+        """
+        with self.lock:
+            with self._transaction():
+                (size,) = self.conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM logs "
+                    "WHERE source = ? AND seq BETWEEN ? AND ?",
+                    (batch.source, batch.first_seq, batch.last_seq),
+                ).fetchone()
+                self.conn.execute(
+                    "DELETE FROM logs WHERE source = ? AND seq BETWEEN ? AND ?",
+                    (batch.source, batch.first_seq, batch.last_seq),
+                )
+            self.sizes[batch.source] -= size
+
+    def depth(self, source):
+        """
+        How many logs from source are waiting to be submitted
+        """
+        with self.lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM logs WHERE source = ?", (source,)
+            ).fetchone()
+        return count
+
+    def depths(self):
+        """
+        Return a dict that maps each source with logs waiting to be submitted to how
+        many there are
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT source, COUNT(*) FROM logs GROUP BY source"
+            ).fetchall()
+        return dict(rows)
+
+    def get_dropped(self):
+        """
+        Return a dict that maps sources to how many of their logs were ever dropped
+        to stay within the disk budgets
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT source, count FROM dropped").fetchall()
+        return dict(rows)
+
+    def get_checkpoint(self, name):
+        """
+        Return the (inode, offset) checkpoint of a log file, or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT inode, offset FROM checkpoints WHERE name = ?", (name,)
+            ).fetchone()
+        return row
+
+    def set_checkpoint(self, name, inode, offset):
+        with self.lock:
+            self._set_checkpoint(name, inode, offset)
+
+    def clear_result_sets(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM result_sets")
+
+    def get_result_sets(self):
+        """
+        Return the saved result set hashes, as a list of (name, hashes, last_full)
+        tuples
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT name, hashes, last_full FROM result_sets"
+            ).fetchall()
+        return [
+            (name, json.loads(hashes), last_full) for name, hashes, last_full in rows
+        ]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _set_checkpoint(self, name, inode, offset):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO checkpoints (name, inode, offset) VALUES (?, ?, ?)",
+            (name, inode, offset),
+        )
+
+    def _evict(self, max_bytes, sources):
+        """
+        Drop the oldest logs from sources, in order, until they fit in max_bytes, and
+        return a dict that maps sources to how many logs were dropped
+        """
+        dropped = {}
+        excess = sum(self.sizes.get(source, 0) for source in sources) - max_bytes
+        for source in sources:
+            if excess <= 0:
+                break
+            if not self.sizes.get(source):
+                continue
+            count, size = self._drop_oldest(source, excess)
+            dropped[source] = count
+            excess -= size
+        return dropped
+
+    def _drop_oldest(self, source, size):
+        """
+        Delete the oldest logs from source, at least size bytes of them (or all of
+        them), and return how many logs and bytes were deleted
+        """
+        dropped = 0
+        dropped_size = 0
+        with self._transaction():
+            cursor = self.conn.execute(
+                "SELECT seq, size FROM logs WHERE source = ? ORDER BY seq", (source,)
+            )
+            for seq, row_size in cursor:
+                if dropped_size >= size:
+                    break
+                dropped += 1
+                dropped_size += row_size
+                last_seq = seq
+            cursor.close()
+            if dropped:
+                self.conn.execute(
+                    "DELETE FROM logs WHERE source = ? AND seq <= ?", (source, last_seq)
+                )
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO dropped (source, count) VALUES (?, 0)",
+                    (source,),
+                )
+                self.conn.execute(
+                    "UPDATE dropped SET count = count + ? WHERE source = ?",
+                    (dropped, source),
+                )
+        self.sizes[source] -= dropped_size
+        return dropped, dropped_size
+
+    def _transaction(self):
+        return Transaction(self.conn)
+
+
+class Batch(object):
+    """
+    A batch of logs peeked from the front of the queue
+    """
+
+    def __init__(self, source, first_seq, last_seq, items, size):
+        self.source = source
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        self.items = items
+        self.size = size  # Serialized size in bytes
+
+
+class Transaction(object):
+    """
+    Context manager that wraps a block in a SQLite transaction
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.conn.execute("ROLLBACK")
+        else:
+            self.conn.execute("COMMIT")
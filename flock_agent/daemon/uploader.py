@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import logging
+import time
+
+from .api_client import PayloadTooLarge
+
+
+class Uploader(object):
+    """
+    Submits logs from the submission queue to the server. Batches
+    are sized by serialized bytes rather than by number of logs, and the size adapts
+    to the server: it doubles while requests finish well within the target time, and
+    halves when they're slow, fail, or get rejected as too large.
+
+    Several batches are in flight at once over the pooled connections, but they're
+    acknowledged in order. The number in flight grows by one for each window of
+    batches the server accepts, and halves when requests fail.
+    """
+
+    def __init__(self, common):
+        self.c = common
+
+        # Start small and grow from there, once the settings are loaded
+        self.batch_bytes = None
+        self.window = 1.0
+
+        # Submissions run in this thread pool, created when it's first needed
+        self.executor = None
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+
+    def upload(self, source, submit, max_batches=None):
+        """
+        Generator that submits batches queued from source with the submit function
+        (like FlockApiClient.submit) until there are none left, or max_batches have
+        been submitted, and yields each batch after the server has accepted it.
+        Exceptions from submit are raised once the batches that are in flight have
+        finished. The failed batch and every batch after it stay in the queue, even
+        if the server accepted them, so batches are only ever acknowledged in order.
+        """
+        logger = logging.getLogger("Uploader.upload")
+        submission_queue = self.c.submission_queue
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.c.global_settings.get("gateway_pool_size")
+            )
+
+        in_flight = collections.deque()
+        sent = 0
+        max_items = None
+        last_seq = None
+        stopped = False
+        error = None
+
+        while True:
+            # Keep the window full
+            while not stopped and len(in_flight) < self.get_window():
+                if max_batches and sent >= max_batches:
+                    break
+                batch = submission_queue.peek(
+                    source,
+                    max_items=max_items,
+                    max_bytes=self.get_batch_bytes(),
+                    after_seq=last_seq,
+                )
+                if not batch:
+                    break
+                sent += 1
+                last_seq = batch.last_seq
+                in_flight.append(
+                    (batch, self.executor.submit(self._submit, submit, batch))
+                )
+
+            if not in_flight:
+                if error:
+                    raise error
+                if not stopped:
+                    break
+
+                # A batch was too large, so start again from the front of the queue
+                stopped = False
+                last_seq = None
+                continue
+
+            # Wait for the oldest batch, so batches are acknowledged in order
+            batch, future = in_flight.popleft()
+            try:
+                elapsed = future.result()
+            except PayloadTooLarge:
+                if stopped:
+                    # It gets submitted again, after the earlier batch
+                    continue
+                if len(batch.items) == 1:
+                    # The server will never accept this log, so don't let it block
+                    # everything else in the queue
+                    logger.warning(
+                        f"dropping {batch.size} byte log, too large to submit"
+                    )
+                    submission_queue.ack(batch)
+                elif batch.size > self.c.global_settings.get(
+                    "submission_batch_min_bytes"
+                ):
+                    logger.info(f"{batch.size} byte batch is too large for the server")
+                    self.batch_bytes = min(self.get_batch_bytes(), batch.size // 2)
+                else:
+                    # Batches can't get any smaller in bytes, so split them by the
+                    # number of logs instead, until it's down to one
+                    logger.info(f"{len(batch.items)} logs are too large for the server")
+                    max_items = len(batch.items) // 2
+                stopped = True
+                continue
+            except Exception as e:
+                if not error:
+                    self.batch_bytes //= 2
+                    self.window = max(1.0, self.window / 2)
+                    error = e
+                stopped = True
+                continue
+
+            if stopped:
+                # An earlier batch wasn't accepted, so this one stays in the queue too,
+                # to keep acknowledgements in order. It gets submitted again later
+                continue
+
+            submission_queue.ack(batch)
+            self.adjust(batch, elapsed)
+            self.window = min(self.get_max_window(), self.window + 1 / int(self.window))
+            yield batch
+
+    def get_max_window(self):
+        # Each batch in flight uses a connection from the API client's pool
+        return min(
+            self.c.global_settings.get("submission_max_in_flight"),
+            self.c.global_settings.get("gateway_pool_size"),
+        )
+
+    def get_window(self):
+        """
+        How many batches can be in flight right now
+        """
+        return max(1, min(self.get_max_window(), int(self.window)))
+
+    def get_batch_bytes(self):
+        """
+        The current batch size, within the bounds in the settings
+        """
+        min_bytes = self.c.global_settings.get("submission_batch_min_bytes")
+        max_bytes = self.c.global_settings.get("submission_batch_max_bytes")
+        if self.batch_bytes is None:
+            self.batch_bytes = 4 * min_bytes
+        self.batch_bytes = max(min_bytes, min(max_bytes, self.batch_bytes))
+        return self.batch_bytes
+
+    def adjust(self, batch, elapsed):
+        """
+        Resize batches based on how long the server took to accept this one
+        """
+        logger = logging.getLogger("Uploader.adjust")
+        target = self.c.global_settings.get("submission_batch_target_seconds")
+
+        if elapsed > target:
+            self.batch_bytes //= 2
+        elif elapsed < target / 2 and batch.size >= self.batch_bytes // 2:
+            # Only grow if this batch was big enough to say something about the link
+            self.batch_bytes *= 2
+        else:
+            return
+        logger.debug(
+            f"{batch.source}: {batch.size} bytes took {elapsed:.2f}s, "
+            f"batch size is now {self.get_batch_bytes()} bytes"
+        )
+
+    def _submit(self, submit, batch):
+        """
+        Submit a batch, and return how long it took
+        """
+        start = time.monotonic()
+        submit(batch.items)
+        return time.monotonic() - start
@@ -47,10 +47,8 @@ def main(common):
         onboarding.go()
     else:
         # Show or hide main window?
-        if (
-            common.daemon.get("use_server")
-            and len(common.daemon.get_undecided_twig_ids()) == 0
-        ):
+        twigs_state = common.daemon.get_twigs_state()
+        if twigs_state["use_server"] and len(twigs_state["undecided_twig_ids"]) == 0:
             main_window.hide()
         else:
             main_window.show()
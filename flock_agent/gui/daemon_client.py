@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import aiohttp
 import json
 import logging
 import requests
@@ -22,19 +23,32 @@ class UnknownErrorException(Exception):
     pass
 
 
+def get_unix_socket_path():
+    if Platform.current() == Platform.MACOS:
+        return "/usr/local/var/lib/flock-agent/socket"
+    else:
+        return "/var/lib/flock-agent/socket"
+
+
 class DaemonClient:
     """
-    The client that communicates with the daemon's server
+    The client that communicates with the daemon's server. Requests to every path
+    share a small pool of keep-alive connections to the daemon's socket.
     """
 
     def __init__(self, common):
         self.c = common
 
         self.session = requests_unixsocket.Session()
-        if Platform.current() == Platform.MACOS:
-            self.unix_socket_path = "/usr/local/var/lib/flock-agent/socket"
-        else:
-            self.unix_socket_path = "/var/lib/flock-agent/socket"
+        self.unix_socket_path = get_unix_socket_path()
+
+        # /events stays open in a background thread, so it gets its own session
+        self.events_session = requests_unixsocket.Session()
+        self.events_response = None
+
+        # The last response from /twigs_state, and its ETag
+        self.twigs_state = None
+        self.twigs_state_etag = None
 
     def ping(self):
         self._http_get("/ping")
@@ -80,6 +94,28 @@ class DaemonClient:
         res = self._http_get("/twig_enabled_statuses")
         return res["data"]
 
+    def get_twigs_state(self):
+        """
+        Returns a dict with every twig's metadata and enabled status, the lists of
+        undecided, decided, and enabled twig ids, and use_server. It's cached, and only
+        downloaded again if it changed in the daemon.
+        """
+        logger = logging.getLogger("DaemonClient.get_twigs_state")
+
+        headers = {}
+        if self.twigs_state_etag:
+            headers["If-None-Match"] = self.twigs_state_etag
+        r = self._send("get", "/twigs_state", headers=headers)
+        if r.status_code == 304:
+            logger.debug("not modified")
+            return self.twigs_state
+        if r.status_code != 200:
+            raise UnknownErrorException
+
+        self.twigs_state = json.loads(r.text)["data"]
+        self.twigs_state_etag = r.headers.get("ETag")
+        return self.twigs_state
+
     def update_twig_status(self, twig_status):
         res = self._http_post("/update_twig_status", twig_status)
         return res["data"]
@@ -88,6 +124,78 @@ class DaemonClient:
         res = self._http_get("/exec_health/{}".format(health_item_name))
         return res["data"]
 
+    def exec_health_batch(self):
+        """
+        Run all of the health item queries, and yield (health_item_name, data) tuples
+        as the daemon streams back each result. If a query failed, its data is None.
+        """
+        logger = logging.getLogger("DaemonClient.exec_health_batch")
+        for obj in self._http_get_lines("/exec_health_batch"):
+            if obj.get("error"):
+                logger.warning(f"Error: {obj['name']}: {obj['error']}")
+            yield obj["name"], obj["data"]
+
+    def invalidate_cache(self):
+        """
+        Make the daemon forget cached twig and health item query results
+        """
+        res = self._http_post("/invalidate_cache")
+        return res["data"]
+
+    def get_submission_queue_depth(self):
+        """
+        Returns a dict that maps each submission lane to how many logs are waiting in it
+        """
+        res = self._http_get("/submission_queue_depth")
+        return res["data"]
+
+    def get_submission_queue_dropped(self):
+        """
+        Returns a dict that maps submission lanes to how many logs were dropped from
+        them to stay within the disk budgets
+        """
+        res = self._http_get("/submission_queue_dropped")
+        return res["data"]
+
+    def events(self):
+        """
+        Subscribe to the daemon's events, and yield (event_type, data) tuples as they
+        come in. This blocks until the daemon closes the connection, so it should run
+        in its own thread.
+        """
+        r = self._send("get", "/events", stream=True, session=self.events_session)
+        if r.status_code != 200:
+            raise UnknownErrorException
+        self.events_response = r
+
+        # Parse the server-sent events
+        event_type = None
+        data_lines = []
+        with r:
+            for line in r.iter_lines(decode_unicode=True):
+                if line:
+                    if line.startswith(":"):
+                        # Heartbeat
+                        continue
+                    field, _, value = line.partition(":")
+                    value = value[1:] if value.startswith(" ") else value
+                    if field == "event":
+                        event_type = value
+                    elif field == "data":
+                        data_lines.append(value)
+                elif event_type:
+                    yield event_type, json.loads("\n".join(data_lines))
+                    event_type = None
+                    data_lines = []
+
+    def close_events(self):
+        """
+        Close the connection to /events, so events() stops
+        """
+        if self.events_response:
+            self.events_response.close()
+            self.events_response = None
+
     def register_server(self, server_url, name):
         res = self._http_post(
             "/register_server", {"server_url": server_url, "name": name}
@@ -104,19 +212,47 @@ class DaemonClient:
     def _http_post(self, path, data=None):
         return self._http_request("post", path, data)
 
+    def _http_get_lines(self, path):
+        """
+        Make a get request, and yield each line of the streamed response as an object
+        """
+        logger = logging.getLogger("DaemonClient._http_get_lines")
+        logger.info(f"get {path}")
+
+        r = self._send("get", path, stream=True)
+        if r.status_code != 200:
+            raise UnknownErrorException
+
+        with r:
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def _http_request(self, method, path, data=None):
         logger = logging.getLogger("DaemonClient._http_request")
-        url = "http+unix://{}{}".format(self.unix_socket_path.replace("/", "%2F"), path)
         if data:
             logger.info(f"{method} {path} {data}")
         else:
             logger.info(f"{method} {path}")
 
+        r = self._send(method, path, data)
+        if r.status_code == 200:
+            obj = json.loads(r.text)
+            if obj["error"]:
+                logger.warning(f"Error: {obj['error']}'")
+            return obj
+
+        raise UnknownErrorException
+
+    def _send(self, method, path, data=None, stream=False, headers=None, session=None):
+        url = "http+unix://{}{}".format(self.unix_socket_path.replace("/", "%2F"), path)
+        if not session:
+            session = self.session
         try:
             if method == "get":
-                r = self.session.get(url)
+                return session.get(url, stream=stream, headers=headers)
             else:
-                r = self.session.post(url, json=data)
+                return session.post(url, json=data, stream=stream, headers=headers)
         except requests.exceptions.ConnectionError as e:
             exception_type = type(e.args[0].args[1])
             if (
@@ -129,10 +265,129 @@ class DaemonClient:
             else:
                 raise UnknownErrorException
 
-        if r.status_code == 200:
-            obj = json.loads(r.text)
-            if obj["error"]:
-                logger.warning(f"Error: {obj['error']}'")
-            return obj
 
-        raise UnknownErrorException
+class AsyncDaemonClient:
+    """
+    An asyncio version of DaemonClient, for code that runs in an event loop. Up to
+    limit requests can be in flight at once, each over one of the keep-alive
+    connections to the daemon's socket.
+    """
+
+    def __init__(self, common, limit=4):
+        self.c = common
+        self.limit = limit
+        self.unix_socket_path = get_unix_socket_path()
+
+        # Created in the event loop, when it's first needed
+        self.session = None
+
+        # The last response from /twigs_state, and its ETag
+        self.twigs_state = None
+        self.twigs_state_etag = None
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def ping(self):
+        await self._http_get("/ping")
+
+    async def get(self, key):
+        res = await self._http_get("/setting/{}".format(key))
+        return res["data"]
+
+    async def set(self, key, val):
+        res = await self._http_post("/setting/{}".format(key), val)
+        return res["data"]
+
+    async def exec_twig(self, twig_id):
+        res = await self._http_get("/exec_twig/{}".format(twig_id))
+        return res["data"]
+
+    async def exec_health(self, health_item_name):
+        res = await self._http_get("/exec_health/{}".format(health_item_name))
+        return res["data"]
+
+    async def invalidate_cache(self):
+        res = await self._http_post("/invalidate_cache")
+        return res["data"]
+
+    async def get_twigs_state(self):
+        """
+        Like DaemonClient.get_twigs_state
+        """
+        headers = {}
+        if self.twigs_state_etag:
+            headers["If-None-Match"] = self.twigs_state_etag
+
+        async with self._send("get", "/twigs_state", headers=headers) as r:
+            if r.status == 304:
+                return self.twigs_state
+            if r.status != 200:
+                raise UnknownErrorException
+            obj = await r.json()
+
+        self.twigs_state = obj["data"]
+        self.twigs_state_etag = r.headers.get("ETag")
+        return self.twigs_state
+
+    async def _http_get(self, path):
+        return await self._http_request("get", path)
+
+    async def _http_post(self, path, data=None):
+        return await self._http_request("post", path, data)
+
+    async def _http_request(self, method, path, data=None):
+        logger = logging.getLogger("AsyncDaemonClient._http_request")
+        if data:
+            logger.info(f"{method} {path} {data}")
+        else:
+            logger.info(f"{method} {path}")
+
+        async with self._send(method, path, data) as r:
+            if r.status != 200:
+                raise UnknownErrorException
+            obj = await r.json()
+
+        if obj["error"]:
+            logger.warning(f"Error: {obj['error']}'")
+        return obj
+
+    def _send(self, method, path, data=None, headers=None):
+        if not self.session:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(
+                    path=self.unix_socket_path, limit=self.limit
+                )
+            )
+        url = f"http://localhost{path}"
+        if method == "get":
+            request = self.session.get(url, headers=headers)
+        else:
+            request = self.session.post(url, json=data, headers=headers)
+        return AsyncDaemonRequest(request)
+
+
+class AsyncDaemonRequest:
+    """
+    Context manager for an aiohttp request to the daemon, that raises the same
+    exceptions as DaemonClient when it can't connect
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    async def __aenter__(self):
+        try:
+            return await self.request.__aenter__()
+        except aiohttp.ClientConnectorError as e:
+            if isinstance(e.os_error, (FileNotFoundError, ConnectionRefusedError)):
+                raise DaemonNotRunningException
+            elif isinstance(e.os_error, PermissionError):
+                raise PermissionDeniedException
+            else:
+                raise UnknownErrorException
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await self.request.__aexit__(exc_type, exc_value, traceback)
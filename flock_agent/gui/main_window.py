@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+import threading
 
 from PyQt5 import QtCore, QtWidgets, QtGui
 
@@ -78,6 +79,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.update_ui()
         self.hide()
 
+        # Update the UI as soon as anything changes in the daemon
+        self.events_thread = DaemonEventsThread(self.c)
+        self.events_thread.connected.connect(self.daemon_connected)
+        self.events_thread.setting_changed.connect(self.daemon_setting_changed)
+        self.events_thread.twigs_changed.connect(self.daemon_twigs_changed)
+        self.events_thread.health_changed.connect(self.daemon_health_changed)
+        self.events_thread.server_registered.connect(self.settings_tab.update_ui)
+        self.events_thread.submission_error.connect(self.daemon_submission_error)
+        self.events_thread.start()
+
     def closeEvent(self, e):
         """
         Intercept close event, and instead minimize to systray
@@ -110,15 +121,16 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Only show data or opt-in tabs if using a server
         try:
-            if self.c.daemon.get("use_server"):
-                data_tab_should_show = len(self.c.daemon.get_decided_twig_ids()) > 0
+            twigs_state = self.c.daemon.get_twigs_state()
+            if twigs_state["use_server"]:
+                data_tab_should_show = len(twigs_state["decided_twig_ids"]) > 0
                 if data_tab_should_show:
                     # In macOS, Data tab index is 1 because Health is always 0, but in Linux it's 0
                     if Platform.current() == Platform.MACOS:
                         self.tabs.insertTab(1, self.data_tab, "Data")
                     else:
                         self.tabs.insertTab(0, self.data_tab, "Data")
-                opt_in_tab_should_show = len(self.c.daemon.get_undecided_twig_ids()) > 0
+                opt_in_tab_should_show = len(twigs_state["undecided_twig_ids"]) > 0
                 if opt_in_tab_should_show:
                     self.tabs.insertTab(0, self.opt_in_tab, "Opt-In")
         except DaemonNotRunningException:
@@ -154,6 +166,43 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 self.tabs.setCurrentIndex(0)
 
+    def refresh_ui(self):
+        """
+        Update the UI, but stay on the same tab if it's still there
+        """
+        current_tab = self.tabs.currentWidget()
+        self.update_ui()
+        index = self.tabs.indexOf(current_tab)
+        if index != -1:
+            self.tabs.setCurrentIndex(index)
+
+    def daemon_connected(self, reconnected):
+        # Events might have been missed while disconnected
+        if reconnected:
+            self.refresh_ui()
+
+    def daemon_setting_changed(self, key):
+        if key == "use_server":
+            self.refresh_ui()
+        else:
+            self.settings_tab.update_ui()
+
+    def daemon_twigs_changed(self, twig_version):
+        # Skip it if the UI is already showing this version, like when the change was
+        # made from this window
+        twigs_state = self.c.daemon.twigs_state
+        if twigs_state and twigs_state["twig_version"] == twig_version:
+            return
+        self.refresh_ui()
+
+    def daemon_health_changed(self, health_item_name, data):
+        if Platform.current() == Platform.MACOS:
+            self.health_tab.query_finished(health_item_name, data)
+
+    def daemon_submission_error(self, source, error):
+        logger = logging.getLogger("MainWindow.daemon_submission_error")
+        logger.warning(f"daemon failed to submit {source} logs: {error}")
+
     def update_ui_settings(self):
         self.update_ui("settings")
 
@@ -182,3 +231,63 @@ class MainWindow(QtWidgets.QMainWindow):
     def shutdown(self):
         logger = logging.getLogger("MainWindow.shutdown")
         logger.debug("")
+        self.events_thread.stop()
+
+
+class DaemonEventsThread(QtCore.QThread):
+    """
+    Listen for events from the daemon, and reconnect if the connection drops
+    """
+
+    connected = QtCore.pyqtSignal(bool)
+    setting_changed = QtCore.pyqtSignal(str)
+    twigs_changed = QtCore.pyqtSignal(int)
+    health_changed = QtCore.pyqtSignal(str, list)
+    server_registered = QtCore.pyqtSignal()
+    submission_error = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, common):
+        super(DaemonEventsThread, self).__init__()
+        self.c = common
+        self.stopping = threading.Event()
+
+        # Seconds to wait before reconnecting
+        self.reconnect_delay = 5
+
+    def stop(self):
+        # Wakes the thread up if it's waiting to reconnect, or disconnects it if it's
+        # listening for events
+        self.stopping.set()
+        self.c.daemon.close_events()
+        self.wait()
+
+    def run(self):
+        logger = logging.getLogger("DaemonEventsThread.run")
+        reconnected = False
+        while not self.stopping.is_set():
+            try:
+                for event_type, data in self.c.daemon.events():
+                    if self.stopping.is_set():
+                        # It was stopped while connecting, so close_events() missed
+                        # this connection
+                        break
+                    if event_type == "connected":
+                        self.connected.emit(reconnected)
+                    elif event_type == "setting_changed":
+                        self.setting_changed.emit(data["key"])
+                    elif event_type == "twigs_changed":
+                        self.twigs_changed.emit(data["twig_version"])
+                    elif event_type == "health_changed":
+                        self.health_changed.emit(data["name"], data["data"])
+                    elif event_type == "server_registered":
+                        self.server_registered.emit()
+                    elif event_type == "submission_error":
+                        self.submission_error.emit(data["source"], data["error"])
+            except Exception as e:
+                if not self.stopping.is_set():
+                    logger.debug(f"lost connection to daemon: {type(e).__name__}")
+
+            # The GUI already handles the daemon not running when it makes requests,
+            # so just keep trying to reconnect
+            reconnected = True
+            self.stopping.wait(self.reconnect_delay)
@@ -1,16 +1,14 @@
 # From https://github.com/msabramo/requests-unixsocket
 # Apache License 2.0
+#
+# Changed so connection pools are keyed by socket path instead of by URL, and to
+# work with newer versions of requests and urllib3
 
 import socket
 
 from requests.adapters import HTTPAdapter
 from requests.compat import urlparse, unquote
 
-try:
-    import http.client as httplib
-except ImportError:
-    import httplib
-
 try:
     from requests.packages import urllib3
 except ImportError:
@@ -19,45 +17,49 @@ except ImportError:
 
 # The following was adapted from some code from docker-py
 # https://github.com/docker/docker-py/blob/master/docker/transport/unixconn.py
-class UnixHTTPConnection(httplib.HTTPConnection, object):
-    def __init__(self, unix_socket_url, timeout=60):
+class UnixHTTPConnection(urllib3.connection.HTTPConnection, object):
+    def __init__(self, socket_path, timeout=60):
         """Create an HTTP connection to a unix domain socket
 
-        :param unix_socket_url: A URL with a scheme of 'http+unix' and the
-        netloc is a percent-encoded path to a unix domain socket. E.g.:
-        'http+unix://%2Ftmp%2Fprofilesvc.sock/status/pid'
+        :param socket_path: The path to a unix domain socket, like
+        '/tmp/profilesvc.sock'
         """
         super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
-        self.unix_socket_url = unix_socket_url
-        self.timeout = timeout
-        self.sock = None
-
-    def __del__(self):  # base class does not have d'tor
-        if self.sock:
-            self.sock.close()
+        self.socket_path = socket_path
 
-    def connect(self):
+    def _new_conn(self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.settimeout(self.timeout)
-        socket_path = unquote(urlparse(self.unix_socket_url).netloc)
-        sock.connect(socket_path)
-        self.sock = sock
+        try:
+            sock.connect(self.socket_path)
+        except:
+            sock.close()
+            raise
+        return sock
 
 
 class UnixHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
-    def __init__(self, socket_path, timeout=60):
-        super(UnixHTTPConnectionPool, self).__init__("localhost", timeout=timeout)
+    def __init__(self, socket_path, timeout=60, maxsize=1):
+        super(UnixHTTPConnectionPool, self).__init__(
+            "localhost", timeout=timeout, maxsize=maxsize
+        )
         self.socket_path = socket_path
-        self.timeout = timeout
 
     def _new_conn(self):
-        return UnixHTTPConnection(self.socket_path, self.timeout)
+        self.num_connections += 1
+        return UnixHTTPConnection(self.socket_path, self.timeout.connect_timeout)
 
 
 class UnixAdapter(HTTPAdapter):
-    def __init__(self, timeout=60, pool_connections=25, *args, **kwargs):
+    """
+    Keeps one small pool of keep-alive connections for each socket path, which get
+    reused for requests to every path on that socket
+    """
+
+    def __init__(self, timeout=60, pool_connections=4, pool_maxsize=4, *args, **kwargs):
         super(UnixAdapter, self).__init__(*args, **kwargs)
         self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
         self.pools = urllib3._collections.RecentlyUsedContainer(
             pool_connections, dispose_func=lambda p: p.close()
         )
@@ -71,16 +73,22 @@ class UnixAdapter(HTTPAdapter):
                 "%s does not support specifying proxies" % self.__class__.__name__
             )
 
+        # The netloc is the percent-encoded path to the socket
+        socket_path = unquote(urlparse(url).netloc)
         with self.pools.lock:
-            pool = self.pools.get(url)
+            pool = self.pools.get(socket_path)
             if pool:
                 return pool
 
-            pool = UnixHTTPConnectionPool(url, self.timeout)
-            self.pools[url] = pool
+            pool = UnixHTTPConnectionPool(socket_path, self.timeout, self.pool_maxsize)
+            self.pools[socket_path] = pool
 
         return pool
 
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        # Newer versions of requests call this instead of get_connection
+        return self.get_connection(request.url, proxies)
+
     def request_url(self, request, proxies):
         return request.path_url
 
@@ -3,6 +3,7 @@ import logging
 
 from PyQt5 import QtCore, QtWidgets, QtGui
 
+from ..daemon_client import DaemonNotRunningException, PermissionDeniedException
 from ...health import health_items
 from ...common import Platform
 
@@ -20,17 +21,22 @@ class HealthTab(QtWidgets.QWidget):
         logger.debug("")
 
         # Health item widgets
-        self.health_item_widgets = []
+        self.health_item_widgets = {}
         for health_item in health_items[Platform.current()]:
-            self.health_item_widgets.append(HealthItemWidget(self.c, health_item))
+            self.health_item_widgets[health_item["name"]] = HealthItemWidget(
+                self.c, health_item
+            )
 
         health_item_layout = QtWidgets.QVBoxLayout()
-        for widget in self.health_item_widgets:
+        for widget in self.health_item_widgets.values():
             health_item_layout.addWidget(widget)
 
+        # Thread starts out as None
+        self.t = None
+
         # Buttons
         refresh_button = QtWidgets.QPushButton("Refresh Health Check")
-        refresh_button.clicked.connect(self.refresh)
+        refresh_button.clicked.connect(self.clicked_refresh_button)
 
         buttons_layout = QtWidgets.QHBoxLayout()
         buttons_layout.addStretch()
@@ -51,11 +57,42 @@ class HealthTab(QtWidgets.QWidget):
         # Refresh them all
         self.refresh()
 
+    def clicked_refresh_button(self):
+        # The daemon caches health check results, but if the user asks for a refresh
+        # they should be up-to-date
+        try:
+            self.c.daemon.invalidate_cache()
+        except DaemonNotRunningException:
+            self.c.gui.daemon_not_running()
+            return
+        except PermissionDeniedException:
+            self.c.gui.daemon_permission_denied()
+            return
+
+        self.refresh()
+
     def refresh(self):
         logger = logging.getLogger("HealthTab.refresh")
         logger.debug("")
-        for widget in self.health_item_widgets:
-            widget.refresh()
+
+        # If a refresh is already running, let it finish
+        if self.t and self.t.isRunning():
+            logger.debug("already refreshing")
+            return
+
+        for widget in self.health_item_widgets.values():
+            widget.loading()
+
+        # Run all of the osquery commands in a single separate thread
+        self.t = HealthOsqueryThread(self.c)
+        self.t.query_finished.connect(self.query_finished)
+        self.t.daemon_not_running.connect(self.c.gui.daemon_not_running)
+        self.t.daemon_permission_denied.connect(self.c.gui.daemon_permission_denied)
+        self.t.start()
+
+    def query_finished(self, health_item_name, data):
+        if health_item_name in self.health_item_widgets:
+            self.health_item_widgets[health_item_name].query_finished(data)
 
 
 class HealthItemWidget(QtWidgets.QWidget):
@@ -99,19 +136,11 @@ class HealthItemWidget(QtWidgets.QWidget):
         layout.addStretch()
         self.setLayout(layout)
 
-        # Thread starts out as None
-        self.t = None
-
-    def refresh(self):
+    def loading(self):
         self.good_image.hide()
         self.bad_image.hide()
         self.label.setText(f"Loading: {self.health_item['name']} ...")
 
-        # Run the osquery command in a separate thread
-        self.t = HealthOsqueryThread(self.c, self.health_item["name"])
-        self.t.query_finished.connect(self.query_finished)
-        self.t.start()
-
     def query_finished(self, data):
         if self.health_item["query_finished"](data):
             self.is_good()
@@ -140,18 +169,24 @@ class HealthItemWidget(QtWidgets.QWidget):
 
 class HealthOsqueryThread(QtCore.QThread):
     """
-    Run the osquery command
+    Run all of the health item osquery commands
     """
 
-    query_finished = QtCore.pyqtSignal(list)
+    query_finished = QtCore.pyqtSignal(str, list)
+    daemon_not_running = QtCore.pyqtSignal()
+    daemon_permission_denied = QtCore.pyqtSignal()
 
-    def __init__(self, common, name):
+    def __init__(self, common):
         super(HealthOsqueryThread, self).__init__()
         self.c = common
-        self.name = name
 
     def run(self):
-        data = self.c.daemon.exec_health(self.name)
-        if not data:
-            data = []
-        self.query_finished.emit(data)
+        try:
+            for name, data in self.c.daemon.exec_health_batch():
+                if not data:
+                    data = []
+                self.query_finished.emit(name, data)
+        except DaemonNotRunningException:
+            self.daemon_not_running.emit()
+        except PermissionDeniedException:
+            self.daemon_permission_denied.emit()
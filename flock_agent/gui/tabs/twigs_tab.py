@@ -99,11 +99,7 @@ class TwigsTab(QtWidgets.QWidget):
 
         # Get list of twig ids
         try:
-            if self.mode == "opt-in":
-                twig_ids = self.c.daemon.get_undecided_twig_ids()
-            else:
-                twig_ids = self.c.daemon.get_decided_twig_ids()
-            twig_enabled_statuses = self.c.daemon.get_twig_enabled_statuses()
+            twigs_state = self.c.daemon.get_twigs_state()
         except DaemonNotRunningException:
             self.c.gui.daemon_not_running()
             return
@@ -111,9 +107,16 @@ class TwigsTab(QtWidgets.QWidget):
             self.c.gui.daemon_permission_denied()
             return
 
+        if self.mode == "opt-in":
+            twig_ids = twigs_state["undecided_twig_ids"]
+        else:
+            twig_ids = twigs_state["decided_twig_ids"]
+
         # Add them
         for twig_id in reversed(twig_ids):
-            twig_view = TwigView(self.c, twig_id, twig_enabled_statuses[twig_id])
+            twig_view = TwigView(
+                self.c, twig_id, twigs_state["twigs"][twig_id]["enabled"]
+            )
             self.twig_views.append(twig_view)
             self.twigs_layout.insertWidget(0, twig_view)
 
@@ -147,7 +150,7 @@ class TwigsTab(QtWidgets.QWidget):
 
         # Build twig_status that maps the existing opt-in status of each twig
         try:
-            twig_enabled_statuses = self.c.daemon.get_twig_enabled_statuses()
+            twigs_state = self.c.daemon.get_twigs_state()
         except DaemonNotRunningException:
             self.c.gui.daemon_not_running()
             return
@@ -156,8 +159,8 @@ class TwigsTab(QtWidgets.QWidget):
             return
 
         twig_status = {}
-        for twig_id in twig_enabled_statuses:
-            if twig_enabled_statuses[twig_id] == "enabled":
+        for twig_id in twigs_state["twigs"]:
+            if twigs_state["twigs"][twig_id]["enabled"] == "enabled":
                 twig_status[twig_id] = True
             else:
                 twig_status[twig_id] = False
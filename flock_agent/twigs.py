@@ -3,12 +3,22 @@
 # A type of data that Flock Agent collects via osquery, and sends to a Flock
 # server, is called a "twig". This file hard-codes all of the available twigs,
 # and users have the option to opt-out of individual twigs.
+#
+# Each twig's priority is the lane its results get submitted in: "high" results
+# get submitted first, then "normal" ones, and "bulk" ones (twigs with big
+# results) last.
+#
+# Each twig's result_mode is either "snapshot", where osquery logs the whole
+# result every time the query runs, or "differential", where it only logs the
+# rows that were added or removed since the last time.
 
 twigs = {
     "os_version": {
         "name": "Operating system version",
         "query": "select * from os_version;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "The current version of operating system that's on your computer",
         "platforms": ["macos", "linux"],
     },
@@ -16,6 +26,8 @@ twigs = {
         "name": "Browser plugins",
         "query": "select browser_plugins.* from users join browser_plugins using (uid);",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "List of browser plugins, which can allow us to detect if you have malicious ones installed",
         "platforms": ["macos"],
     },
@@ -23,6 +35,8 @@ twigs = {
         "name": "Safari extensions",
         "query": "select safari_extensions.* from users join safari_extensions using (uid);",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "List of Safari extensions, which can allow us to detect if you have malicious ones installed",
         "platforms": ["macos"],
     },
@@ -30,6 +44,8 @@ twigs = {
         "name": "Opera extensions",
         "query": "select opera_extensions.* from users join opera_extensions using (uid);",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "List of Opera extensions, which can allow us to detect if you have malicious ones installed",
         "platforms": ["macos", "linux"],
     },
@@ -37,6 +53,8 @@ twigs = {
         "name": "Chrome extensions",
         "query": "select chrome_extensions.* from users join chrome_extensions using (uid);",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "List of Chrome extensions, which can allow us to detect if you have malicious ones installed",
         "platforms": ["macos", "linux"],
     },
@@ -44,6 +62,8 @@ twigs = {
         "name": "Firefox add-ons",
         "query": "select firefox_addons.* from users join firefox_addons using (uid);",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "List of Firefox add-ons, which can allow us to detect if you have malicious ones installed",
         "platforms": ["macos", "linux"],
     },
@@ -51,6 +71,8 @@ twigs = {
         "name": "Launch daemons",
         "query": "select * from launchd;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "What daemons (background services) automatically start on your computer, which malware could use for persistence",
         "platforms": ["macos"],
     },
@@ -58,6 +80,8 @@ twigs = {
         "name": "Startup items",
         "query": "select * from startup_items;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "What apps automatically start on your computer, which malware could use for persistence",
         "platforms": ["macos"],
     },
@@ -65,6 +89,8 @@ twigs = {
         "name": "Scheduled tasks (cron jobs)",
         "query": "select * from crontab;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "What programs are scheduled to run at regular intervals, which malware could use for persistence",
         "platforms": ["macos", "linux"],
     },
@@ -72,6 +98,8 @@ twigs = {
         "name": "Login window values",
         "query": "select key, subkey, value from plist where path = '/Library/Preferences/com.apple.loginwindow.plist';",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "What loginwindow values are set, including if the guest user is enabled, and which malware could use for persistence on system boot",
         "platforms": ["macos"],
     },
@@ -79,6 +107,8 @@ twigs = {
         "name": "Application firewall configuration",
         "query": "select * from alf;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "How the application firewall is configured",
         "platforms": ["macos"],
     },
@@ -86,6 +116,8 @@ twigs = {
         "name": "Application firewall services",
         "query": "select * from alf_services;",
         "interval": 3600,
+        "priority": "normal",
+        "result_mode": "differential",
         "description": "Which network services are allowed through the firewall, allowing us to identify unwanted firewall holes made by malware or humans",
         "platforms": ["macos"],
     },
@@ -93,6 +125,8 @@ twigs = {
         "name": "Local hostnames",
         "query": "select * from etc_hosts;",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "Values from the /etc/hosts file, which could be used to redirect or block network communications",
         "platforms": ["macos", "linux"],
     },
@@ -100,6 +134,8 @@ twigs = {
         "name": "Kernel extensions",
         "query": "select * from kernel_extensions;",
         "interval": 3600,
+        "priority": "bulk",
+        "result_mode": "differential",
         "description": "What current kernel extensions are loaded; some malware has a kernel extension component and this could help us catch it",
         "platforms": ["macos"],
     },
@@ -107,6 +143,8 @@ twigs = {
         "name": "Installed applications",
         "query": "select * from apps;",
         "interval": 3600,
+        "priority": "bulk",
+        "result_mode": "differential",
         "description": "List of applications that are currently installed, to help identify malware, adware, or vulnerable applications that are installed",
         "platforms": ["macos"],
     },
@@ -114,6 +152,8 @@ twigs = {
         "name": "Setuid binaries",
         "query": "select * from suid_bin;",
         "interval": 3600,
+        "priority": "bulk",
+        "result_mode": "differential",
         "description": "List of binary files on your computer with setuid enabled, which could be used for privilege escalation, including privilege escalation backdoors",
         "platforms": ["macos", "linux"],
     },
@@ -121,6 +161,8 @@ twigs = {
         "name": "Disk encryption",
         "query": "select disk_encryption.* from mounts join disk_encryption on mounts.device_alias = disk_encryption.name where mounts.path = '/'",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "Whether disk encryption is enabled",
         "platforms": ["macos", "linux"],
     },
@@ -128,6 +170,8 @@ twigs = {
         "name": "Remote sharing preferences",
         "query": "select * from sharing_preferences",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "Whether people can remotely login to your computer to access your screen, files, printers, or other services",
         "platforms": ["macos"],
     },
@@ -135,6 +179,8 @@ twigs = {
         "name": "Gatekeeper",
         "query": "select * from gatekeeper",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "Whether Gatekeeper is enabled, which protects your computer from running malicious apps",
         "platforms": ["macos"],
     },
@@ -142,6 +188,8 @@ twigs = {
         "name": "System Integrity Protection",
         "query": "select * from sip_config where config_flag='sip'",
         "interval": 28800,
+        "priority": "normal",
+        "result_mode": "snapshot",
         "description": "Whether System Integrity Protection is enabled, which protects your macOS system files from getting modified by malware",
         "platforms": ["macos"],
     },
@@ -150,6 +198,8 @@ twigs = {
         "name": "Reverse shells",
         "query": "SELECT DISTINCT(processes.pid), processes.parent, processes.name, processes.path, processes.cmdline, processes.cwd, processes.root, processes.uid, processes.gid, processes.start_time, process_open_sockets.remote_address, process_open_sockets.remote_port, (SELECT cmdline FROM processes AS parent_cmdline WHERE pid=processes.parent) AS parent_cmdline FROM processes JOIN (SELECT * FROM process_open_sockets WHERE family is 2 OR family is 10 ) AS process_open_sockets USING (pid) WHERE ( name is 'sh' OR name is 'bash' OR name is 'dash' OR name is 'zsh') AND process_open_sockets.remote_address != '127.0.0.1';",
         "interval": 60,
+        "priority": "high",
+        "result_mode": "differential",
         "description": "Detect reverse shells, which is the first step attackers often take after an initial compromise in order to more easily run commands on your computer",
         "platforms": ["macos", "linux"],
     }
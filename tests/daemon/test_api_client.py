@@ -1,3 +1,4 @@
+import gzip
 import json
 
 import responses
@@ -29,6 +30,19 @@ class TestApiClient:
         )
         FlockApiClient(common).ping()
 
+    @responses.activate
+    def test__make_request_reuses_session(self):
+        common = self._build_common()
+        responses.add(
+            responses.GET, f"{self.test_url}/ping", status=200,
+        )
+        api_client = FlockApiClient(common)
+        session = api_client.session
+        api_client.ping()
+        api_client.ping()
+        assert api_client.session is session
+        assert len(responses.calls) == 2
+
     @responses.activate
     def test__make_request_connection_error(self):
         common = self._build_common()
@@ -38,6 +52,48 @@ class TestApiClient:
         with pytest.raises(api_client.ConnectionError):
             FlockApiClient(common)._make_request("/test", "post", False)
 
+    @responses.activate
+    def test__make_request_circuit_open(self):
+        common = self._build_common()
+        responses.add(
+            responses.GET, f"{self.test_url}/ping", status=503,
+        )
+        client = FlockApiClient(common)
+        for _ in range(3):
+            with pytest.raises(api_client.BadStatusCode):
+                client.ping()
+
+        # Now requests fail without being sent
+        with pytest.raises(api_client.CircuitOpen):
+            client.ping()
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    def test_check_connection(self):
+        common = self._build_common()
+        responses.add(
+            responses.GET, f"{self.test_url}/ping", status=503,
+        )
+        client = FlockApiClient(common)
+
+        # While requests are succeeding, nothing is sent
+        assert client.check_connection()
+        assert len(responses.calls) == 0
+
+        for _ in range(3):
+            with pytest.raises(api_client.BadStatusCode):
+                client.ping()
+        assert not client.check_connection()
+        assert len(responses.calls) == 3
+
+        # Once the backoff is over, it pings as the probe
+        client.breaker.retry_at = 0
+        responses.replace(responses.GET, f"{self.test_url}/ping", status=200)
+        assert client.check_connection()
+        assert len(responses.calls) == 4
+        assert client.check_connection()
+        assert len(responses.calls) == 4
+
     @responses.activate
     def test__make_request_ok_with_401_response(self):
         response_data = {"error": False, "a": "test", "b": "test"}
@@ -242,6 +298,14 @@ class TestApiClient:
             "User-Agent": f"Flock Agent {common.version}"
         }
 
+    def test__get_headers_no_keep_alive(self):
+        common = self._build_common()
+        common.global_settings.set("gateway_keep_alive", False)
+        assert FlockApiClient(common)._get_headers(auth=False) == {
+            "User-Agent": f"Flock Agent {common.version}",
+            "Connection": "close",
+        }
+
     def test__get_headers_yes_auth(self):
         common = self._build_common()
         assert FlockApiClient(common)._get_headers(auth=True) == {
@@ -263,3 +327,107 @@ class TestApiClient:
             FlockApiClient(common)._build_url("/api/test")
             == "https://example.org/api/test"
         )
+
+    def _add_test_gateway(self, accept_encoding="gzip"):
+        """
+        Stand-in for the gateway's /ping and /submit endpoints, which decompresses
+        request bodies like the real gateway does, and records what it received
+        """
+        received = []
+
+        def ping_callback(request):
+            headers = {}
+            if accept_encoding:
+                headers["Accept-Encoding"] = accept_encoding
+            return 200, headers, json.dumps({"error": False})
+
+        def submit_callback(request):
+            encoding = request.headers.get("Content-Encoding")
+            body = request.body
+            if encoding and encoding not in (accept_encoding or ""):
+                return 415, {"Accept-Encoding": accept_encoding or "identity"}, ""
+            if encoding == "gzip":
+                body = gzip.decompress(body)
+            elif encoding == "zstd":
+                import zstandard
+
+                body = zstandard.ZstdDecompressor().decompress(body)
+            received.append({"encoding": encoding, "data": json.loads(body)})
+            return 200, {}, json.dumps({"error": False})
+
+        responses.add_callback(
+            responses.GET, f"{self.test_url}/ping", callback=ping_callback,
+        )
+        responses.add_callback(
+            responses.POST, f"{self.test_url}/submit", callback=submit_callback,
+        )
+        return received
+
+    def _build_logs(self, count):
+        return [
+            {"name": "os_version", "hostIdentifier": "test-host", "unixTime": i}
+            for i in range(count)
+        ]
+
+    @responses.activate
+    def test_submit_compressed_with_gzip(self):
+        common = self._build_common()
+        received = self._add_test_gateway("gzip")
+        logs = self._build_logs(100)
+
+        api_client = FlockApiClient(common)
+        api_client.ping()
+        api_client.submit(logs)
+
+        assert received == [{"encoding": "gzip", "data": logs}]
+        assert len(responses.calls[1].request.body) < len(json.dumps(logs)) / 5
+
+    @responses.activate
+    def test_submit_compressed_with_zstd(self):
+        pytest.importorskip("zstandard")
+        common = self._build_common()
+        received = self._add_test_gateway("zstd, gzip")
+        logs = self._build_logs(100)
+
+        api_client = FlockApiClient(common)
+        api_client.ping()
+        api_client.submit(logs)
+
+        assert received == [{"encoding": "zstd", "data": logs}]
+
+    @responses.activate
+    def test_submit_not_compressed_below_threshold(self):
+        common = self._build_common()
+        received = self._add_test_gateway("gzip")
+        logs = self._build_logs(1)
+
+        api_client = FlockApiClient(common)
+        api_client.ping()
+        api_client.submit(logs)
+
+        assert received == [{"encoding": None, "data": logs}]
+
+    @responses.activate
+    def test_submit_not_compressed_if_not_advertised(self):
+        common = self._build_common()
+        received = self._add_test_gateway(None)
+        logs = self._build_logs(100)
+
+        api_client = FlockApiClient(common)
+        api_client.ping()
+        api_client.submit(logs)
+
+        assert received == [{"encoding": None, "data": logs}]
+
+    @responses.activate
+    def test_submit_retries_uncompressed_on_415(self):
+        common = self._build_common()
+        received = self._add_test_gateway(None)
+        logs = self._build_logs(100)
+
+        api_client = FlockApiClient(common)
+        api_client.request_encodings = ["gzip"]
+        api_client.submit(logs)
+
+        assert received == [{"encoding": None, "data": logs}]
+        assert api_client.request_encodings == []
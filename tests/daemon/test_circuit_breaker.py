@@ -0,0 +1,54 @@
+from flock_agent.daemon.circuit_breaker import CircuitBreaker
+
+
+class TestCircuitBreaker:
+    def _build_breaker(self):
+        clock = {"now": 0}
+        breaker = CircuitBreaker(3, 30, 1800, clock=lambda: clock["now"])
+        return breaker, clock
+
+    def test_opens_after_threshold(self):
+        breaker, clock = self._build_breaker()
+        for _ in range(2):
+            breaker.record_failure()
+            assert breaker.allow_request()
+
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert 0 <= breaker.seconds_until_retry() <= 30
+
+    def test_success_resets_failures(self):
+        breaker, clock = self._build_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_allows_one_probe(self):
+        breaker, clock = self._build_breaker()
+        for _ in range(3):
+            breaker.record_failure()
+
+        clock["now"] = 30
+        assert breaker.allow_request()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow_request()
+
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow_request()
+
+    def test_failed_probe_backs_off_longer(self):
+        breaker, clock = self._build_breaker()
+        for _ in range(3):
+            breaker.record_failure()
+
+        # Each time the breaker opens, the backoff (before jitter) doubles, up to the
+        # maximum
+        for backoff in [60, 120, 240, 480, 960, 1800, 1800]:
+            clock["now"] += 1800
+            assert breaker.allow_request()
+            breaker.record_failure()
+            assert breaker.state == CircuitBreaker.OPEN
+            assert 0 <= breaker.seconds_until_retry() <= backoff
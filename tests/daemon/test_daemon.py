@@ -0,0 +1,70 @@
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from flock_agent import Common
+from flock_agent.daemon import daemon as daemon_module
+from flock_agent.daemon.daemon import Daemon
+from flock_agent.daemon.event_bus import EventBus
+from flock_agent.daemon.global_settings import GlobalSettings
+from flock_agent.gui.daemon_client import AsyncDaemonClient
+
+
+class SlowOsquery:
+    """
+    Stands in for Osquery, with a submit_logs that blocks for a while
+    """
+
+    def __init__(self):
+        self.submitted = False
+
+    def submit_logs(self):
+        time.sleep(1)
+        self.submitted = True
+
+
+class TestDaemon:
+    def _daemon(self, tmp_path):
+        """
+        A daemon with just enough set up to run the http server and submit logs
+        """
+        d = Daemon.__new__(Daemon)
+        d.c = Common(None, None)
+        d.global_settings = GlobalSettings(d.c, testing=True)
+        d.c.global_settings = d.global_settings
+        d.osquery = SlowOsquery()
+        d.event_bus = EventBus()
+        d.submit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        d.unix_socket_path = os.path.join(tmp_path, "socket")
+        d.gid = os.getgid()
+        return d
+
+    def test_http_server_responds_while_submitting(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(daemon_module.os, "chown", lambda *args: None)
+        d = self._daemon(tmp_path)
+        client = AsyncDaemonClient(d.c)
+        client.unix_socket_path = d.unix_socket_path
+
+        async def go():
+            await d.http_server()
+            submit_task = asyncio.ensure_future(d.submit_logs_osquery())
+            await asyncio.sleep(0.1)
+
+            start = time.monotonic()
+            await client.ping()
+            elapsed = time.monotonic() - start
+            assert not submit_task.done()
+
+            await submit_task
+            await client.close()
+            return elapsed
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            assert loop.run_until_complete(go()) < 0.5
+        finally:
+            loop.close()
+            d.submit_executor.shutdown()
+        assert d.osquery.submitted
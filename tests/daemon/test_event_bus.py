@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+from flock_agent.daemon.event_bus import EventBus
+
+
+class TestEventBus:
+    def _run(self, coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def test_publish_to_subscribers(self):
+        event_bus = EventBus()
+
+        async def go():
+            event_bus.start()
+            queue1 = event_bus.subscribe()
+            queue2 = event_bus.subscribe()
+            event_bus.publish("twigs_changed", {"twig_version": 1})
+
+            # Publish from another thread too
+            t = threading.Thread(target=event_bus.publish, args=("server_registered",))
+            t.start()
+            t.join()
+
+            for queue in [queue1, queue2]:
+                assert await queue.get() == {
+                    "type": "twigs_changed",
+                    "data": {"twig_version": 1},
+                }
+                assert await queue.get() == {"type": "server_registered", "data": None}
+
+            event_bus.unsubscribe(queue2)
+            event_bus.publish("server_registered")
+            await asyncio.sleep(0)
+            assert queue1.qsize() == 1
+            assert queue2.qsize() == 0
+
+        self._run(go())
+
+    def test_slow_subscriber_is_disconnected(self):
+        event_bus = EventBus(max_queued=2)
+
+        async def go():
+            event_bus.start()
+            queue = event_bus.subscribe()
+            for i in range(3):
+                event_bus.publish("setting_changed", {"key": str(i)})
+            await asyncio.sleep(0)
+
+            assert (await queue.get())["data"] == {"key": "0"}
+            assert (await queue.get())["data"] == {"key": "1"}
+            assert await queue.get() is None
+            assert queue not in event_bus.subscribers
+
+        self._run(go())
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import platform
+
+import pytest
+
+from flock_agent.daemon.file_watcher import FileWatcher
+from flock_agent.daemon.log_reader import LogReader
+from flock_agent.daemon.submission_queue import SubmissionQueue
+
+
+@pytest.mark.skipif(
+    platform.system() not in ["Linux", "Darwin"], reason="needs inotify or kqueue"
+)
+class TestFileWatcher:
+    def _run(self, tmp_path, change, debounce=0.05):
+        filename = os.path.join(tmp_path, "results.log")
+        calls = []
+
+        async def go():
+            watcher = FileWatcher([filename], lambda: calls.append(None), debounce)
+            assert watcher.start()
+            await asyncio.sleep(0.05)
+            change(filename)
+            await asyncio.sleep(0.3)
+            watcher.stop()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(go())
+        loop.close()
+        return calls
+
+    def test_write_is_noticed(self, tmp_path):
+        def change(filename):
+            with open(filename, "a") as f:
+                f.write("line\n")
+
+        assert len(self._run(tmp_path, change)) == 1
+
+    def test_bursts_are_coalesced(self, tmp_path):
+        def change(filename):
+            for i in range(10):
+                with open(filename, "a") as f:
+                    f.write(f"line{i}\n")
+
+        assert len(self._run(tmp_path, change)) == 1
+
+    def test_other_files_are_ignored(self, tmp_path):
+        def change(filename):
+            with open(os.path.join(os.path.dirname(filename), "other.log"), "a") as f:
+                f.write("line\n")
+
+        assert len(self._run(tmp_path, change)) == 0
+
+    def test_idle_pass_is_ignored(self, tmp_path):
+        # Once everything's been read, another pass over the file shouldn't look like
+        # a change, or the submit loop would never go idle
+        reader = LogReader(
+            os.path.join(tmp_path, "results.log"),
+            SubmissionQueue(str(tmp_path)),
+            "results",
+        )
+
+        def change(filename):
+            for _ in reader.read_batches(10):
+                reader.commit()
+            reader.truncate_if_consumed()
+
+        def write_and_truncate(filename):
+            with open(filename, "a") as f:
+                f.write("line\n")
+            change(filename)
+
+        assert len(self._run(tmp_path, write_and_truncate)) == 1
+        assert len(self._run(tmp_path, change)) == 0
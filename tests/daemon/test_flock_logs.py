@@ -0,0 +1,123 @@
+import json
+import os
+
+import pytest
+import responses
+
+from flock_agent import Common
+from flock_agent.daemon.global_settings import GlobalSettings
+from flock_agent.daemon import api_client
+from flock_agent.daemon.api_client import FlockApiClient
+from flock_agent.daemon.flock_logs import FlockLog, FlockLogTypes
+from flock_agent.daemon.submission_queue import SubmissionQueue
+
+
+class TestFlockLog:
+    test_url = "https://example.org"
+
+    def _build_flock_log(self, tmp_path):
+        common = Common(None, None)
+        common.global_settings = GlobalSettings(common, testing=True)
+        common.global_settings.set("gateway_url", self.test_url)
+        common.global_settings.set("gateway_username", "test-username")
+        common.global_settings.set("gateway_token", "test-token")
+        common.api_client = FlockApiClient(common)
+        common.submission_queue = SubmissionQueue(str(tmp_path))
+        return FlockLog(common, str(tmp_path))
+
+    def _read_lines(self, filename):
+        with open(filename) as f:
+            return [json.loads(line) for line in f]
+
+    def _add_test_gateway(self, status=200):
+        received = []
+
+        def submit_callback(request):
+            received.append(json.loads(request.body))
+            return status, {}, json.dumps({"error": False})
+
+        responses.add(
+            responses.GET, f"{self.test_url}/ping", json={"error": False}, status=200
+        )
+        responses.add_callback(
+            responses.POST,
+            f"{self.test_url}/submit_flock_logs",
+            callback=submit_callback,
+        )
+        return received
+
+    def test_log(self, tmp_path):
+        flock_log = self._build_flock_log(tmp_path)
+        flock_log.log(FlockLogTypes.TWIGS_ENABLED, ["os_version"])
+        flock_log.log(FlockLogTypes.SERVER_DISABLED)
+
+        lines = self._read_lines(flock_log.filename)
+        assert [line["type"] for line in lines] == ["twigs_enabled", "server_disabled"]
+        assert lines[0]["twig_ids"] == ["os_version"]
+        assert os.stat(flock_log.filename).st_mode & 0o777 == 0o600
+        flock_log.close()
+
+    def test_rotate(self, tmp_path):
+        flock_log = self._build_flock_log(tmp_path)
+        flock_log.log(FlockLogTypes.SERVER_ENABLED)
+        flock_log.rotate()
+        flock_log.log(FlockLogTypes.SERVER_DISABLED)
+
+        # A second rotate does nothing, since the pending file wasn't submitted yet
+        flock_log.rotate()
+
+        pending = self._read_lines(flock_log.pending_filename)
+        current = self._read_lines(flock_log.filename)
+        assert [line["type"] for line in pending] == ["server_enabled"]
+        assert [line["type"] for line in current] == ["server_disabled"]
+        flock_log.close()
+
+    @responses.activate
+    def test_submit_logs(self, tmp_path):
+        received = self._add_test_gateway()
+        flock_log = self._build_flock_log(tmp_path)
+        flock_log.log(FlockLogTypes.SERVER_ENABLED)
+        flock_log.log(FlockLogTypes.TWIGS_ENABLED, ["os_version"])
+        flock_log.submit_logs()
+
+        assert len(received) == 1
+        assert [obj["type"] for obj in received[0]] == [
+            "server_enabled",
+            "twigs_enabled",
+        ]
+        assert not os.path.exists(flock_log.pending_filename)
+        assert os.path.getsize(flock_log.filename) == 0
+        flock_log.close()
+
+    @responses.activate
+    def test_submit_logs_failed_keeps_queued(self, tmp_path):
+        self._add_test_gateway(status=500)
+        flock_log = self._build_flock_log(tmp_path)
+        flock_log.log(FlockLogTypes.SERVER_ENABLED)
+        with pytest.raises(api_client.BadStatusCode):
+            flock_log.submit_logs()
+
+        assert not os.path.exists(flock_log.pending_filename)
+        assert flock_log.c.submission_queue.depth("flock") == 1
+
+        # Once the server is back, they get submitted
+        responses.reset()
+        received = self._add_test_gateway()
+        flock_log.submit_logs()
+        assert [obj["type"] for obj in received[0]] == ["server_enabled"]
+        assert flock_log.c.submission_queue.depth("flock") == 0
+        flock_log.close()
+
+    def test_queue_logs_over_budget(self, tmp_path):
+        flock_log = self._build_flock_log(tmp_path)
+        flock_log.c.global_settings.set("flock_log_max_bytes", 100)
+        flock_log.log(FlockLogTypes.SERVER_ENABLED)
+        flock_log.log(FlockLogTypes.TWIGS_ENABLED, ["os_version"])
+        flock_log.queue_logs()
+
+        # Only the newest log is kept, and the dropped one is logged
+        assert flock_log.c.submission_queue.depth("flock") == 1
+        lines = self._read_lines(flock_log.filename)
+        assert lines[0]["type"] == "logs_dropped"
+        assert lines[0]["dropped"] == {"flock": 1}
+        flock_log.close()
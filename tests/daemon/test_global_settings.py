@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+from flock_agent import Common
+from flock_agent.daemon.global_settings import GlobalSettings
+
+
+class TestGlobalSettings:
+    def _build_global_settings(self, tmp_path):
+        common = Common(None, None)
+        common.appdata_path = str(tmp_path)
+        global_settings = GlobalSettings(common, testing=True)
+
+        # Save to the temp dir
+        global_settings.testing = False
+        global_settings.settings_filename = os.path.join(tmp_path, "settings.json")
+        global_settings.save_delay = 0.05
+        return global_settings
+
+    def _read(self, filename):
+        with open(filename) as f:
+            return json.load(f)
+
+    def test_save_is_coalesced(self, tmp_path):
+        global_settings = self._build_global_settings(tmp_path)
+        for i in range(10):
+            global_settings.set("gateway_url", f"https://{i}.example.org")
+            global_settings.save()
+        assert not os.path.exists(global_settings.settings_filename)
+
+        time.sleep(0.2)
+        settings = self._read(global_settings.settings_filename)
+        assert settings["gateway_url"] == "https://9.example.org"
+        assert not os.path.exists(f"{global_settings.settings_filename}.tmp")
+        assert os.stat(global_settings.settings_filename).st_mode & 0o777 == 0o600
+
+    def test_load(self, tmp_path):
+        global_settings = self._build_global_settings(tmp_path)
+        global_settings.set("gateway_url", "https://example.org")
+        global_settings.set("last_osquery_result_timestamp", 123)
+        global_settings.flush()
+
+        # Settings that aren't used anymore get deleted
+        global_settings.load(None)
+        assert global_settings.get("gateway_url") == "https://example.org"
+        assert "last_osquery_result_timestamp" not in global_settings.settings
+
+    def test_twig_index(self, tmp_path):
+        global_settings = self._build_global_settings(tmp_path)
+        twig_ids = list(global_settings.settings["twigs"])
+        assert global_settings.get_undecided_twig_ids() == twig_ids
+        assert global_settings.get_enabled_twig_ids() == []
+
+        version = global_settings.twig_version
+        global_settings.enable_twig(twig_ids[2])
+        global_settings.enable_twig(twig_ids[0])
+        global_settings.disable_twig(twig_ids[1])
+        assert global_settings.twig_version == version + 3
+
+        assert global_settings.get_enabled_twig_ids() == [twig_ids[0], twig_ids[2]]
+        assert global_settings.get_decided_twig_ids() == twig_ids[:3]
+        assert global_settings.get_undecided_twig_ids() == twig_ids[3:]
+        assert global_settings.get_twig_enabled_statuses()[twig_ids[1]] == "disabled"
+
+        # Nothing changed, so the version stays the same
+        global_settings.enable_twig(twig_ids[0])
+        assert global_settings.twig_version == version + 3
+
+    def test_twigs_state(self, tmp_path):
+        global_settings = self._build_global_settings(tmp_path)
+        twig_ids = list(global_settings.settings["twigs"])
+        global_settings.enable_twig(twig_ids[0])
+
+        state = global_settings.get_twigs_state()
+        assert state["twig_version"] == global_settings.twig_version
+        assert state["enabled_twig_ids"] == [twig_ids[0]]
+        assert state["decided_twig_ids"] == [twig_ids[0]]
+        assert state["undecided_twig_ids"] == twig_ids[1:]
+        assert state["twigs"][twig_ids[0]]["enabled"] == "enabled"
+        assert state["twigs"][twig_ids[1]]["name"]
+        json.dumps(state)
+
+    def test_failed_flush_is_retried(self, tmp_path, monkeypatch):
+        global_settings = self._build_global_settings(tmp_path)
+        global_settings.set("gateway_url", "https://example.org")
+
+        def write(filename, data):
+            raise OSError("disk full")
+
+        with monkeypatch.context() as m:
+            m.setattr(global_settings, "_write", write)
+            with pytest.raises(OSError):
+                global_settings.flush()
+
+        global_settings.flush()
+        settings = self._read(global_settings.settings_filename)
+        assert settings["gateway_url"] == "https://example.org"
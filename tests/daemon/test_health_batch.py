@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+
+from flock_agent.daemon.health_batch import stream_health_batch
+
+
+class TestHealthBatch:
+    health_items = [
+        {"name": "slow", "query": "0.3"},
+        {"name": "fast", "query": "0.1"},
+        {"name": "failed", "query": "0.2"},
+        {"name": "crashed", "query": "0"},
+    ]
+
+    @pytest.fixture
+    def queries(self):
+        """
+        Fake health item queries, which take as many seconds as their query says,
+        and keep track of which ones got cancelled
+        """
+        cancelled = []
+
+        async def exec_health_item(health_item):
+            try:
+                await asyncio.sleep(float(health_item["query"]))
+            except asyncio.CancelledError:
+                cancelled.append(health_item["name"])
+                raise
+            if health_item["name"] == "failed":
+                return None
+            if health_item["name"] == "crashed":
+                raise RuntimeError("crashed")
+            return [{"name": health_item["name"]}]
+
+        return exec_health_item, cancelled
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_streams_in_order_of_completion(self, queries):
+        exec_health_item, cancelled = queries
+        lines = []
+
+        async def write(data):
+            lines.append(json.loads(data))
+
+        self._run(stream_health_batch(self.health_items, exec_health_item, write))
+        assert lines == [
+            {
+                "name": "crashed",
+                "data": None,
+                "error": "error executing health item query",
+            },
+            {"name": "fast", "data": [{"name": "fast"}], "error": False},
+            {
+                "name": "failed",
+                "data": None,
+                "error": "error executing health item query",
+            },
+            {"name": "slow", "data": [{"name": "slow"}], "error": False},
+        ]
+        assert cancelled == []
+
+    def test_write_failure_cancels_the_rest(self, queries):
+        exec_health_item, cancelled = queries
+
+        async def write(data):
+            if json.loads(data)["name"] == "fast":
+                raise ConnectionResetError()
+
+        async def go():
+            with pytest.raises(ConnectionResetError):
+                await stream_health_batch(self.health_items, exec_health_item, write)
+            await asyncio.sleep(0)
+
+        self._run(go())
+        assert sorted(cancelled) == ["failed", "slow"]
+
+    def test_cancel_cancels_the_rest(self, queries):
+        exec_health_item, cancelled = queries
+
+        async def write(data):
+            pass
+
+        async def go():
+            task = asyncio.ensure_future(
+                stream_health_batch(self.health_items, exec_health_item, write)
+            )
+            await asyncio.sleep(0.15)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+
+        self._run(go())
+        assert sorted(cancelled) == ["failed", "slow"]
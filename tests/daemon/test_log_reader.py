@@ -0,0 +1,85 @@
+import os
+
+from flock_agent.daemon.log_reader import LogReader
+from flock_agent.daemon.submission_queue import SubmissionQueue
+
+
+class TestLogReader:
+    def _build_reader(self, tmp_path, lines=None):
+        filename = os.path.join(tmp_path, "results.log")
+        if lines is not None:
+            with open(filename, "w") as f:
+                f.write("".join(lines))
+        return LogReader(filename, SubmissionQueue(str(tmp_path)), "results")
+
+    def _append(self, reader, data):
+        with open(reader.filename, "a") as f:
+            f.write(data)
+
+    def test_read_batches(self, tmp_path):
+        reader = self._build_reader(tmp_path, [f"line{i}\n" for i in range(5)])
+        batches = list(reader.read_batches(2))
+        assert batches == [["line0", "line1"], ["line2", "line3"], ["line4"]]
+
+    def test_commit_only_reads_new_lines(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b\n"])
+        for _ in reader.read_batches(10):
+            reader.commit()
+        assert not reader.has_new_lines()
+
+        self._append(reader, "c\n")
+        assert reader.has_new_lines()
+        assert list(reader.read_batches(10)) == [["c"]]
+
+    def test_uncommitted_batches_are_read_again(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b\n", "c\n"])
+        for batch in reader.read_batches(1):
+            if batch == ["b"]:
+                break
+            reader.commit()
+        assert list(reader.read_batches(10)) == [["b", "c"]]
+
+    def test_checkpoint_is_persisted(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b\n"])
+        for _ in reader.read_batches(10):
+            reader.commit()
+        self._append(reader, "c\n")
+
+        reader = self._build_reader(tmp_path)
+        assert list(reader.read_batches(10)) == [["c"]]
+
+    def test_partial_line_is_not_read(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b"])
+        for _ in reader.read_batches(10):
+            reader.commit()
+        self._append(reader, "c\n")
+        assert list(reader.read_batches(10)) == [["bc"]]
+
+    def test_truncated_file_starts_over(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["aaaa\n", "bbbb\n"])
+        for _ in reader.read_batches(10):
+            reader.commit()
+        with open(reader.filename, "w") as f:
+            f.write("c\n")
+        assert list(reader.read_batches(10)) == [["c"]]
+
+    def test_truncate_if_consumed(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b\n"])
+        for _ in reader.read_batches(1):
+            reader.truncate_if_consumed()
+            assert os.path.getsize(reader.filename) > 0
+            reader.commit()
+
+        reader.truncate_if_consumed()
+        assert os.path.getsize(reader.filename) == 0
+        assert reader.offset == 0
+
+    def test_checkpoint_saved_with_enqueue(self, tmp_path):
+        reader = self._build_reader(tmp_path, ["a\n", "b\n"])
+        for lines in reader.read_batches(10):
+            reader.checkpoints.enqueue("test", lines, checkpoint=reader.checkpoint())
+            reader.commit(saved=True)
+        self._append(reader, "c\n")
+
+        reader = self._build_reader(tmp_path)
+        assert list(reader.read_batches(10)) == [["c"]]
@@ -0,0 +1,375 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from flock_agent import Common
+from flock_agent.common import Platform
+from flock_agent.daemon import osquery as osquery_module
+from flock_agent.daemon.global_settings import GlobalSettings
+from flock_agent.daemon.log_reader import LogReader
+from flock_agent.daemon.osquery import Osquery
+from flock_agent.daemon.osquery_extension import ExtensionClient
+from flock_agent.daemon.submission_queue import SubmissionQueue
+from flock_agent.twigs import twigs
+
+from test_osquery_extension import StandInExtensionManager
+
+
+# Stands in for osqueryi. The query is how long to sleep for, and it keeps track of
+# how many copies are running at once in its directory
+FAKE_OSQUERYI = """#!{python}
+import os, sys, time
+dirname = os.path.dirname(os.path.abspath(__file__))
+running = os.path.join(dirname, "running", str(os.getpid()))
+open(running, "w").close()
+with open(os.path.join(dirname, "counts"), "a") as f:
+    f.write(str(len(os.listdir(os.path.dirname(running)))) + "\\n")
+time.sleep(float(sys.argv[2]))
+os.remove(running)
+open(os.path.join(dirname, "finished"), "a").close()
+print('[{{"result": "ok"}}]')
+"""
+
+
+class FakeProcess:
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class FakeApiClient:
+    def __init__(self):
+        self.submitted = []
+
+    def check_connection(self):
+        return True
+
+    def submit(self, data):
+        self.submitted.extend(data)
+
+
+class TestOsquery:
+    @pytest.fixture
+    def osquery(self, tmp_path, monkeypatch):
+        common = Common(None, None)
+        common.global_settings = GlobalSettings(common, testing=True)
+        common.global_settings.set("use_server", True)
+        common.submission_queue = SubmissionQueue(str(tmp_path))
+
+        # Keep everything in the temp dir
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.LINUX)
+        monkeypatch.setattr(osquery_module.os, "makedirs", lambda *args, **kw: None)
+        osquery = Osquery(common)
+        monkeypatch.undo()
+
+        osquery.config_filename = os.path.join(tmp_path, "osquery.conf")
+        osquery.results_filename = os.path.join(tmp_path, "osqueryd.results.log")
+        osquery.snapshots_filename = os.path.join(tmp_path, "osqueryd.snapshots.log")
+        osquery.results_reader = LogReader(
+            osquery.results_filename, common.submission_queue, "osqueryd.results"
+        )
+        osquery.snapshots_reader = LogReader(
+            osquery.snapshots_filename, common.submission_queue, "osqueryd.snapshots"
+        )
+        osquery.plist_filename = os.path.join(tmp_path, "installed.plist")
+        return osquery
+
+    @pytest.fixture
+    def commands(self, monkeypatch):
+        """
+        Fake subprocess.run, and keep track of the commands that would have run
+        """
+        commands = []
+        state = {"running": True}
+
+        def run(args, **kwargs):
+            commands.append(" ".join(args))
+            if "is-active" in args or "list" in args:
+                return FakeProcess(0 if state["running"] else 3)
+            return FakeProcess(0)
+
+        monkeypatch.setattr(osquery_module.subprocess, "run", run)
+        return commands, state
+
+    def _write_current_config(self, osquery):
+        with open(osquery.config_filename, "w") as f:
+            f.write(json.dumps(osquery.build_config(), indent=4))
+
+    def test_unchanged_config_does_nothing(self, osquery, commands, monkeypatch):
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.LINUX)
+        commands, _ = commands
+        self._write_current_config(osquery)
+
+        osquery.refresh_osqueryd()
+        assert commands == ["/bin/systemctl is-active --quiet osqueryd"]
+
+    def test_schedule_change_reloads(self, osquery, commands, monkeypatch):
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.LINUX)
+        commands, _ = commands
+        self._write_current_config(osquery)
+
+        twig_id = osquery.c.global_settings.get_undecided_twig_ids()[0]
+        osquery.c.global_settings.enable_twig(twig_id)
+        osquery.refresh_osqueryd()
+
+        # osqueryd picks up the new schedule with config_refresh, without a restart
+        assert commands == ["/bin/systemctl is-active --quiet osqueryd"]
+        with open(osquery.config_filename) as f:
+            assert twig_id in json.load(f)["schedule"]
+
+    def test_options_change_restarts(self, osquery, commands, monkeypatch):
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.LINUX)
+        commands, _ = commands
+        self._write_current_config(osquery)
+
+        osquery.config_skeleton["options"]["schedule_splay_percent"] = "20"
+        osquery.refresh_osqueryd()
+
+        assert commands[1:] == [
+            "/usr/bin/pkexec /bin/systemctl stop osqueryd",
+            "/usr/bin/pkexec /bin/systemctl start osqueryd",
+            "/usr/bin/pkexec /bin/systemctl enable osqueryd",
+        ]
+        with open(osquery.config_filename) as f:
+            assert json.load(f)["options"]["schedule_splay_percent"] == "20"
+
+    def test_not_running_starts(self, osquery, commands, monkeypatch):
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.LINUX)
+        commands, state = commands
+        state["running"] = False
+        self._write_current_config(osquery)
+
+        osquery.refresh_osqueryd()
+        assert commands[1:] == [
+            "/usr/bin/pkexec /bin/systemctl start osqueryd",
+            "/usr/bin/pkexec /bin/systemctl enable osqueryd",
+        ]
+
+    def test_stale_plist_restarts(self, osquery, commands, monkeypatch, tmp_path):
+        monkeypatch.setattr(osquery_module.Platform, "current", lambda: Platform.MACOS)
+        commands, _ = commands
+        self._write_current_config(osquery)
+
+        plist_resource = os.path.join(tmp_path, "resource.plist")
+        with open(plist_resource, "w") as f:
+            f.write("new plist")
+        with open(osquery.plist_filename, "w") as f:
+            f.write("old plist")
+        monkeypatch.setattr(osquery, "_get_plist_resource_path", lambda: plist_resource)
+
+        osquery.refresh_osqueryd()
+        assert commands[1:] == [
+            f"/bin/launchctl unload {osquery.plist_filename}",
+            f"/bin/launchctl load {osquery.plist_filename}",
+        ]
+        with open(osquery.plist_filename) as f:
+            assert f.read() == "new plist"
+
+    @pytest.fixture
+    def osqueryi(self, osquery, tmp_path):
+        """
+        Make queries run in the fake osqueryi, and return its directory
+        """
+        dirname = os.path.join(tmp_path, "osqueryi")
+        os.makedirs(os.path.join(dirname, "running"))
+        osquery.osqueryi_bin = os.path.join(dirname, "osqueryi")
+        with open(osquery.osqueryi_bin, "w") as f:
+            f.write(FAKE_OSQUERYI.format(python=sys.executable))
+        os.chmod(osquery.osqueryi_bin, stat.S_IRWXU)
+
+        # There's no osqueryd extension socket, so osqueryi gets used
+        osquery.extension_client = ExtensionClient(os.path.join(tmp_path, "none.em"))
+        return dirname
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_exec_async(self, osquery, osqueryi):
+        assert self._run(osquery.exec_async("0")) == [{"result": "ok"}]
+
+    def test_exec_async_timeout(self, osquery, osqueryi):
+        osquery.query_timeout = 0.5
+        start = time.monotonic()
+        assert self._run(osquery.exec_async("1")) is None
+        assert time.monotonic() - start < 1
+
+        # It was killed, instead of being left running
+        time.sleep(1)
+        assert not os.path.exists(os.path.join(osqueryi, "finished"))
+
+    def test_exec_async_cancel_kills_query(self, osquery, osqueryi):
+        async def go():
+            task = asyncio.ensure_future(osquery.exec_async("1"))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(1)
+
+        self._run(go())
+        assert not os.path.exists(os.path.join(osqueryi, "finished"))
+
+    def test_exec_async_concurrency_limit(self, osquery, osqueryi):
+        async def go():
+            return await asyncio.gather(*[osquery.exec_async("0.3") for _ in range(6)])
+
+        assert self._run(go()) == [[{"result": "ok"}]] * 6
+        with open(os.path.join(osqueryi, "counts")) as f:
+            counts = [int(line) for line in f]
+        assert len(counts) == 6
+        assert max(counts) == osquery.max_concurrent_queries
+
+    @pytest.fixture
+    def extension(self, osquery, osqueryi, tmp_path):
+        """
+        Make queries run over a stand-in extension socket, which is slow
+        """
+        server = StandInExtensionManager(
+            os.path.join(tmp_path, "osquery.em"), {"slow": []}
+        )
+        server.delay = 5
+        osquery.extension_client = ExtensionClient(server.socket_path)
+        yield server
+        server.close()
+
+    def test_exec_async_extension_timeout(self, osquery, osqueryi, extension):
+        osquery.query_timeout = 0.5
+        start = time.monotonic()
+        assert self._run(osquery.exec_async("slow")) is None
+        assert time.monotonic() - start < 1
+
+        # It didn't get run again with osqueryi, and the connection was dropped
+        assert not os.path.exists(os.path.join(osqueryi, "counts"))
+        assert osquery.extension_client.idle == []
+
+    def test_exec_async_extension_cancel(self, osquery, osqueryi, extension):
+        async def go():
+            # With only one executor thread, nothing else can run until the query
+            # gives up
+            loop = asyncio.get_event_loop()
+            loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(1))
+
+            task = asyncio.ensure_future(osquery.exec_async("slow"))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            start = time.monotonic()
+            await loop.run_in_executor(None, lambda: None)
+            return time.monotonic() - start
+
+        assert self._run(go()) < 1
+        assert not os.path.exists(os.path.join(osqueryi, "counts"))
+
+    def test_build_config_result_modes(self, osquery):
+        global_settings = osquery.c.global_settings
+        for twig_id in global_settings.get_undecided_twig_ids():
+            global_settings.enable_twig(twig_id)
+
+        schedule = osquery.build_config()["schedule"]
+        assert schedule
+        for twig_id in schedule:
+            if twigs[twig_id]["result_mode"] == "snapshot":
+                assert schedule[twig_id]["snapshot"] is True
+                assert "removed" not in schedule[twig_id]
+            else:
+                assert schedule[twig_id]["removed"] is True
+                assert "snapshot" not in schedule[twig_id]
+
+    def test_split_diff_results(self, osquery):
+        obj = {
+            "name": "kernel_modules",
+            "unixTime": 123,
+            "diffResults": {
+                "added": [{"name": "a"}, {"name": "b"}],
+                "removed": [{"name": "c"}],
+            },
+        }
+        assert osquery.split_diff_results(obj) == [
+            {
+                "name": "kernel_modules",
+                "unixTime": 123,
+                "action": "added",
+                "columns": {"name": "a"},
+            },
+            {
+                "name": "kernel_modules",
+                "unixTime": 123,
+                "action": "added",
+                "columns": {"name": "b"},
+            },
+            {
+                "name": "kernel_modules",
+                "unixTime": 123,
+                "action": "removed",
+                "columns": {"name": "c"},
+            },
+        ]
+
+        # Events that are already one row at a time are left alone
+        event = {"name": "kernel_modules", "action": "added", "columns": {}}
+        assert osquery.split_diff_results(event) == [event]
+
+    def _write_logs(self, osquery):
+        with open(osquery.results_filename, "w") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "name": "kernel_modules",
+                        "action": "added",
+                        "columns": {"name": "a"},
+                    }
+                )
+                + "\n"
+            )
+        with open(osquery.snapshots_filename, "w") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "name": "os_version",
+                        "action": "snapshot",
+                        "snapshot": [{"version": "10.15"}],
+                    }
+                )
+                + "\n"
+            )
+
+    def test_queue_logs_reads_results_and_snapshots(self, osquery):
+        self._write_logs(osquery)
+        osquery.queue_logs()
+
+        batch = osquery.c.submission_queue.peek(osquery.get_lane_source("normal"))
+        assert sorted(obj["name"] for obj in batch.items) == [
+            "kernel_modules",
+            "os_version",
+        ]
+
+        # Both files were consumed, and don't get queued again
+        assert os.path.getsize(osquery.results_filename) == 0
+        assert os.path.getsize(osquery.snapshots_filename) == 0
+        osquery.queue_logs()
+        assert osquery.c.submission_queue.depth(osquery.get_lane_source("normal")) == 2
+
+    def test_submit_logs_submits_results_and_snapshots(self, osquery):
+        osquery.c.api_client = FakeApiClient()
+        self._write_logs(osquery)
+        osquery.submit_logs()
+
+        submitted = {obj["name"]: obj for obj in osquery.c.api_client.submitted}
+        assert sorted(submitted) == ["kernel_modules", "os_version"]
+        assert submitted["os_version"]["snapshot"] == [{"version": "10.15"}]
+        for priority, _ in osquery.lanes:
+            assert (
+                osquery.c.submission_queue.depth(osquery.get_lane_source(priority)) == 0
+            )
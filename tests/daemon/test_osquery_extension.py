@@ -0,0 +1,176 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from flock_agent.daemon.osquery_extension import (
+    ExtensionClient,
+    ExtensionSocketError,
+    QueryAborted,
+    QueryFailed,
+    QueryHandle,
+    QueryTimeout,
+    encode_message,
+    read_message,
+    T_EXCEPTION,
+    T_I32,
+    T_I64,
+    T_LIST,
+    T_MAP,
+    T_REPLY,
+    T_STRING,
+    T_STRUCT,
+)
+
+
+class StandInExtensionManager:
+    """
+    Stand-in for osqueryd's extension manager socket, which answers "query" calls with
+    canned rows, after waiting delay seconds
+    """
+
+    def __init__(self, socket_path, tables):
+        self.socket_path = socket_path
+        self.tables = tables
+        self.queries = []
+        self.connections = 0
+        self.delay = 0
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen(5)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        f = conn.makefile("rb")
+        while True:
+            try:
+                name, message_type, seqid, args = read_message(f)
+            except ExtensionSocketError:
+                conn.close()
+                return
+
+            if name != "query":
+                reply = encode_message(
+                    name, T_EXCEPTION, seqid, [(1, T_STRING, "unknown method")]
+                )
+            else:
+                sql = args[1]
+                self.queries.append(sql)
+                time.sleep(self.delay)
+                if sql in self.tables:
+                    code, message, rows = 0, "OK", self.tables[sql]
+                else:
+                    code, message, rows = 1, "no such table", []
+                status = [(1, T_I32, code), (2, T_STRING, message), (3, T_I64, 0)]
+                rows = [(T_STRING, T_STRING, row) for row in rows]
+                response = [(1, T_STRUCT, status), (2, T_LIST, (T_MAP, rows))]
+                reply = encode_message(name, T_REPLY, seqid, [(0, T_STRUCT, response)])
+            try:
+                conn.sendall(reply)
+            except OSError:
+                # The client gave up on the query
+                conn.close()
+                return
+
+    def close(self):
+        self.server.close()
+
+
+class TestExtensionClient:
+    tables = {
+        "select * from os_version;": [{"name": "macOS", "major": "10", "minor": "15"}],
+        "select * from empty;": [],
+    }
+
+    @pytest.fixture
+    def server(self, tmp_path):
+        server = StandInExtensionManager(
+            os.path.join(tmp_path, "osquery.em"), self.tables
+        )
+        yield server
+        server.close()
+
+    def test_query(self, server):
+        client = ExtensionClient(server.socket_path)
+        assert client.query("select * from os_version;") == [
+            {"name": "macOS", "major": "10", "minor": "15"}
+        ]
+        assert client.query("select * from empty;") == []
+
+    def test_query_reuses_connection(self, server):
+        client = ExtensionClient(server.socket_path)
+        for _ in range(5):
+            client.query("select * from os_version;")
+        assert server.connections == 1
+        assert len(server.queries) == 5
+
+    def test_query_failed(self, server):
+        client = ExtensionClient(server.socket_path)
+        with pytest.raises(QueryFailed):
+            client.query("select * from missing_table;")
+
+        # The connection is still usable
+        assert client.query("select * from empty;") == []
+
+    def test_query_reconnects(self, server):
+        client = ExtensionClient(server.socket_path)
+        client.query("select * from empty;")
+        client.idle[0].sock.shutdown(socket.SHUT_RDWR)
+        assert client.query("select * from empty;") == []
+        assert server.connections == 2
+
+    def test_query_no_socket(self, tmp_path):
+        client = ExtensionClient(os.path.join(tmp_path, "missing.em"))
+        with pytest.raises(ExtensionSocketError):
+            client.query("select * from os_version;")
+
+    def test_query_timeout_is_not_retried(self, server):
+        client = ExtensionClient(server.socket_path, timeout=0.5)
+        server.delay = 2
+        with pytest.raises(QueryTimeout):
+            client.query("select * from empty;")
+        assert len(server.queries) == 1
+        assert client.idle == []
+
+    def test_query_abort(self, server):
+        client = ExtensionClient(server.socket_path)
+        server.delay = 5
+        handle = QueryHandle()
+        threading.Timer(0.2, handle.abort).start()
+
+        start = time.monotonic()
+        with pytest.raises(QueryAborted):
+            client.query("select * from empty;", handle)
+        assert time.monotonic() - start < 1
+        assert len(server.queries) == 1
+        assert client.idle == []
+
+    def test_concurrent_queries(self, server):
+        client = ExtensionClient(server.socket_path, max_idle=2)
+        server.delay = 0.5
+        threads = [
+            threading.Thread(target=client.query, args=("select * from empty;",))
+            for _ in range(2)
+        ]
+
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.monotonic() - start < 0.9
+        assert server.connections == 2
+        assert len(client.idle) == 2
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from flock_agent.daemon.query_cache import QueryCache
+
+
+class TestQueryCache:
+    def _run(self, coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def _build_fetch(self, data, delay=0):
+        calls = []
+
+        async def fetch():
+            calls.append(None)
+            await asyncio.sleep(delay)
+            return data
+
+        return fetch, calls
+
+    def test_get_caches_results(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch([{"a": "1"}])
+
+        async def go():
+            assert await cache.get("key", 60, fetch) == [{"a": "1"}]
+            assert await cache.get("key", 60, fetch) == [{"a": "1"}]
+
+        self._run(go())
+        assert len(calls) == 1
+
+    def test_get_expired(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch([{"a": "1"}])
+
+        async def go():
+            await cache.get("key", 0, fetch)
+            await cache.get("key", 0, fetch)
+
+        self._run(go())
+        assert len(calls) == 2
+
+    def test_get_does_not_cache_failures(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch(None)
+
+        async def go():
+            assert await cache.get("key", 60, fetch) is None
+            assert await cache.get("key", 60, fetch) is None
+
+        self._run(go())
+        assert len(calls) == 2
+
+    def test_get_single_flight(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch([{"a": "1"}], delay=0.1)
+
+        async def go():
+            return await asyncio.gather(
+                cache.get("key", 60, fetch), cache.get("key", 60, fetch)
+            )
+
+        assert self._run(go()) == [[{"a": "1"}], [{"a": "1"}]]
+        assert len(calls) == 1
+
+    def test_get_cancelled_cancels_query(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch([{"a": "1"}], delay=10)
+
+        async def go():
+            task = asyncio.ensure_future(cache.get("key", 60, fetch))
+            await asyncio.sleep(0.01)
+            query = cache.in_flight["key"]
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+            assert query.task.cancelled()
+            assert "key" not in cache.in_flight
+
+        self._run(go())
+
+    def test_lru_eviction(self):
+        cache = QueryCache(max_entries=2)
+        fetch, calls = self._build_fetch([])
+
+        async def go():
+            await cache.get("a", 60, fetch)
+            await cache.get("b", 60, fetch)
+            await cache.get("a", 60, fetch)
+            await cache.get("c", 60, fetch)
+
+        self._run(go())
+        assert list(cache.entries) == ["a", "c"]
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        fetch, calls = self._build_fetch([])
+
+        async def go():
+            await cache.get("a", 60, fetch)
+            await cache.get("b", 60, fetch)
+            cache.invalidate("a")
+            assert list(cache.entries) == ["b"]
+            cache.invalidate()
+            assert list(cache.entries) == []
+
+        self._run(go())
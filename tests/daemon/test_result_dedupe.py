@@ -0,0 +1,75 @@
+from flock_agent import Common
+from flock_agent.daemon.global_settings import GlobalSettings
+from flock_agent.daemon.result_dedupe import ResultDeduplicator
+from flock_agent.daemon.submission_queue import SubmissionQueue
+
+
+class TestResultDeduplicator:
+    def _build_deduplicator(self, tmp_path):
+        common = Common(None, None)
+        common.global_settings = GlobalSettings(common, testing=True)
+        common.submission_queue = SubmissionQueue(str(tmp_path))
+        return ResultDeduplicator(common)
+
+    def _snapshot(self, rows):
+        return {"name": "os_version", "action": "snapshot", "snapshot": rows}
+
+    def _added(self, row):
+        return {"name": "suid_bin", "action": "added", "columns": row}
+
+    def _save(self, deduplicator):
+        deduplicator.c.submission_queue.enqueue_many(
+            {}, result_sets=deduplicator.get_changes()
+        )
+
+    def test_unchanged_snapshot_becomes_heartbeat(self, tmp_path):
+        deduplicator = self._build_deduplicator(tmp_path)
+        rows = [{"name": "macOS", "major": "10"}]
+        assert deduplicator.dedupe([self._snapshot(rows)]) == [self._snapshot(rows)]
+
+        logs = deduplicator.dedupe([self._snapshot(rows)])
+        assert logs[0]["action"] == "heartbeat"
+        assert logs[0]["rows"] == 1
+        assert "snapshot" not in logs[0]
+
+        rows = [{"name": "macOS", "major": "11"}]
+        assert deduplicator.dedupe([self._snapshot(rows)]) == [self._snapshot(rows)]
+
+    def test_duplicate_added_rows_are_dropped(self, tmp_path):
+        deduplicator = self._build_deduplicator(tmp_path)
+        rows = [{"path": "/bin/su"}, {"path": "/bin/sudo"}]
+        deduplicator.dedupe([self._added(row) for row in rows])
+
+        # If they're all added again, a single heartbeat replaces them
+        logs = deduplicator.dedupe([self._added(row) for row in rows])
+        assert [obj["action"] for obj in logs] == ["heartbeat"]
+
+        # After a row is removed, adding it again gets submitted
+        removed = {"name": "suid_bin", "action": "removed", "columns": rows[0]}
+        deduplicator.dedupe([removed])
+        assert deduplicator.dedupe([self._added(rows[0])]) == [self._added(rows[0])]
+
+    def test_resync(self, tmp_path):
+        deduplicator = self._build_deduplicator(tmp_path)
+        rows = [{"name": "macOS", "major": "10"}]
+        deduplicator.dedupe([self._snapshot(rows)])
+
+        deduplicator.result_sets["os_version"]["last_full"] -= 86400
+        assert deduplicator.dedupe([self._snapshot(rows)]) == [self._snapshot(rows)]
+        assert deduplicator.dedupe([self._snapshot(rows)])[0]["action"] == "heartbeat"
+
+    def test_index_is_persisted(self, tmp_path):
+        deduplicator = self._build_deduplicator(tmp_path)
+        rows = [{"name": "macOS", "major": "10"}]
+        deduplicator.dedupe([self._snapshot(rows)])
+        self._save(deduplicator)
+
+        deduplicator = ResultDeduplicator(deduplicator.c)
+        assert deduplicator.dedupe([self._snapshot(rows)])[0]["action"] == "heartbeat"
+
+    def test_disabled(self, tmp_path):
+        deduplicator = self._build_deduplicator(tmp_path)
+        deduplicator.c.global_settings.set("result_dedupe", False)
+        rows = [{"name": "macOS", "major": "10"}]
+        deduplicator.dedupe([self._snapshot(rows)])
+        assert deduplicator.dedupe([self._snapshot(rows)]) == [self._snapshot(rows)]
@@ -0,0 +1,89 @@
+from flock_agent.daemon.submission_queue import SubmissionQueue
+
+
+class TestSubmissionQueue:
+    def test_peek_and_ack(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue("osquery", [{"n": i} for i in range(5)])
+
+        batch = queue.peek("osquery", 2)
+        assert batch.items == [{"n": 0}, {"n": 1}]
+
+        # Peeking again without acking returns the same batch
+        assert queue.peek("osquery", 2).items == batch.items
+
+        queue.ack(batch)
+        assert queue.peek("osquery", 10).items == [{"n": i} for i in range(2, 5)]
+        assert queue.depth("osquery") == 3
+
+    def test_sources_are_separate(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue("osquery", [{"n": 1}])
+        queue.enqueue("flock", [{"n": 2}])
+
+        assert queue.peek("flock", 10).items == [{"n": 2}]
+        queue.ack(queue.peek("osquery", 10))
+        assert queue.peek("osquery", 10) is None
+        assert queue.depth("flock") == 1
+
+    def test_enqueue_many(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue_many(
+            {"osquery_high": [{"n": 1}], "osquery_bulk": [{"n": 2}, {"n": 3}]},
+            checkpoint=("results", 123, 456),
+        )
+        assert queue.depths() == {"osquery_high": 1, "osquery_bulk": 2}
+        assert queue.get_checkpoint("results") == (123, 456)
+
+    def test_persisted(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue("osquery", [{"n": 1}], checkpoint=("results", 123, 456))
+        queue.close()
+
+        queue = SubmissionQueue(str(tmp_path))
+        assert queue.peek("osquery", 10).items == [{"n": 1}]
+        assert queue.get_checkpoint("results") == (123, 456)
+        assert queue.get_checkpoint("missing") is None
+
+    def test_budget_drops_oldest(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue("osquery_normal", [{"n": i} for i in range(10)])
+        size = queue.sizes["osquery_normal"]
+
+        # Each of these logs is 8 bytes serialized
+        budget = (size, ["osquery_bulk", "osquery_normal"])
+        dropped = queue.enqueue("osquery_normal", [{"n": 9}], budget=budget)
+        assert dropped == {"osquery_normal": 1}
+        assert queue.peek("osquery_normal", 1).items == [{"n": 1}]
+        assert queue.get_dropped() == {"osquery_normal": 1}
+
+    def test_budget_drops_lowest_priority_first(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        budget = (80, ["osquery_bulk", "osquery_normal", "osquery_high"])
+        queue.enqueue("osquery_high", [{"n": i} for i in range(5)], budget=budget)
+        queue.enqueue("osquery_bulk", [{"n": i} for i in range(4)], budget=budget)
+        dropped = queue.enqueue(
+            "osquery_normal", [{"n": i} for i in range(3)], budget=budget
+        )
+
+        assert dropped == {"osquery_bulk": 2}
+        assert queue.depths() == {
+            "osquery_high": 5,
+            "osquery_normal": 3,
+            "osquery_bulk": 2,
+        }
+
+        # Budgets only apply to their own sources
+        assert queue.enqueue("flock", [{"n": 1}], budget=(8, ["flock"])) == {}
+
+    def test_peek_max_bytes(self, tmp_path):
+        queue = SubmissionQueue(str(tmp_path))
+        queue.enqueue("osquery", [{"n": i} for i in range(5)])
+
+        # Each of these logs is 8 bytes serialized
+        batch = queue.peek("osquery", max_bytes=20)
+        assert batch.items == [{"n": 0}, {"n": 1}]
+        assert batch.size == 16
+
+        # A batch always has at least one log
+        assert queue.peek("osquery", max_bytes=1).items == [{"n": 0}]
@@ -0,0 +1,146 @@
+import threading
+import time
+
+import pytest
+
+from flock_agent import Common
+from flock_agent.daemon.global_settings import GlobalSettings
+from flock_agent.daemon.api_client import PayloadTooLarge, ConnectionError
+from flock_agent.daemon.submission_queue import SubmissionQueue
+from flock_agent.daemon.uploader import Uploader
+
+
+class TestUploader:
+    def _build_uploader(self, tmp_path):
+        common = Common(None, None)
+        common.global_settings = GlobalSettings(common, testing=True)
+        common.global_settings.set("submission_batch_min_bytes", 100)
+        common.global_settings.set("submission_batch_max_bytes", 1600)
+        common.submission_queue = SubmissionQueue(str(tmp_path))
+        return Uploader(common)
+
+    def _enqueue(self, uploader, count):
+        # Each of these logs is 20 bytes serialized
+        uploader.c.submission_queue.enqueue(
+            "osquery", [{"data": "x" * 8} for _ in range(count)]
+        )
+
+    def test_upload_grows_batches(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        uploader.c.global_settings.set("submission_max_in_flight", 1)
+        self._enqueue(uploader, 200)
+
+        batches = uploader.upload("osquery", lambda items: None)
+        sizes = [batch.size for batch in batches]
+        assert sizes == [400, 800, 1600, 1200]
+        assert uploader.c.submission_queue.depth("osquery") == 0
+
+    def test_upload_shrinks_on_error(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        self._enqueue(uploader, 10)
+
+        def submit(items):
+            raise ConnectionError()
+
+        with pytest.raises(ConnectionError):
+            list(uploader.upload("osquery", submit))
+        assert uploader.batch_bytes == 200
+        assert uploader.c.submission_queue.depth("osquery") == 10
+
+    def test_upload_splits_too_large_batches(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        self._enqueue(uploader, 20)
+
+        def submit(items):
+            if len(items) > 5:
+                raise PayloadTooLarge()
+
+        batches = list(uploader.upload("osquery", submit))
+        assert [len(batch.items) for batch in batches][0] == 5
+        assert uploader.c.submission_queue.depth("osquery") == 0
+
+    def test_upload_drops_log_too_large_to_submit(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        self._enqueue(uploader, 1)
+
+        def submit(items):
+            raise PayloadTooLarge()
+
+        assert list(uploader.upload("osquery", submit)) == []
+        assert uploader.c.submission_queue.depth("osquery") == 0
+
+    def test_upload_max_batches(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        uploader.c.global_settings.set("submission_batch_max_bytes", 100)
+        self._enqueue(uploader, 100)
+
+        batches = list(uploader.upload("osquery", lambda items: None, 3))
+        assert len(batches) == 3
+        assert uploader.c.submission_queue.depth("osquery") == 85
+
+    def test_upload_pipelines_batches_in_order(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        uploader.c.global_settings.set("submission_batch_max_bytes", 100)
+        self._enqueue(uploader, 100)
+
+        lock = threading.Lock()
+        state = {"in_flight": 0, "most_in_flight": 0}
+
+        def submit(items):
+            with lock:
+                state["in_flight"] += 1
+                state["most_in_flight"] = max(
+                    state["most_in_flight"], state["in_flight"]
+                )
+            time.sleep(0.01)
+            with lock:
+                state["in_flight"] -= 1
+
+        batches = list(uploader.upload("osquery", submit))
+        assert len(batches) == 20
+        assert [batch.first_seq for batch in batches] == list(range(1, 100, 5))
+        assert state["most_in_flight"] == 4
+        uploader.close()
+
+    def test_upload_error_halves_window(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        uploader.c.global_settings.set("submission_batch_max_bytes", 100)
+        uploader.c.submission_queue.enqueue(
+            "osquery", [{"data": f"{i:08}"} for i in range(100)]
+        )
+        uploader.window = 4.0
+
+        # The third batch fails
+        def submit(items):
+            if items[0]["data"] == "00000010":
+                raise ConnectionError()
+
+        with pytest.raises(ConnectionError):
+            for batch in uploader.upload("osquery", submit):
+                pass
+        assert uploader.window == 2.0
+        assert uploader.c.submission_queue.peek("osquery", 1).items == [
+            {"data": "00000010"}
+        ]
+
+        # The batch after the failed one was accepted, but it stays in the queue
+        assert uploader.c.submission_queue.depth("osquery") == 90
+        uploader.close()
+
+    def test_upload_splits_batches_smaller_than_min_bytes(self, tmp_path):
+        uploader = self._build_uploader(tmp_path)
+        self._enqueue(uploader, 20)
+
+        # The server only accepts 50 bytes, which is below the minimum batch size
+        requests = []
+
+        def submit(items):
+            requests.append(len(items))
+            if len(items) * 20 > 50:
+                raise PayloadTooLarge()
+
+        batches = list(uploader.upload("osquery", submit))
+        assert all(len(batch.items) <= 2 for batch in batches)
+        assert uploader.c.submission_queue.depth("osquery") == 0
+        assert len(requests) < 30
+        uploader.close()
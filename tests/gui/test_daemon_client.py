@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+from aiohttp import web
+
+from flock_agent import Common
+from flock_agent.gui.tabs.health_tab import HealthOsqueryThread
+from flock_agent.gui.daemon_client import (
+    DaemonClient,
+    AsyncDaemonClient,
+    DaemonNotRunningException,
+)
+
+
+class TestDaemonClient:
+    @pytest.fixture
+    def server(self, tmp_path):
+        """
+        Run a fake daemon on a unix socket, and keep track of its connections
+        """
+        unix_socket_path = os.path.join(tmp_path, "socket")
+        connections = set()
+
+        async def get_setting(request):
+            connections.add(id(request.transport))
+            key = request.match_info.get("key")
+            return web.json_response({"data": key, "error": False})
+
+        async def twigs_state(request):
+            if request.headers.get("If-None-Match") == '"1"':
+                return web.Response(status=304, headers={"ETag": '"1"'})
+            response = web.json_response({"data": {"twig_version": 1}, "error": False})
+            response.headers["ETag"] = '"1"'
+            return response
+
+        async def exec_health_batch(request):
+            response = web.StreamResponse()
+            response.content_type = "application/x-ndjson"
+            await response.prepare(request)
+            for obj in [
+                {"name": "fast", "data": [{"a": "1"}], "error": False},
+                {"name": "failed", "data": None, "error": "error"},
+                {"name": "slow", "data": [], "error": False},
+            ]:
+                await response.write((json.dumps(obj) + "\n").encode())
+                await asyncio.sleep(0.05)
+            await response.write_eof()
+            return response
+
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/setting/{key}", get_setting)
+        app.router.add_get("/twigs_state", twigs_state)
+        app.router.add_get("/exec_health_batch", exec_health_batch)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.UnixSite(runner, unix_socket_path).start())
+        t = threading.Thread(target=loop.run_forever)
+        t.start()
+
+        yield unix_socket_path, connections
+
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        t.join()
+
+    def test_connection_is_reused(self, server):
+        unix_socket_path, connections = server
+        client = DaemonClient(Common(None, None))
+        client.unix_socket_path = unix_socket_path
+
+        for key in ["use_server", "gateway_url", "automatically_enable_twigs"]:
+            assert client.get(key) == key
+        assert len(connections) == 1
+
+        assert client.get_twigs_state() == {"twig_version": 1}
+        assert client.twigs_state_etag == '"1"'
+        assert client.get_twigs_state() == {"twig_version": 1}
+
+    def test_exec_health_batch(self, server):
+        unix_socket_path, _ = server
+        client = DaemonClient(Common(None, None))
+        client.unix_socket_path = unix_socket_path
+
+        assert list(client.exec_health_batch()) == [
+            ("fast", [{"a": "1"}]),
+            ("failed", None),
+            ("slow", []),
+        ]
+
+    def test_health_tab_thread(self, server):
+        unix_socket_path, _ = server
+        common = Common(None, None)
+        common.daemon = DaemonClient(common)
+        common.daemon.unix_socket_path = unix_socket_path
+
+        results = []
+        t = HealthOsqueryThread(common)
+        t.query_finished.connect(lambda name, data: results.append((name, data)))
+        t.run()
+        assert results == [("fast", [{"a": "1"}]), ("failed", []), ("slow", [])]
+
+    def test_async_client(self, server):
+        unix_socket_path, connections = server
+        client = AsyncDaemonClient(Common(None, None), limit=2)
+        client.unix_socket_path = unix_socket_path
+
+        async def go():
+            keys = [f"key{i}" for i in range(10)]
+            results = await asyncio.gather(*[client.get(key) for key in keys])
+            assert results == keys
+            assert await client.get_twigs_state() == {"twig_version": 1}
+            assert await client.get_twigs_state() == {"twig_version": 1}
+            await client.close()
+
+        asyncio.new_event_loop().run_until_complete(go())
+        assert 1 <= len(connections) <= 2
+
+    def test_daemon_not_running(self, tmp_path):
+        client = DaemonClient(Common(None, None))
+        client.unix_socket_path = os.path.join(tmp_path, "socket")
+        with pytest.raises(DaemonNotRunningException):
+            client.get("use_server")
+
+        async_client = AsyncDaemonClient(Common(None, None))
+        async_client.unix_socket_path = os.path.join(tmp_path, "socket")
+
+        async def go():
+            try:
+                await async_client.get("use_server")
+            finally:
+                await async_client.close()
+
+        with pytest.raises(DaemonNotRunningException):
+            asyncio.new_event_loop().run_until_complete(go())
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from PyQt5 import QtCore
+
+from flock_agent import Common
+from flock_agent.gui.daemon_client import DaemonNotRunningException
+from flock_agent.gui.main_window import DaemonEventsThread
+
+
+class FakeDaemonClient:
+    """
+    Stands in for DaemonClient. If connected is set, events() yields events until
+    close_events() gets called, and otherwise the daemon isn't running.
+    """
+
+    def __init__(self):
+        self.connected = threading.Event()
+        self.closed = threading.Event()
+        self.connections = 0
+
+    def events(self):
+        self.connections += 1
+        if not self.connected.is_set():
+            raise DaemonNotRunningException
+        self.closed.clear()
+        yield "connected", {"boot_id": "1"}
+        self.closed.wait()
+
+    def close_events(self):
+        self.closed.set()
+
+
+class TestDaemonEventsThread:
+    def _thread(self, monkeypatch):
+        common = Common(None, None)
+        common.daemon = FakeDaemonClient()
+        t = DaemonEventsThread(common)
+
+        # Terminating the thread could leave the daemon client in a broken state
+        t.terminated_calls = []
+        monkeypatch.setattr(t, "terminate", lambda: t.terminated_calls.append(True))
+        return t
+
+    def test_stop_while_waiting_to_reconnect(self, monkeypatch):
+        t = self._thread(monkeypatch)
+        t.start()
+        time.sleep(0.2)
+        assert t.c.daemon.connections == 1
+
+        start = time.monotonic()
+        t.stop()
+        assert time.monotonic() - start < 1
+        assert t.isFinished()
+        assert t.terminated_calls == []
+
+    def test_stop_while_connected(self, monkeypatch):
+        t = self._thread(monkeypatch)
+        connected = []
+        t.connected.connect(connected.append, QtCore.Qt.DirectConnection)
+        t.c.daemon.connected.set()
+        t.start()
+        time.sleep(0.2)
+
+        start = time.monotonic()
+        t.stop()
+        assert time.monotonic() - start < 1
+        assert t.isFinished()
+        assert t.terminated_calls == []
+        assert connected == [False]
+        assert t.c.daemon.connections == 1